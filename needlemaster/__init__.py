@@ -1,2 +1,5 @@
 from .demo import *
 from .environment import *
+from .batched import *
+from .vector import *
+from .corpus import *
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Struct-of-arrays simulation of many needles on the same level.
+"""
+import numpy as np
+import torch
+
+from .environment import Environment, move_array, obs_state
+
+# gate status codes, matching Gate.status
+gate_none = 0
+gate_next = 1
+gate_passed = 2
+gate_failed = 3
+
+
+class BatchedEnvironment:
+    """
+        Runs N copies of an Environment in lockstep. The per-needle state
+        (pose, path length, damage per surface, gate statuses, next gate, time,
+        done) lives in NumPy arrays and one call to step advances every copy.
+
+        Stepping, termination and scoring follow Environment.step,
+        Environment.check_status and Environment.score, so the results match
+        N independent mode_rl Environments. Observations are the obs_state
+        vectors (see Environment.state_vector) stacked into an (N, 11) tensor.
+        Copies that finish are reset automatically; their final score is
+        reported in the returned info.
+    """
+
+    def __init__(self, filename, n, device=torch.device('cpu')):
+        self.n = n
+        self.device = device
+        self.filename = filename
+
+        ''' parse the level once with a regular Environment '''
+        level = Environment(filename, observation=obs_state)
+        self.width = level.width
+        self.height = level.height
+        self.max_time = level.max_time
+        self.state_size = level.state_size
+
+        self.geometry = level.geometry
+        self.deep = self.geometry.deep
+        self.ngates = len(level.gates)
+        self.gate_pose = np.array([[g.x, g.y, g.w] for g in level.gates]).reshape(-1, 3)
+
+        self.start_x = level.needle.x
+        self.start_y = level.needle.y
+        self.start_w = level.needle.w
+
+        self.moves = np.array(move_array)
+
+        self.x = np.zeros(n)
+        self.y = np.zeros(n)
+        self.w = np.zeros(n)
+        self.path_length = np.zeros(n)
+        self.surface_damage = np.zeros((n, self.geometry.nsurfaces))
+        self.gate_status = np.zeros((n, self.ngates), dtype=np.int8)
+        self.next_gate = np.zeros(n, dtype=np.int64)
+        self.t = np.zeros(n, dtype=np.int64)
+        self.in_tissue = np.zeros(n, dtype=bool)
+        self.in_deep = np.zeros(n, dtype=bool)
+        self.done = np.zeros(n, dtype=bool)
+
+    def action_space(self):
+        ''' Return the action space size of the environment '''
+        return len(move_array)
+
+    def reset(self):
+        ''' Reset every copy, return the stacked observations '''
+        self._reset(np.ones(self.n, dtype=bool))
+        return self.observe()
+
+    def _reset(self, which):
+        self.x[which] = self.start_x
+        self.y[which] = self.start_y
+        self.w[which] = self.start_w
+        self.path_length[which] = 0.
+        self.surface_damage[which] = 0.
+        self.gate_status[which] = gate_none
+        self.t[which] = 0
+        self.done[which] = False
+        if self.ngates > 0:
+            self.gate_status[which, 0] = gate_next
+            self.next_gate[which] = 0
+        else:
+            self.next_gate[which] = -1
+        self._collide(which)
+
+    def _tip(self, which):
+        ''' needle tips in the frame used for collision checks '''
+        return np.stack([self.x[which], self.height - self.y[which]], axis=1)
+
+    def _collide(self, which):
+        ''' update the in-tissue and deep tissue flags at the current poses '''
+        inside = self.geometry.surfaces_containing(self._tip(which))
+        self.in_tissue[which] = inside.any(axis=1)
+        self.in_deep[which] = (inside & self.deep).any(axis=1)
+        return inside
+
+    def step(self, actions):
+        """
+            Move every copy one time step forward.
+            Args:
+                actions: (N,) indices into move_array
+            Returns:
+              * (N, state_size) observations
+              * (N,) rewards (the scores)
+              * (N,) done flags
+              * info dict with 'final_score' for the copies that finished
+                (NaN elsewhere); those copies have already been reset
+        """
+        movement = self.moves[np.asarray(actions)]
+        dX = movement[:, 0]
+        dw = movement[:, 1]
+
+        ''' Needle.move, using the in-tissue flag from before the move '''
+        everyone = slice(None)
+        start = self._tip(everyone)
+        dw_move = np.where(self.in_tissue, 0.5 * dw, dw)
+        dw_move = np.where(self.in_tissue & (np.abs(dw_move) > 0.01),
+                0.02 * np.sign(dw_move), dw_move)
+        self.w = self.w + dw_move
+        old_x, old_y = self.x, self.y
+        self.x = self.x + dX * np.cos(self.w)
+        self.y = self.y - dX * np.sin(self.w)
+        self.path_length += np.sqrt((self.x - old_x) ** 2 + (self.y - old_y) ** 2)
+
+        ''' Environment._collide, sweeping the segments the tips moved along '''
+        inside = self._collide(everyone)
+        tip = self._tip(everyone)
+        sweep = self.geometry.sweep(start, tip)
+        self.in_deep |= sweep.deep
+
+        ''' Environment._update_damage '''
+        damage = (np.abs(dw) / 2.0 - 0.01) * 100
+        hit = inside & (np.abs(dw) > 0.02)[:, None]
+        self.surface_damage = np.where(hit,
+                np.minimum(self.surface_damage + damage[:, None], 100), self.surface_damage)
+        total_damage = self.surface_damage.sum(axis=1)
+
+        ''' Environment.check_status: gate passage '''
+        if self.ngates > 0:
+            self._update_gates(sweep)
+
+        valid_pos = (self.x >= 0) & (self.x <= self.width) & \
+                (self.y >= 0) & (self.y <= self.height)
+        valid_deep = ~self.in_deep
+        valid_damage = total_damage < 100
+        valid_t = self.t < self.max_time
+        running = valid_pos & valid_deep & valid_damage & valid_t
+
+        self.t += 1
+        rewards = self.score(total_damage)
+        done = ~running
+
+        info = {'final_score': np.where(done, rewards, np.nan)}
+        if done.any():
+            self._reset(done)
+        return self.observe(), rewards, done, info
+
+    def _update_gates(self, sweep):
+        '''
+            Gate.update_sweep on each copy's next gate, then advance
+            next_gate; repeated from where each gate was decided along the
+            segment, like Environment.check_status
+        '''
+        start = np.zeros(self.n)
+        active = np.nonzero(self.next_gate >= 0)[0]
+        while len(active) > 0:
+            gate_idx = self.next_gate[active]
+            first = np.maximum(sweep.gate_enter[active, gate_idx], start[active, None])
+            reached = np.where((first < sweep.gate_exit[active, gate_idx]) & (first <= 1), first, np.inf)
+            wall = np.minimum(reached[:, 1], reached[:, 2])
+            failed = (wall <= reached[:, 0]) & (wall < np.inf)
+            passed = ~failed & (reached[:, 0] < np.inf)
+
+            changed = passed | failed
+            rows, cols = active[changed], gate_idx[changed]
+            self.gate_status[rows, cols] = np.where(failed[changed], gate_failed, gate_passed)
+            start[rows] = np.where(failed, wall, reached[:, 0])[changed]
+            nxt = cols + 1
+            has_next = nxt < self.ngates
+            self.gate_status[rows[has_next], nxt[has_next]] = gate_next
+            self.next_gate[rows] = np.where(has_next, nxt, -1)
+            active = rows[has_next]
+
+    def score(self, total_damage=None):
+        ''' Environment.score for every copy '''
+        if total_damage is None:
+            total_damage = self.surface_damage.sum(axis=1)
+
+        if self.ngates == 0:
+            gate_score = np.full(self.n, 1000.0)
+        else:
+            passed = (self.gate_status == gate_passed).sum(axis=1)
+            gate_score = 1000.0 * passed / self.ngates
+
+        m = -1.0 * 1000.0 / (2 * self.max_time / 3.)
+        time_score = np.where(self.t <= (1 / 3.) * self.max_time, 1000.0, 1500 + m * self.t)
+
+        W = self.width
+        w = np.maximum(self.path_length, 3 * W)
+        path_score = np.where(self.path_length <= W, 0., -1000.0 / (2 * W) * (w - W))
+
+        damage_score = -1000.0 / 100 * total_damage - 1000.0 * self.in_deep
+
+        return gate_score + time_score + path_score + damage_score
+
+    def observe(self):
+        ''' stacked Environment.state_vector observations '''
+        state = np.zeros((self.n, self.state_size), dtype=np.float32)
+        state[:, 0] = self.x / self.width
+        state[:, 1] = self.y / self.height
+        state[:, 2] = self.w
+        has_gate = self.next_gate >= 0
+        if self.ngates > 0:
+            pose = self.gate_pose[np.maximum(self.next_gate, 0)]
+            state[:, 3] = has_gate
+            state[:, 4] = np.where(has_gate, pose[:, 0] / self.width, 0.)
+            state[:, 5] = np.where(has_gate, pose[:, 1] / self.height, 0.)
+            state[:, 6] = np.where(has_gate, pose[:, 2], 0.)
+        state[:, 7] = self.in_tissue
+        state[:, 8] = self.in_deep
+        state[:, 9] = self.surface_damage.sum(axis=1) / 100.
+        state[:, 10] = self.t.astype(np.float64) / self.max_time
+        return torch.from_numpy(state).to(device=self.device)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the demonstration trials (trial_<level>_<timestamp>.csv) spread over
+one or more data directories.
+"""
+import multiprocessing as mp
+import os
+import numpy as np
+
+from .demo import Demo
+
+index_version = 1
+index_fields = ('level', 'timestamp', 'rows', 'offset', 'size', 'mtime')
+
+
+def _scan_trial(path):
+    ''' (rows, byte offset of the first row) of a trial file '''
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    body = data.lstrip()
+    rows = sum(1 for line in body.splitlines() if line.strip())
+    return rows, len(data) - len(body)
+
+
+def _load_trial(job):
+    ''' parse one trial starting at its byte offset; runs in pool workers too '''
+    path, offset, rows = job
+    with open(path, 'r') as handle:
+        handle.seek(offset)
+        data = Demo.load_array(handle)
+    return data[:rows]
+
+
+class DemoCorpus:
+    """
+        Every trial found in a set of directories, indexed by level.
+
+        The index holds one entry per trial: path, level, timestamp, row
+        count and the byte offset of its first row, plus the file size and
+        modification time used to detect changes. It is kept sorted by
+        (level, timestamp). If index_path is given it is read from there and
+        written back whenever refresh() finds new, changed or removed files,
+        so only those are scanned again.
+
+        Trials are loaded on demand: load() and iter_demos() parse one file
+        at a time, load_all() spreads the parsing over a process pool.
+    """
+
+    def __init__(self, directories, index_path=None, refresh=True):
+        if isinstance(directories, (str, os.PathLike)):
+            directories = [directories]
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.index_path = index_path
+
+        self.paths = np.zeros(0, dtype=str)
+        self.level = np.zeros(0, dtype=np.int64)
+        self.timestamp = np.zeros(0, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.offset = np.zeros(0, dtype=np.int64)
+        self.size = np.zeros(0, dtype=np.int64)
+        self.mtime = np.zeros(0, dtype=np.float64)
+
+        if index_path is not None and os.path.exists(index_path):
+            self._read_index()
+        if refresh:
+            self.refresh()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _read_index(self):
+        with np.load(self.index_path, allow_pickle=False) as index:
+            if int(index['version']) != index_version:
+                return
+            self.paths = index['paths']
+            for field in index_fields:
+                setattr(self, field, index[field])
+
+    def save(self):
+        ''' write the index to index_path (atomically) '''
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'wb') as handle:
+            np.savez(handle, version=index_version, paths=self.paths,
+                     **{field: getattr(self, field) for field in index_fields})
+        os.replace(tmp, self.index_path)
+
+    def refresh(self):
+        """
+            Rescan the directories. Only files that are new or whose size or
+            modification time changed are read. Returns the number of
+            entries added or updated.
+        """
+        known = {path: i for i, path in enumerate(self.paths)}
+        entries = []
+        changed = 0
+        for directory in self.directories:
+            for f in os.scandir(directory):
+                if not (f.name.startswith('trial_') and f.name.endswith('.csv')):
+                    continue
+                stat = f.stat()
+                path = os.path.join(directory, f.name)
+                i = known.pop(path, None)
+                if i is not None and self.size[i] == stat.st_size and self.mtime[i] == stat.st_mtime:
+                    entries.append((path,) + tuple(getattr(self, field)[i] for field in index_fields))
+                    continue
+                level, timestamp = Demo.parse_name(path)
+                rows, offset = _scan_trial(path)
+                entries.append((path, level, int(timestamp), rows, offset, stat.st_size, stat.st_mtime))
+                changed += 1
+
+        if changed == 0 and not known:
+            return 0
+
+        entries.sort(key=lambda e: (e[1], e[2], e[0]))
+        columns = list(zip(*entries)) if entries else [()] * (1 + len(index_fields))
+        self.paths = np.array(columns[0], dtype=str)
+        for field, column, dtype in zip(index_fields, columns[1:], (np.int64,) * 5 + (np.float64,)):
+            setattr(self, field, np.array(column, dtype=dtype))
+        if self.index_path is not None:
+            self.save()
+        return changed
+
+    def levels(self):
+        ''' the levels that have at least one trial '''
+        return np.unique(self.level)
+
+    def select(self, level=None, min_rows=0):
+        ''' indices of the trials of level (all levels if None) with at least min_rows rows '''
+        keep = self.rows >= min_rows
+        if level is not None:
+            keep &= np.isin(self.level, level)
+        return np.nonzero(keep)[0]
+
+    def _job(self, i):
+        return str(self.paths[i]), int(self.offset[i]), int(self.rows[i])
+
+    def _demo(self, i, data, env_width, env_height):
+        demo = Demo(env_width, env_height)
+        demo.set_array(data)
+        demo.env = int(self.level[i])
+        demo.timestamp = int(self.timestamp[i])
+        demo.path = str(self.paths[i])
+        return demo
+
+    def load(self, i, env_width=None, env_height=None):
+        ''' Demo for index entry i '''
+        return self._demo(i, _load_trial(self._job(i)), env_width, env_height)
+
+    def iter_demos(self, level=None, env_width=None, env_height=None):
+        ''' lazily load the Demos of level, one file at a time '''
+        for i in self.select(level):
+            yield self.load(i, env_width, env_height)
+
+    def load_all(self, level=None, env_width=None, env_height=None, workers=None, context=None):
+        ''' load every Demo of level, parsing the files in a pool of workers '''
+        indices = self.select(level)
+        jobs = [self._job(i) for i in indices]
+        if workers is None:
+            workers = mp.cpu_count()
+        workers = max(1, min(workers, len(jobs)))
+        if workers == 1:
+            arrays = [_load_trial(job) for job in jobs]
+        else:
+            with mp.get_context(context).Pool(workers) as pool:
+                arrays = pool.map(_load_trial, jobs, chunksize=max(1, len(jobs) // (4 * workers)))
+        return [self._demo(i, data, env_width, env_height) for i, data in zip(indices, arrays)]
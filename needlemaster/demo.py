@@ -4,7 +4,7 @@ Created on Thu Oct 08 11:31:19 2015
 
 @author: Chris
 """
-import math
+import warnings
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -44,28 +44,28 @@ class Demo:
         plt.plot(self.s[:,0],self.s[:,1])
 
     '''
-    Load demonstration from a file
+    Load demonstration from a file. Each row is t, then the state x, y, w,
+    then the action; the whole file is parsed in one NumPy call.
     '''
     def load(self, handle):
+        self.set_array(self.load_array(handle))
 
-        t = []
-        s = []
-        u = []
+    def set_array(self, data):
+        ''' split an (N, 6) trial array into t, s and u '''
+        self.t = data[:, 0]
+        self.s = data[:, 1:4]
+        self.u = data[:, 4:]
 
-        data = handle.readline()
-        while not data is None and len(data)>0:
-            data = [float(x) for x in data.split(',')]
-
-            t.append(data[0])
-            s.append(data[1:4])
-            u.append(data[4:])
-
-            data = handle.readline()
-
-        self.t = np.array(t)#.transpose()
-        self.s = np.array(s)#.transpose()
-        #self.s[1,:] = self.s[1,:]
-        self.u = np.array(u)#.transpose()
+    @staticmethod
+    def load_array(handle):
+        ''' Parse a trial file (path or open handle) into an (N, 6) array '''
+        with warnings.catch_warnings():
+            # empty trials are expected, loadtxt warns about them
+            warnings.simplefilter('ignore', UserWarning)
+            data = np.loadtxt(handle, delimiter=',', ndmin=2)
+        if data.size == 0:
+            data = np.zeros((0, 6))
+        return data
 
     '''
     convert state, actions into environment coordinate frame
@@ -78,30 +78,32 @@ class Demo:
         self.s[:, 0] = self.s[:, 0] * width_ratio
         self.s[:, 1] = self.s[:, 1] * height_ratio
         ''' update action information '''
-        for t in range(len(self.u)):
-            self.u[t,:] = self.convert_action(self.u[t,:])
+        self.u = self.convert_actions(self.u)
 
     def convert_action(self, a):
-        ''' TODO: vectorize this if we can '''
-        r     = a[0]
-        theta = a[1]
+        ''' convert a single (r, theta) action, see convert_actions '''
+        return self.convert_actions(np.asarray(a, dtype=np.float64)[None, :])[0]
+
+    def convert_actions(self, u):
+        '''
+        convert (N, 2) actions (r, theta) from the device to the environment
+        frame. theta is the heading increment the environment adds to the
+        needle's w, so it is kept as it is. r is scaled by the screen ratio;
+        with unequal width and height ratios it becomes the length of the
+        displacement (r cos(theta), r sin(theta)) scaled per axis, keeping
+        its sign, as the original scalar conversion sketched.
+        '''
         width_ratio  = self.env_width / float(self.device_width)
         height_ratio = self.env_height / float(self.device_height)
-
-        dx = r*math.cos(theta)
-        dy = r*math.sin(theta)
+        r     = u[:, 0]
+        theta = u[:, 1]
 
         if(width_ratio == height_ratio):
             r_prime = width_ratio * r
-            theta_prime = theta
         else:
-            ''' TOOD implement if we have envs with diff aspect ratio'''
-            pass
-
-        # dx_prime = width_ratio * dx
-        # dy_prime = height_ratio * dy
-        #
-        # r_prime = np.sqrt(dx_prime**2 + dy_prime**2)
-        # if(r < 0):
-        #     r_prime = -1*r_prime
-        return np.array([r_prime, theta_prime])
+            dx_prime = width_ratio * r * np.cos(theta)
+            dy_prime = height_ratio * r * np.sin(theta)
+            r_prime = np.copysign(np.sqrt(dx_prime**2 + dy_prime**2), r)
+        theta_prime = theta
+
+        return np.stack([r_prime, theta_prime], axis=1)
@@ -5,6 +5,8 @@ Created on Thu Oct 08 11:30:52 2015
 @author: Chris Paxton
 """
 import os
+import copy
+from collections import namedtuple
 import math
 import numpy as np
 import matplotlib
@@ -15,7 +17,9 @@ from matplotlib.patches import Polygon as Poly
 from shapely.geometry import Polygon, Point # using to replace sympy
 from matplotlib.collections import PatchCollection
 
-from pdb import set_trace as woah
+from .geometry import LevelGeometry
+from .raster import Rasterizer, LayeredRenderer, patch_linewidth, thread_linewidth, green
+from .recorder import FrameRecorder
 
 def safe_load_line(name,handle):
     l = handle.readline()[:-1].split(': ')
@@ -36,13 +40,135 @@ move_array = [(x, y) for x in moves for y in moves]
 mode_demo = 0
 mode_rl = 1
 
+# Rendering backends for Environment.render
+backend_matplotlib = 0
+backend_numpy = 1
+
+# Observations returned by Environment.step/reset: a rendered image, or a
+# compact state vector that skips rendering entirely
+obs_image = 0
+obs_state = 1
+# no observation at all, for headless replay and scoring
+obs_none = 2
+
+# Format of obs_image observations, produced directly when rendering: the
+# frame is size x size pixels, RGB (3 channels) or grayscale (1 channel), and
+# either float32 in [0, 1] or uint8 in [0, 255]
+class ObservationSpec(namedtuple('ObservationSpec', ('size', 'grayscale', 'dtype'),
+        defaults=(224, False, torch.float32))):
+    __slots__ = ()
+
+    @property
+    def channels(self):
+        return 1 if self.grayscale else 3
+
+    @property
+    def shape(self):
+        return (self.channels, self.size, self.size)
+
+# Play state of an Environment, from Environment.snapshot: plain values and
+# references to objects that are replaced rather than changed while playing
+# (the needle's thread is shared copy-on-write, see _Thread), so taking and
+# restoring one copies a few numbers per gate and surface, never the level
+Snapshot = namedtuple('Snapshot', ('geometry', 't', 'done', 'damage', 'next_gate',
+        'collision', 'sweep', 'needle', 'gates', 'surfaces'))
+
+# ITU-R 601 luma weights used for grayscale observations
+luma = np.array([0.299, 0.587, 0.114])
+
+class LevelTemplate:
+    '''
+        A parsed level file. Treated as immutable: the gates, surfaces and
+        collision geometry it holds are shared by every Environment built
+        from it, and instantiate() hands out copies of just the parts that
+        change while playing.
+    '''
+
+    def __init__(self, handle=None):
+        self.height = 0
+        self.width = 0
+        self.gates = []
+        self.surfaces = []
+        self.geometry = LevelGeometry(self.surfaces, self.gates)
+        if handle is not None:
+            self.load(handle)
+
+    '''
+    Load an environment file.
+    '''
+    def load(self, handle):
+
+        D = safe_load_line('Dimensions',handle)
+        height = int(D[1])
+        width = int(D[0])
+        #print " - width=%d, height=%d"%(width, height)
+
+        D = safe_load_line('Gates',handle)
+        ngates = int(D[0])
+        #print " - num gates=%d"%(ngates)
+
+        gates = []
+        for i in range(ngates):
+            gate = Gate(width,height)
+            gate.load(handle)
+            gates.append(gate)
+
+        D = safe_load_line('Surfaces',handle)
+        nsurfaces = int(D[0])
+        #print " - num surfaces=%d"%(nsurfaces)
+
+        surfaces = []
+        for i in range(nsurfaces):
+            s = Surface(width,height)
+            s.load(handle)
+            surfaces.append(s)
+
+        self.set_level(width, height, gates, surfaces)
+
+    def set_level(self, width, height, gates, surfaces):
+        ''' Fill the template from already built gates and surfaces '''
+        self.width = width
+        self.height = height
+        self.gates = gates
+        self.surfaces = surfaces
+        self.geometry = LevelGeometry(self.surfaces, self.gates)
+
+    def instantiate(self):
+        ''' fresh (gates, surfaces) sharing this template's geometry '''
+        return [g.copy() for g in self.gates], [s.copy() for s in self.surfaces]
+
+
+# Parsed levels shared by every Environment in this process, by absolute
+# path, as (modification time, LevelTemplate)
+_level_cache = {}
+
+def load_template(filename):
+    ''' Parse a level file once; reparse only if the file has changed '''
+    path = os.path.abspath(filename)
+    mtime = os.path.getmtime(path)
+    cached = _level_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'r') as file:
+        template = LevelTemplate(file)
+    _level_cache[path] = (mtime, template)
+    return template
+
+
 class Environment:
     metadata = {'render.modes': ['rgb_array']}
 
     background_color = np.array([99., 153., 174.]) / 255
 
-    def __init__(self, filename=None, mode=mode_demo, device=torch.device('cpu')):
+    # length of the obs_state observation, see state_vector
+    state_size = 11
 
+    def __init__(self, filename=None, mode=mode_demo, device=torch.device('cpu'),
+            backend=backend_matplotlib, observation=obs_image, template=None,
+            recorder=None, spec=None, action_repeat=1):
+
+        if action_repeat < 1:
+            raise ValueError('action_repeat must be at least 1, not %d' % action_repeat)
         self.t = 0
         self.height   = 0
         self.width    = 0
@@ -52,10 +178,22 @@ class Environment:
         ''' TODO keep track of which gate is next '''
         self.next_gate    = None
         self.filename = filename
-        if not os.path.exists('./out'):
-            os.mkdir('./out')
+        # a LevelTemplate to play instead of filename, e.g. from a LevelPack
+        self.template = template
+        # FrameRecorder for frames rendered with save_image, created on first use
+        self.recorder = recorder
         self.mode = mode
         self.device = device
+        self.backend = backend
+        self.observation = observation
+        self.spec = ObservationSpec() if spec is None else spec
+        # every step applies its action this many times and observes once
+        self.action_repeat = action_repeat
+        self.raster = None
+        self.layers = None
+        self.geometry = None
+        self.collision = None
+        self.sweep = None
 
         self.reset()
 
@@ -63,6 +201,10 @@ class Environment:
         ''' Dummy method '''
         pass
 
+    def eval(self):
+        ''' Dummy method '''
+        pass
+
     def action_space(self):
         ''' Return the action space size of the environment '''
         return len(move_array)
@@ -79,17 +221,85 @@ class Environment:
         self.passed_gates = 0
         self.next_gate = None
 
-        if self.filename is not None:
-            with open(self.filename, 'r') as file:
-                self.load(file)
+        if self.template is not None:
+            self.use_template(self.template)
+        elif self.filename is not None:
+            self.use_template(load_template(self.filename))
+        else:
+            self.use_template(LevelTemplate())
 
         self.needle = Needle(self.width, self.height)
-
-        return self.render(save_image=True)
+        self._collide()
+
+        if self.backend == backend_numpy and (self.raster is None or
+                (self.raster.env_width, self.raster.env_height) != (self.width, self.height)):
+            self.raster = Rasterizer(self.width, self.height, size=self.spec.size)
+            self.layers = LayeredRenderer(self.raster, self.background_color)
+
+        recording = self.recorder is not None
+        if recording:
+            self.recorder.start_episode(self.episode_name())
+        return self.observe(save_image=recording)
+
+    def episode_name(self):
+        ''' name recordings are saved under, e.g. level_14_demo '''
+        level = 'level' if self.filename is None else 'level_' + self.parse_name(self.filename)
+        return level + ('_demo' if self.mode == mode_demo else '_rl')
+
+    def _record(self, frame):
+        ''' hand a uint8 frame to the recorder; saved images have the x axis inverted '''
+        if self.recorder is None:
+            self.recorder = FrameRecorder()
+            self.recorder.start_episode(self.episode_name())
+        self.recorder.write(self.t, np.fliplr(frame))
+
+    def close(self):
+        ''' wait for recorded frames to be written, and stop recording '''
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def observe(self, save_image=False):
+        ''' Current observation: the rendered frame or the state vector '''
+        if self.observation == obs_state:
+            return self.state_vector()
+        if self.observation == obs_none:
+            return None
+        return self.render(save_image=save_image)
+
+    def state_vector(self):
+        '''
+            Compact float32 observation, used instead of rendering:
+              * needle x, y (normalised by the screen size) and w
+              * 1 if there is a next gate, then its x, y (normalised) and w
+              * needle in tissue, needle in deep tissue
+              * damage / 100, t / max_time
+            Positions stay 0 until a level is loaded: the screen size is 0
+            before that.
+        '''
+        state = np.zeros(self.state_size, dtype=np.float32)
+        if self.width > 0 and self.height > 0:
+            state[0] = self.needle.x / self.width
+            state[1] = self.needle.y / self.height
+        state[2] = self.needle.w
+        if self.next_gate is not None:
+            gate = self.gates[self.next_gate]
+            state[3] = 1.
+            state[4] = gate.x / self.width
+            state[5] = gate.y / self.height
+            state[6] = gate.w
+        state[7] = self._needle_in_tissue()
+        state[8] = self._deep_tissue_intersect()
+        state[9] = self.damage / 100.
+        state[10] = float(self.t) / self.max_time
+        return torch.from_numpy(state).to(device=self.device)
 
 
     def render(self, mode='rgb_array', save_image=False):
-        fig = plt.figure(figsize=(2.24,2.24), dpi=100)
+        if self.backend == backend_numpy:
+            return self._render_numpy(mode, save_image)
+
+        fig = plt.figure(figsize=(2.24,2.24), dpi=self.spec.size / 2.24)
         plt.ylim(self.height)
         plt.xlim(self.width)
         frame = plt.gca()
@@ -105,24 +315,50 @@ class Environment:
 
         self.needle.draw()
 
-        if save_image:
-            woah()
-            frame.invert_xaxis()
-            plt.savefig('./out/{:03d}.png'.format(self.t))
-
         # Return the figure in a numpy buffer
-        if mode == 'rgb_array':
+        if mode == 'rgb_array' or save_image:
             fig.canvas.draw()
-            buf = fig.canvas.tostring_rgb()
-            ncols, nrows = fig.canvas.get_width_height()
+            # RGBA buffer: tostring_rgb and np.fromstring are gone from current releases
+            arr = np.array(fig.canvas.buffer_rgba())[:, :, :3]
             plt.close('all')
-            arr = np.fromstring(buf, dtype=np.uint8).reshape(nrows, ncols, 3)
-            arr = arr.astype(np.float32)
-            arr /= 255.
-            return torch.from_numpy(arr).permute(2,0,1).to(device=self.device)
+            if save_image:
+                self._record(arr)
+            if mode == 'rgb_array':
+                return self._to_tensor(arr)
         else:
             plt.close('all')
 
+    def _to_tensor(self, frame):
+        ''' (H, W, 3) uint8 frame -> observation tensor in the format of self.spec '''
+        if self.spec.grayscale:
+            gray = frame.dot(luma)[None]
+            if self.spec.dtype == torch.uint8:
+                arr = np.round(gray).astype(np.uint8)
+            else:
+                arr = (gray / 255.).astype(np.float32)
+            return torch.from_numpy(arr).to(device=self.device)
+
+        # copy: the numpy backend reuses its frame buffer
+        arr = torch.from_numpy(np.ascontiguousarray(frame.transpose(2, 0, 1)))
+        if self.spec.dtype != torch.uint8:
+            arr = arr.float()
+            arr /= 255.
+        return arr.to(device=self.device)
+
+    def _render_numpy(self, mode='rgb_array', save_image=False):
+        '''
+            Compose the scene with the rasterizer, repainting only the
+            surfaces and gates that changed since the last step.
+            Gives the same layout and tensor format as the matplotlib path.
+        '''
+        frame = self.layers.render(self.surfaces, self.gates, self.needle)
+
+        if save_image:
+            self._record(frame)
+
+        if mode == 'rgb_array':
+            return self._to_tensor(frame)
+
     @staticmethod
     def parse_name(filename):
         toks = filename.split('/')[-1].split('.')[0].split('_')
@@ -132,67 +368,105 @@ class Environment:
     Load an environment file.
     '''
     def load(self, handle):
+        self.use_template(LevelTemplate(handle))
 
-        D = safe_load_line('Dimensions',handle)
-        self.height = int(D[1])
-        self.width = int(D[0])
-        #print " - width=%d, height=%d"%(self.width, self.height)
-
-        D = safe_load_line('Gates',handle)
-        self.ngates = int(D[0])
-        #print " - num gates=%d"%(self.ngates)
-
-        for i in range(self.ngates):
-            gate = Gate(self.width,self.height)
-            gate.load(handle)
-            self.gates.append(gate)
+    def use_template(self, template):
+        ''' Set up the level from a parsed LevelTemplate '''
+        self.height = template.height
+        self.width = template.width
+        self.gates, self.surfaces = template.instantiate()
+        self.geometry = template.geometry
+        self.ngates = len(self.gates)
+        self.nsurfaces = len(self.surfaces)
 
         if(self.ngates > 0):
             self.next_gate = 0
             self.gates[self.next_gate].status = 'next_gate'
 
-        D = safe_load_line('Surfaces',handle)
-        self.nsurfaces = int(D[0])
-        #print " - num surfaces=%d"%(self.nsurfaces)
-
-        for i in range(self.nsurfaces):
-            s = Surface(self.width,self.height)
-            s.load(handle)
-            self.surfaces.append(s)
-
     def step(self, action, save_image=False):
         """
-            Move one time step forward
+            Move one time step forward, or action_repeat time steps with
+            the same action, stopping early if the game ends; only the
+            final state is observed
             Returns:
-              * state of the world (in our case, an image)
-              * reward
+              * state of the world (an image, or a vector with obs_state)
+              * reward: the score of the final state, so the same as the
+                last of action_repeat single steps (the score already
+                accumulates over the episode)
               * done
         """
         if self.mode == mode_rl:
             action = move_array[action]
 
+        for _ in range(self.action_repeat):
+            running = self._advance(action)
+            if not running:
+                break
+        self.done = not running
+        return (self.observe(save_image=save_image), self.score(), self.done)
+
+    def snapshot(self):
+        ''' the current play state as a Snapshot, to go back to with restore '''
+        return Snapshot(self.geometry, self.t, self.done, self.damage, self.next_gate,
+                self.collision, self.sweep, self.needle.state(),
+                tuple(gate.state() for gate in self.gates),
+                tuple(surface.state() for surface in self.surfaces))
+
+    def restore(self, snapshot):
+        '''
+            Go back to a Snapshot of this level, taken from this Environment
+            or any other playing the same LevelTemplate; the next step carries
+            on from there. The next render redraws the whole scene.
+        '''
+        if snapshot.geometry is not self.geometry:
+            raise ValueError('snapshot is of a different level')
+        self.t = snapshot.t
+        self.done = snapshot.done
+        self.damage = snapshot.damage
+        self.next_gate = snapshot.next_gate
+        self.collision = snapshot.collision
+        self.sweep = snapshot.sweep
+        self.needle.set_state(snapshot.needle)
+        for gate, state in zip(self.gates, snapshot.gates):
+            gate.set_state(state)
+        for surface, state in zip(self.surfaces, snapshot.surfaces):
+            surface.set_state(state)
+        if self.layers is not None:
+            self.layers.invalidate()
+
+    def _advance(self, action):
+        ''' one time step of the simulation, returns whether the game goes on '''
         needle_in_tissue = self._needle_in_tissue()
+        start = self._tip()
         self.needle.move(action, needle_in_tissue)
+        self._collide(start)
         self._update_damage(action)
         running = self.check_status()
         self.t += 1
-        return (self.render(save_image=save_image), self.score(), not running)
+        return running
 
-    def _needle_in_tissue(self):
-        for s in self.surfaces:
-            if self._needle_in_surface(s):
-                return True
-        return False
+    def _tip(self):
+        ''' needle tip in the frame used for collision checks '''
+        return (self.needle.x, self.height - self.needle.y)
 
-    def _needle_in_surface(self, s):
-        needle_tip = np.array([self.needle.x, self.height - self.needle.y])
-        s_flag = s.poly.contains(Point(needle_tip))
-        return s_flag
+    def _collide(self, start=None):
+        '''
+            Run every collision test for the current needle tip once; the
+            result is shared by the rest of the step and the next move.
+            The segment the tip moved along from start is swept for gates
+            and deep tissue, so that a long move cannot skip over them.
+        '''
+        needle_tip = self._tip()
+        self.collision = self.geometry.query(needle_tip)
+        self.sweep = self.geometry.sweep_one(needle_tip if start is None else start, needle_tip)
+
+    def _needle_in_tissue(self):
+        return self.collision.in_tissue
 
     def _update_damage(self, movement):
         self.damage = 0
-        for surface in self.surfaces:
-            if self._needle_in_surface(surface):
+        for surface, inside in zip(self.surfaces, self.collision.surfaces):
+            if inside:
                 surface.calc_damage_update_color(movement)
             self.damage += surface.damage
 
@@ -205,18 +479,23 @@ class Environment:
         x = self.needle.x
         y = self.needle.y
 
-        """ have you passed a new gate? """
-        if(self.next_gate is not None):
-            self.gates[self.next_gate].update([x, self.height - y])
+        """ have you passed a new gate? gates are checked in order along
+            the segment the tip moved, from where the previous one was decided """
+        start = 0.
+        while(self.next_gate is not None):
+            g = self.next_gate
+            start = self.gates[g].update_sweep(self.sweep.gate_enter[g], self.sweep.gate_exit[g], start)
             # if you passed or failed the gate
-            if(self.gates[self.next_gate].status != 'next_gate'):
-                # increment to the next gate
-                self.next_gate = self.next_gate + 1
-                if(self.next_gate < self.ngates):
-                    # if we have this many gates, set gate status to be next
-                    self.gates[self.next_gate].status = 'next_gate'
-                else:
-                    self.next_gate = None
+            if start is None:
+                break
+            # increment to the next gate
+            self.next_gate = self.next_gate + 1
+            if(self.next_gate < self.ngates):
+                # if we have this many gates, set gate status to be next
+                self.gates[self.next_gate].status = 'next_gate'
+                self.gates[self.next_gate].dirty = True
+            else:
+                self.next_gate = None
 
         """ are you in a valid game configuration? """
         valid_x = x >= 0 and x <= self.width
@@ -245,12 +524,9 @@ class Environment:
     def _deep_tissue_intersect(self):
         """
             check each surface, does the needle intersect the
-            surface? is the surface deep?
+            surface? is the surface deep? (anywhere along the last move)
         """
-        for s in self.surfaces:
-            if s.deep and self._needle_in_surface(s):
-                return True
-        return False
+        return self.collision.deep or self.sweep.deep
 
     def _compute_passed_gates(self):
         passed_gates = 0
@@ -382,9 +658,31 @@ class Gate:
         self.bottom_box = None
         self.top_box = None
 
+        # set when the gate needs to be redrawn by the numpy renderer
+        self.dirty = False
+
         self.env_width = env_width
         self.env_height = env_height
 
+    def copy(self):
+        ''' copy sharing the (immutable) geometry, with the play state reset '''
+        gate = copy.copy(self)
+        gate.status = None
+        gate.c1 = self.color1
+        gate.c2 = self.color2
+        gate.c3 = self.color3
+        gate.dirty = False
+        return gate
+
+    def state(self):
+        ''' status and colours, see Environment.snapshot '''
+        return (self.status, self.c1, self.c2, self.c3)
+
+    def set_state(self, state):
+        if state[0] != self.status:
+            self.status, self.c1, self.c2, self.c3 = state
+            self.dirty = True
+
     def contains(self, poly, traj):
         return [poly.contains(Point(x)) for x in traj]
 
@@ -392,18 +690,44 @@ class Gate:
         ''' take in current position,
             see if you passed or failed the gate'''
         p = Point(pos)
-        if self.status != 'passed' and \
-            (self.top_box.contains(p) or self.bottom_box.contains(p)):
+        self.update_status(self.box.contains(p), self.top_box.contains(p),
+                self.bottom_box.contains(p))
+
+    def update_sweep(self, enter, exit, start=0.):
+        '''
+            same as update along a segment the needle tip moved, from t =
+            start on, given the (3,) intervals over which it is inside the
+            gate's box, top and bottom (see LevelGeometry.sweep): whichever
+            is reached first decides. Returns the t at which the status
+            changed, or None.
+        '''
+        reached = [max(a, start) for a in enter]
+        reached = [r if r < b and r <= 1 else np.inf for r, b in zip(reached, exit)]
+        wall = min(reached[1], reached[2])
+        if self.status != 'passed' and wall <= reached[0] and wall < np.inf:
+            self.update_status(False, True, False)
+            return wall
+        if self.status == 'next_gate' and reached[0] < np.inf:
+            self.update_status(True, False, False)
+            return reached[0]
+        return None
+
+    def update_status(self, in_box, in_top, in_bottom):
+        ''' same as update, given whether the position is inside the gate's
+            box, top and bottom (see LevelGeometry.query) '''
+        if self.status != 'passed' and (in_top or in_bottom):
             self.status = 'failed'
             self.c1 = self.color_failed
             self.c2 = self.color_failed
             self.c3 = self.color_failed
+            self.dirty = True
 
-        elif self.box.contains(p) and self.status == 'next_gate':
+        elif in_box and self.status == 'next_gate':
             self.status = 'passed'
             self.c1 = self.color_passed
             self.c2 = self.color_passed
             self.c3 = self.color_passed
+            self.dirty = True
 
     def draw(self):
         """
@@ -418,6 +742,20 @@ class Gate:
         axes.add_patch(Poly(self.bottom, facecolor=self.c3))
         # if next_gate, outline in green
 
+    def outline(self):
+        ''' every point the gate is drawn from '''
+        return np.vstack([self.corners, self.top, self.bottom])
+
+    def rasterize(self, raster):
+        ''' same as draw, for the numpy backend '''
+        raster.fill_polygon(self.corners, self.c1)
+        if self.status == 'next_gate':
+            raster.draw_polyline(self.corners, green, patch_linewidth, closed=True)
+        else:
+            raster.draw_polyline(self.corners, self.c1, patch_linewidth, closed=True)
+        raster.fill_polygon(self.top, self.c2)
+        raster.fill_polygon(self.bottom, self.c3)
+
     '''
     Load Gate from file at the current position.
     '''
@@ -431,16 +769,25 @@ class Gate:
         bottomx = safe_load_line('BottomX',handle)
         bottomy = safe_load_line('BottomY',handle)
 
+        pos = [float(p) for p in pos]
+        corners = np.array([[float(x) for x in cornersx], [float(y) for y in cornersy]]).T
+        top = np.array([[float(x) for x in topx], [float(y) for y in topy]]).T
+        bottom = np.array([[float(x) for x in bottomx], [float(y) for y in bottomy]]).T
+        self.setup(pos, corners, top, bottom)
+
+    def setup(self, pos, corners, top, bottom):
+        '''
+        Set up the gate from its values as stored in a level file:
+        pos = (x, y, w) with x, y relative to the screen size, and the
+        (4,2) corners, top and bottom
+        '''
         self.x = self.env_width*float(pos[0])
         self.y = self.env_height*float(pos[1])
         self.w = float(pos[2])
 
-        self.top[:,0] = [float(x) for x in topx]
-        self.top[:,1] = [float(y) for y in topy]
-        self.bottom[:,0] = [float(x) for x in bottomx]
-        self.bottom[:,1] = [float(y) for y in bottomy]
-        self.corners[:,0] = [float(x) for x in cornersx]
-        self.corners[:,1] = [float(y) for y in cornersy]
+        self.top[:] = top
+        self.bottom[:] = bottom
+        self.corners[:] = corners
 
         # apply corrections to make sure the gates are oriented right
         self.w *= -1
@@ -484,10 +831,40 @@ class Surface:
 
         self.poly = None
 
+        # set when the surface needs to be redrawn by the numpy renderer
+        self.dirty = False
+
     def draw(self):
         ''' update damage and surface color '''
         axes = plt.gca()
         axes.add_patch(Poly(self.corners, color=self.color))
+
+    def copy(self):
+        ''' copy sharing the (immutable) geometry, with the damage reset '''
+        surface = copy.copy(self)
+        surface.damage = 0
+        surface.color = np.array(self.deep_color if self.deep else self.light_color)
+        surface.dirty = False
+        return surface
+
+    def state(self):
+        ''' damage and colour, see Environment.snapshot '''
+        return (self.damage, self.color)
+
+    def set_state(self, state):
+        if state[1] is not self.color:
+            self.damage, self.color = state
+            self.dirty = True
+
+    def outline(self):
+        ''' every point the surface is drawn from '''
+        return self.corners
+
+    def rasterize(self, raster):
+        ''' same as draw, for the numpy backend '''
+        raster.fill_polygon(self.corners, self.color)
+        raster.draw_polyline(self.corners, self.color, patch_linewidth, closed=True)
+
     '''
     Load surface from file at the current position
     '''
@@ -496,11 +873,17 @@ class Surface:
 
         sx = [float(x) for x in safe_load_line('SurfaceX',handle)]
         sy = [float(x) for x in safe_load_line('SurfaceY',handle)]
-        self.corners = np.array([sx,sy]).transpose()
-        self.corners[:,1] = self.env_height - self.corners[:,1]
+        self.setup(isdeep[0] == 'true', np.array([sx,sy]).transpose())
 
+    def setup(self, deep, corners):
+        '''
+        Set up the surface from its values as stored in a level file:
+        whether it is deep tissue and its (N,2) corners
+        '''
+        self.corners = np.array(corners, dtype=np.float64)
+        self.corners[:,1] = self.env_height - self.corners[:,1]
 
-        self.deep = isdeep[0] == 'true'
+        self.deep = bool(deep)
         self.deep_color = np.array([207., 69., 32.]) / 255
         self.light_color = np.array([232., 146., 124.]) / 255
         self.color = np.array(self.deep_color if self.deep else self.light_color)
@@ -519,35 +902,95 @@ class Surface:
         alpha = self.damage / 100.
         beta = (100. - self.damage) / 100.
         self.color = beta * self.light_color + alpha * self.deep_color
+        self.dirty = True
+
+class _Thread:
+    '''
+        Preallocated buffer of thread points, shared by a needle and its
+        snapshots. Points below size are never written again; a needle only
+        appends in place at size, and copies the points it has otherwise.
+    '''
+
+    __slots__ = ('points', 'size')
+
+    def __init__(self, points, size):
+        self.points = points
+        self.size = size
+
+    def copy(self, size, capacity):
+        ''' a new buffer holding the first size points, with room for capacity '''
+        points = np.empty((capacity, 2))
+        points[:size] = self.points[:size]
+        return _Thread(points, size)
+
 
 class Needle:
+    '''
+        Needle pose and the thread it leaves behind. The thread is kept in a
+        preallocated (capacity, 2) array that doubles when full, so a move
+        is O(1) however long the episode; thread_points is a view of the
+        points so far.
+    '''
+
+    __slots__ = ('x', 'y', 'w', 'corners', 'scale', 'is_moving', 'env_width', 'env_height',
+                 'thread', 'nthread', 'path_length')
+
+    max_dXY      = 75
+    length_const = 0.08
+    needle_color = np.array([134., 200., 188.])/255
+    thread_color = np.array([167., 188., 214.])/255
+    thread_capacity = 256   # initial number of thread points
 
     def __init__(self, env_width, env_height):
         self.x = 96     # read off from saved demonstrations as start x
         self.y = env_height - 108    # read off from saved demonstrations as start y
         self.w = math.pi
-        self.corners = None
+        self.corners = np.zeros((3, 2))
 
-        self.max_dXY      = 75
-        self.length_const = 0.08
         self.scale        = np.sqrt(env_width**2 + env_height**2)
         self.is_moving    = False
 
         self.env_width = env_width
         self.env_height = env_height
 
-        self.needle_color  = np.array([134., 200., 188.])/255
-        self.thread_color  = np.array([167., 188., 214.])/255
-
-        self.thread_points = [(self.x, self.y)]
+        self.thread = _Thread(np.empty((self.thread_capacity, 2)), 1)
+        self.thread.points[0] = self.x, self.y
+        self.nthread = 1
         self.path_length = 0.
 
         self.load()
 
+    @property
+    def thread_points(self):
+        ''' (N, 2) view of the thread points so far, oldest first '''
+        return self.thread.points[:self.nthread]
+
+    def state(self):
+        ''' pose and thread, see Environment.snapshot '''
+        return (self.x, self.y, self.w, self.corners.copy(), self.thread, self.nthread,
+                self.path_length)
+
+    def set_state(self, state):
+        self.x, self.y, self.w, corners, self.thread, self.nthread, self.path_length = state
+        self.corners[:] = corners
+
     def draw(self):
         self._draw_needle()
         self._draw_thread()
 
+    def rasterize(self, raster):
+        ''' same as _draw_needle, for the numpy backend '''
+        raster.fill_polygon(self.corners, self.needle_color)
+        raster.draw_polyline(self.corners, self.needle_color, patch_linewidth, closed=True)
+
+    def rasterize_thread(self, raster, start=0, mask=None):
+        ''' same as _draw_thread from thread point start on, for the numpy backend '''
+        if self.nthread - start > 1:
+            thread_points = self.thread.points[start:self.nthread].copy()
+            thread_points[:, 1] = self.env_height - thread_points[:, 1]
+            raster.draw_polyline(thread_points, self.thread_color,
+                    thread_linewidth, mask=mask)
+
     def _compute_corners(self):
         """
             given x,y,w compute needle corners and save
@@ -570,15 +1013,15 @@ class Needle:
         bot_y = y - (0.01 * self.scale) * math.sin(bot_w) + \
                 (length * math.sin(w))
 
-        self.corners = np.array([[x, y], [top_x, top_y], [bot_x, bot_y]])
+        self.corners[:] = ((x, y), (top_x, top_y), (bot_x, bot_y))
 
     def _draw_needle(self):
         axes = plt.gca()
         axes.add_patch(Poly(self.corners, color=self.needle_color))
 
     def _draw_thread(self):
-        if len(self.thread_points) > 0:
-            thread_points = np.array(self.thread_points)
+        if self.nthread > 0:
+            thread_points = self.thread_points
             plt.plot(thread_points[:,0],
                     self.env_height - thread_points[:, 1],
                     c=self.thread_color)
@@ -588,7 +1031,6 @@ class Needle:
         """
         # compute the corners for the current position
         self._compute_corners()
-        self.poly = Polygon(self.corners)
 
     def move(self, movement, needle_in_tissue):
         """
@@ -618,9 +1060,17 @@ class Needle:
         self.y = self.y - dX * math.sin(self.w)
 
         self._compute_corners()
-        self.poly = Polygon(self.corners)
-        self.thread_points.append(np.array([self.x, self.y]))
-        dx = self.thread_points[-1][0] - self.thread_points[-2][0]
-        dy = self.thread_points[-1][1] - self.thread_points[-2][1]
+        thread = self.thread
+        if thread.size != self.nthread:
+            # restored from a snapshot, the points after nthread belong to another path
+            self.thread = thread = thread.copy(self.nthread, len(thread.points))
+        elif self.nthread == len(thread.points):
+            self.thread = thread = thread.copy(self.nthread, 2 * self.nthread)
+        last_x, last_y = thread.points[self.nthread - 1]
+        thread.points[self.nthread] = self.x, self.y
+        self.nthread += 1
+        thread.size = self.nthread
+        dx = self.x - last_x
+        dy = self.y - last_y
         dlength = math.sqrt(dx * dx + dy * dy)
         self.path_length += dlength
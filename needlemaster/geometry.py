@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized geometry kernels used instead of per-point shapely queries.
+"""
+from collections import namedtuple
+import numpy as np
+
+
+def convex_halfplanes(polygon):
+    """
+        Half-plane form of a convex polygon: returns A (M,2) and b (M,) such
+        that a point p is strictly inside iff A.dot(p) > b for every edge,
+        whichever way round the corners are listed.
+    """
+    p0 = np.asarray(polygon, dtype=np.float64)
+    p1 = np.roll(p0, -1, axis=0)
+    e = p1 - p0
+    area = np.sum(p0[:, 0] * p1[:, 1] - p1[:, 0] * p0[:, 1])
+    sign = 1. if area >= 0 else -1.
+    A = sign * np.stack([-e[:, 1], e[:, 0]], axis=1)
+    b = sign * (e[:, 0] * p0[:, 1] - e[:, 1] * p0[:, 0])
+    return A, b
+
+
+# Result of LevelGeometry.query for one needle tip
+Collision = namedtuple('Collision', ('surfaces', 'in_tissue', 'deep',
+                                     'gate_box', 'gate_top', 'gate_bottom'))
+
+# Result of LevelGeometry.sweep for the segments a needle tip moved along
+Sweep = namedtuple('Sweep', ('deep', 'gate_enter', 'gate_exit'))
+
+
+class _Kernel:
+    """
+        Stacked linear tests for a subset of a level's surfaces and gates.
+
+        Every test involved is linear in the query point, so they are all
+        stacked into one matrix and evaluated with a single product:
+          * surfaces (possibly concave) use the even-odd rule; for each edge
+            two rows test whether the point's scanline crosses it and a third
+            whether the crossing lies to the right of the point
+          * gate boxes, tops and bottoms are convex quads and use one
+            half-plane row per edge
+    """
+
+    def __init__(self, surfaces, gates, surface_ids, gate_ids):
+        self.surface_ids = np.asarray(surface_ids, dtype=np.int64)
+        self.gate_ids = np.asarray(gate_ids, dtype=np.int64)
+        nsurfaces = len(self.surface_ids)
+        self.ngates = len(self.gate_ids)
+
+        ''' surface edge table '''
+        x0, y0, x1, y1, ids = [], [], [], [], []
+        for i, sid in enumerate(self.surface_ids):
+            c = np.asarray(surfaces[sid].corners, dtype=np.float64)
+            x0.append(c[:, 0])
+            y0.append(c[:, 1])
+            x1.append(np.roll(c[:, 0], -1))
+            y1.append(np.roll(c[:, 1], -1))
+            ids.append(np.full(len(c), i))
+        stack = lambda a: np.concatenate(a) if len(a) > 0 else np.zeros(0)
+        x0, y0, x1, y1 = stack(x0), stack(y0), stack(x1), stack(y1)
+        edge_surface = stack(ids).astype(np.int64)
+        dy = y1 - y0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dxdy = np.where(dy != 0, (x1 - x0) / dy, 0.)
+        self.nedges = len(x0)
+
+        ''' (S, E) incidence matrix used to count crossings per surface '''
+        self.edge_matrix = np.zeros((nsurfaces, self.nedges), dtype=np.int64)
+        self.edge_matrix[edge_surface, np.arange(self.nedges)] = 1
+
+        ''' gate half-planes for box, top, bottom: (G * 3 * 4) rows '''
+        A = np.zeros((self.ngates, 3, 4, 2))
+        b = np.zeros((self.ngates, 3, 4))
+        for g, gid in enumerate(self.gate_ids):
+            gate = gates[gid]
+            for k, quad in enumerate((gate.corners, gate.top, gate.bottom)):
+                A[g, k], b[g, k] = convex_halfplanes(quad)
+
+        ''' a point p passes row r iff rows[r].dot(p) > thresholds[r] '''
+        zeros, ones = np.zeros(self.nedges), np.ones(self.nedges)
+        self.rows = np.concatenate([
+            np.stack([zeros, -ones], axis=1),   # y0 > py
+            np.stack([zeros, -ones], axis=1),   # y1 > py
+            np.stack([-ones, dxdy], axis=1),    # px < x0 + (py - y0) * dxdy
+            A.reshape(-1, 2)])
+        self.thresholds = np.concatenate([-y0, -y1, -(x0 - y0 * dxdy), b.reshape(-1)])
+
+    def tests(self, points):
+        ''' surface membership (..., s) and gate tests (..., g, 3) for this subset '''
+        E = self.nedges
+        hit = points.dot(self.rows.T) > self.thresholds
+        crossing = (hit[..., :E] != hit[..., E:2 * E]) & hit[..., 2 * E:3 * E]
+        surfaces = (crossing.dot(self.edge_matrix.T) & 1).astype(bool)
+        gates = hit[..., 3 * E:].reshape(hit.shape[:-1] + (self.ngates, 3, 4)).all(axis=-1)
+        return surfaces, gates
+
+
+class LevelGeometry:
+    """
+        Precomputed collision kernels for a level, so that every membership
+        test a step needs is answered by one query instead of a shapely
+        contains() per surface and gate.
+
+        The level is covered by a uniform grid. Each cell gets its own
+        _Kernel over just the surfaces and gates whose bounding boxes
+        overlap it, so a query only touches polygons near the needle and
+        its cost does not grow with the number of polygons in the level.
+        Cells with the same candidates share a kernel.
+    """
+
+    def __init__(self, surfaces, gates, resolution=None):
+        self.nsurfaces = len(surfaces)
+        self.ngates = len(gates)
+        self.deep = np.array([s.deep for s in surfaces], dtype=bool)
+
+        boxes = [self._bounds(s.corners) for s in surfaces] + \
+                [self._bounds(np.vstack([g.corners, g.top, g.bottom])) for g in gates]
+        if resolution is None:
+            resolution = int(min(64, np.ceil(2 * np.sqrt(len(boxes))))) if boxes else 1
+        self.resolution = resolution
+
+        if boxes:
+            boxes = np.array(boxes)
+            self.origin = boxes[:, :2].min(axis=0)
+            extent = boxes[:, 2:].max(axis=0) - self.origin
+        else:
+            self.origin = np.zeros(2)
+            extent = np.ones(2)
+        self.cell_size = np.maximum(extent, 1e-9) / resolution
+
+        ''' assign each polygon to the cells its bounding box overlaps '''
+        members = [[[] for _ in range(resolution)] for _ in range(resolution)]
+        for i, box in enumerate(boxes):
+            lo = np.floor((box[:2] - self.origin) / self.cell_size).astype(int)
+            hi = np.floor((box[2:] - self.origin) / self.cell_size).astype(int)
+            lo = np.clip(lo, 0, resolution - 1)
+            hi = np.clip(hi, 0, resolution - 1)
+            for cx in range(lo[0], hi[0] + 1):
+                for cy in range(lo[1], hi[1] + 1):
+                    members[cy][cx].append(i)
+
+        self.kernels = []
+        self.cells = np.full((resolution, resolution), -1, dtype=np.int64)
+        known = {}
+        for cy in range(resolution):
+            for cx in range(resolution):
+                key = tuple(members[cy][cx])
+                if not key:
+                    continue
+                if key not in known:
+                    surface_ids = [i for i in key if i < self.nsurfaces]
+                    gate_ids = [i - self.nsurfaces for i in key if i >= self.nsurfaces]
+                    known[key] = len(self.kernels)
+                    self.kernels.append(_Kernel(surfaces, gates, surface_ids, gate_ids))
+                self.cells[cy, cx] = known[key]
+
+        ''' whole-level tables for sweep: gate half-planes and deep tissue edges '''
+        A = np.zeros((self.ngates, 3, 4, 2))
+        b = np.zeros((self.ngates, 3, 4))
+        for g, gate in enumerate(gates):
+            for k, quad in enumerate((gate.corners, gate.top, gate.bottom)):
+                A[g, k], b[g, k] = convex_halfplanes(quad)
+        self.gate_rows = A.reshape(-1, 2)
+        self.gate_thresholds = b.reshape(-1)
+        gate_bounds = np.array([self._bounds(np.vstack([g.corners, g.top, g.bottom]))
+                                for g in gates]).reshape(-1, 4)
+        edges = [(c, np.roll(c, -1, axis=0) - c) for c in
+                 (np.asarray(s.corners, dtype=np.float64) for s in surfaces if s.deep)]
+        self.deep_edge_start = np.concatenate([e[0] for e in edges]) if edges else np.zeros((0, 2))
+        self.deep_edge_vector = np.concatenate([e[1] for e in edges]) if edges else np.zeros((0, 2))
+        ends = self.deep_edge_start + self.deep_edge_vector
+        ''' the same, as plain floats for sweep_one '''
+        self.sweep_planes = [[list(zip(A[g, k, :, 0].tolist(), A[g, k, :, 1].tolist(), b[g, k].tolist()))
+                              for k in range(3)] for g in range(self.ngates)]
+        self.sweep_edges = np.hstack([self.deep_edge_start, self.deep_edge_vector]).tolist()
+        self.sweep_none = Sweep(False, ((np.inf,) * 3,) * self.ngates, ((-np.inf,) * 3,) * self.ngates)
+        ''' bounding boxes of the gates and deep edges, (lo, hi) corners '''
+        self.sweep_lo = np.concatenate([gate_bounds[:, :2], np.minimum(self.deep_edge_start, ends)])
+        self.sweep_hi = np.concatenate([gate_bounds[:, 2:], np.maximum(self.deep_edge_start, ends)])
+
+    @staticmethod
+    def _bounds(points):
+        points = np.asarray(points, dtype=np.float64)
+        return np.concatenate([points.min(axis=0), points.max(axis=0)])
+
+    def _cell(self, points):
+        ''' kernel index for each (..., 2) point, -1 outside the grid '''
+        c = ((points - self.origin) // self.cell_size).astype(np.int64)
+        inside = ((c >= 0) & (c < self.resolution)).all(axis=-1)
+        kernel = np.full(c.shape[:-1], -1, dtype=np.int64)
+        kernel[inside] = self.cells[c[inside][..., 1], c[inside][..., 0]]
+        return kernel
+
+    def _tests(self, points):
+        ''' surface membership (N,S) and gate tests (N,G,3) for (N,2) points '''
+        points = np.asarray(points, dtype=np.float64)
+        surfaces = np.zeros((len(points), self.nsurfaces), dtype=bool)
+        gates = np.zeros((len(points), self.ngates, 3), dtype=bool)
+        kernel_ids = self._cell(points)
+        for k in np.unique(kernel_ids[kernel_ids >= 0]):
+            kernel = self.kernels[k]
+            sel = np.nonzero(kernel_ids == k)[0]
+            s, g = kernel.tests(points[sel])
+            surfaces[np.ix_(sel, kernel.surface_ids)] = s
+            gates[np.ix_(sel, kernel.gate_ids)] = g
+        return surfaces, gates
+
+    def surfaces_containing(self, points):
+        ''' (N,S) bool: which surfaces contain each of the (N,2) points '''
+        return self._tests(points)[0]
+
+    def gates_containing(self, points):
+        ''' (N,G,3) bool: each point inside each gate's box, top and bottom '''
+        return self._tests(points)[1]
+
+    def query(self, point):
+        ''' every membership test for a single needle tip, as a Collision '''
+        p = np.array(point, dtype=np.float64)
+        surfaces = np.zeros(self.nsurfaces, dtype=bool)
+        gates = np.zeros((self.ngates, 3), dtype=bool)
+        cx, cy = ((p - self.origin) // self.cell_size).astype(int)
+        if 0 <= cx < self.resolution and 0 <= cy < self.resolution and self.cells[cy, cx] >= 0:
+            kernel = self.kernels[self.cells[cy, cx]]
+            s, g = kernel.tests(p)
+            surfaces[kernel.surface_ids] = s
+            gates[kernel.gate_ids] = g
+        return Collision(surfaces, surfaces.any(), (surfaces & self.deep).any(),
+                         gates[:, 0], gates[:, 1], gates[:, 2])
+
+    def sweep(self, starts, ends):
+        """
+            Continuous tests along the (N,2) segments p(t) = start + t (end - start),
+            t in [0, 1], that needle tips moved along:
+              * deep (N,): the segment crosses the boundary of deep tissue
+              * gate_enter, gate_exit (N,G,3): p(t) is strictly inside each
+                gate's box, top and bottom for enter < t < exit, t in [0, 1]
+                (enter = inf and exit = -inf if the segment never is)
+            so a long move cannot jump over a gate or through deep tissue.
+        """
+        p0 = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+        p1 = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+        d = p1 - p0
+
+        ''' Cyrus-Beck clipping: inside every half-plane iff c + t n > 0 '''
+        c = p0.dot(self.gate_rows.T) - self.gate_thresholds
+        n = d.dot(self.gate_rows.T)
+        bound = np.divide(-c, n, out=np.zeros_like(c), where=n != 0)
+        outside = (n == 0) & (c <= 0)
+        lower = np.where(n > 0, bound, np.where(outside, np.inf, -np.inf))
+        upper = np.where(n < 0, bound, np.where(outside, -np.inf, np.inf))
+        shape = (len(p0), self.ngates, 3, 4)
+        enter = lower.reshape(shape).max(axis=-1, initial=-np.inf)
+        exit = upper.reshape(shape).min(axis=-1, initial=np.inf)
+        missed = (enter >= exit) | (enter >= 1) | (exit <= 0)
+        enter[missed], exit[missed] = np.inf, -np.inf
+
+        ''' segment / deep edge intersections, 0 <= t, u <= 1 without dividing '''
+        qx = self.deep_edge_start[:, 0] - p0[:, 0:1]            # (N,E)
+        qy = self.deep_edge_start[:, 1] - p0[:, 1:2]
+        ex, ey = self.deep_edge_vector[:, 0], self.deep_edge_vector[:, 1]
+        dx, dy = d[:, 0:1], d[:, 1:2]
+        denom = dx * ey - dy * ex
+        sign = np.sign(denom)
+        t = (qx * ey - qy * ex) * sign
+        u = (qx * dy - qy * dx) * sign
+        scale = np.abs(denom)
+        deep = ((denom != 0) & (t >= 0) & (t <= scale) & (u >= 0) & (u <= scale)).any(axis=1)
+        return Sweep(deep, enter, exit)
+
+    def sweep_one(self, start, end):
+        """
+            sweep for a single (2,) segment, as a bool and (G,3) nested
+            sequences of floats. Only the gates and deep edges whose bounding
+            boxes overlap the segment's are tested, one at a time.
+        """
+        x0, y0 = float(start[0]), float(start[1])
+        dx, dy = float(end[0]) - x0, float(end[1]) - y0
+        near = np.nonzero((self.sweep_lo[:, 0] <= max(x0, x0 + dx)) & (self.sweep_hi[:, 0] >= min(x0, x0 + dx)) &
+                          (self.sweep_lo[:, 1] <= max(y0, y0 + dy)) & (self.sweep_hi[:, 1] >= min(y0, y0 + dy)))[0]
+        if len(near) == 0:
+            return self.sweep_none
+        enter = [[np.inf] * 3 for _ in range(self.ngates)]
+        exit = [[-np.inf] * 3 for _ in range(self.ngates)]
+        deep = False
+        for i in near.tolist():
+            if i >= self.ngates:
+                qx, qy, ex, ey = self.sweep_edges[i - self.ngates]
+                denom = dx * ey - dy * ex
+                if denom != 0:
+                    sign = 1. if denom > 0 else -1.
+                    t = (qx - x0) * ey - (qy - y0) * ex
+                    u = (qx - x0) * dy - (qy - y0) * dx
+                    deep = deep or 0 <= t * sign <= abs(denom) and 0 <= u * sign <= abs(denom)
+                continue
+            for k in range(3):
+                lower, upper = -np.inf, np.inf
+                for a0, a1, b in self.sweep_planes[i][k]:
+                    c = a0 * x0 + a1 * y0 - b
+                    n = a0 * dx + a1 * dy
+                    if n > 0:
+                        lower = max(lower, -c / n)
+                    elif n < 0:
+                        upper = min(upper, -c / n)
+                    elif c <= 0:
+                        lower, upper = np.inf, -np.inf
+                        break
+                if lower < upper and lower < 1 and upper > 0:
+                    enter[i][k], exit[i][k] = lower, upper
+        return Sweep(deep, enter, exit)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Binary level packs: every level of a corpus compiled into one file that can
+be memory-mapped, so worker processes share its pages instead of each
+parsing the text files.
+
+Layout (little-endian, every field 4 or 8 byte aligned):
+
+    header   magic b'NMLP', uint32 version, uint32 count, uint32 reserved
+    ids      int32[count]     level number, as in environment_<id>.txt
+    offsets  uint64[count]    byte offset of each level record
+    records, one per level:
+        int32[4]              width, height, ngates, nsurfaces
+        float32[ngates, 27]   GatePos (3), then GateX/Y, TopX/Y, BottomX/Y as
+                              (4,2) corners, top and bottom
+        int32[nsurfaces, 2]   IsDeepTissue, number of corners
+        float32[ncorners, 2]  SurfaceX/Y of every surface, one after another
+
+Values are stored as they appear in the level files; Gate.setup and
+Surface.setup apply the same corrections as when parsing text.
+
+    python -m needlemaster.levelpack data/ levels.pack
+"""
+import argparse
+import glob
+import os
+import numpy as np
+
+from .environment import Environment, LevelTemplate, Gate, Surface, safe_load_line
+
+magic = b'NMLP'
+version = 1
+gate_floats = 27
+
+
+def _read_level(handle):
+    ''' raw values of a level file, without any corrections '''
+    D = safe_load_line('Dimensions', handle)
+    width, height = int(D[0]), int(D[1])
+    ngates = int(safe_load_line('Gates', handle)[0])
+    gates = np.zeros((ngates, gate_floats), dtype=np.float32)
+    for i in range(ngates):
+        values = [safe_load_line(name, handle) for name in
+                  ('GatePos', 'GateX', 'GateY', 'TopX', 'TopY', 'BottomX', 'BottomY')]
+        pos = [float(p) for p in values[0]]
+        quads = [np.array([[float(x) for x in values[k]], [float(y) for y in values[k + 1]]]).T
+                 for k in (1, 3, 5)]
+        gates[i] = np.concatenate([pos] + [q.reshape(-1) for q in quads])
+    nsurfaces = int(safe_load_line('Surfaces', handle)[0])
+    table = np.zeros((nsurfaces, 2), dtype=np.int32)
+    coords = []
+    for i in range(nsurfaces):
+        deep = safe_load_line('IsDeepTissue', handle)[0] == 'true'
+        sx = [float(x) for x in safe_load_line('SurfaceX', handle)]
+        sy = [float(y) for y in safe_load_line('SurfaceY', handle)]
+        table[i] = (deep, len(sx))
+        coords.append(np.array([sx, sy], dtype=np.float32).T)
+    coords = np.concatenate(coords) if coords else np.zeros((0, 2), dtype=np.float32)
+    return np.array([width, height, ngates, nsurfaces], dtype=np.int32), gates, table, coords
+
+
+def compile_pack(filenames, out):
+    '''
+        Compile level files into one pack written to out (a path or a
+        binary file object). Levels keep the order of filenames.
+    '''
+    ids, records = [], []
+    for filename in filenames:
+        with open(filename, 'r') as handle:
+            header, gates, table, coords = _read_level(handle)
+        ids.append(int(Environment.parse_name(filename)))
+        records.append(b''.join([header.tobytes(), gates.tobytes(),
+                                 table.tobytes(), coords.tobytes()]))
+
+    count = len(records)
+    offset = 16 + 4 * count + 8 * count
+    offset += -offset % 8
+    offsets = []
+    for record in records:
+        offsets.append(offset)
+        offset += len(record)
+        offset += -offset % 8
+
+    blob = bytearray(offset)
+    blob[:16] = magic + np.array([version, count, 0], dtype=np.uint32).tobytes()
+    blob[16:16 + 4 * count] = np.array(ids, dtype=np.int32).tobytes()
+    blob[16 + 4 * count:16 + 12 * count] = np.array(offsets, dtype=np.uint64).tobytes()
+    for start, record in zip(offsets, records):
+        blob[start:start + len(record)] = record
+
+    if hasattr(out, 'write'):
+        out.write(bytes(blob))
+    else:
+        with open(out, 'wb') as handle:
+            handle.write(bytes(blob))
+
+
+class LevelPack:
+    '''
+        Read-only view of a compiled level pack.
+
+        source is a path, which is memory-mapped, or any bytes-like buffer.
+        template(index) builds (and caches) the LevelTemplate for one level
+        straight from the packed float32 arrays, ready to be passed to
+        Environment(template=...).
+    '''
+
+    def __init__(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            self.data = np.memmap(source, dtype=np.uint8, mode='r')
+        else:
+            self.data = np.frombuffer(source, dtype=np.uint8)
+
+        if bytes(self.data[:4]) != magic:
+            raise ValueError('not a needle master level pack')
+        file_version, count, _ = self._array(4, np.uint32, 3)
+        if file_version != version:
+            raise ValueError('unsupported level pack version %d' % file_version)
+        self.count = int(count)
+        self.ids = self._array(16, np.int32, self.count)
+        self.offsets = self._array(16 + 4 * self.count, np.uint64, self.count)
+        self._templates = {}
+
+    def _array(self, offset, dtype, count):
+        ''' zero-copy view of count values of dtype at a byte offset '''
+        nbytes = np.dtype(dtype).itemsize * count
+        return self.data[offset:offset + nbytes].view(dtype)
+
+    def __len__(self):
+        return self.count
+
+    def index_of(self, level):
+        ''' position in the pack of environment_<level>.txt '''
+        return int(np.nonzero(self.ids == level)[0][0])
+
+    def arrays(self, index):
+        '''
+            Zero-copy views of one level record:
+            (width, height), gates (G,27), surface table (S,2), coordinates (C,2)
+        '''
+        offset = int(self.offsets[index])
+        width, height, ngates, nsurfaces = self._array(offset, np.int32, 4)
+        offset += 16
+        gates = self._array(offset, np.float32, ngates * gate_floats).reshape(ngates, gate_floats)
+        offset += 4 * ngates * gate_floats
+        table = self._array(offset, np.int32, 2 * nsurfaces).reshape(nsurfaces, 2)
+        offset += 8 * nsurfaces
+        ncorners = int(table[:, 1].sum())
+        coords = self._array(offset, np.float32, 2 * ncorners).reshape(ncorners, 2)
+        return (int(width), int(height)), gates, table, coords
+
+    def template(self, index):
+        ''' LevelTemplate for the level at position index in the pack '''
+        if index in self._templates:
+            return self._templates[index]
+
+        (width, height), packed_gates, table, coords = self.arrays(index)
+        gates = []
+        for g in packed_gates.astype(np.float64):
+            gate = Gate(width, height)
+            gate.setup(g[:3], g[3:11].reshape(4, 2), g[11:19].reshape(4, 2), g[19:27].reshape(4, 2))
+            gates.append(gate)
+
+        surfaces = []
+        start = 0
+        for deep, ncorners in table:
+            s = Surface(width, height)
+            s.setup(deep, coords[start:start + ncorners])
+            surfaces.append(s)
+            start += ncorners
+
+        template = LevelTemplate()
+        template.set_level(width, height, gates, surfaces)
+        self._templates[index] = template
+        return template
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile level files into a level pack')
+    parser.add_argument('directory', help='directory with environment_*.txt files')
+    parser.add_argument('out', help='pack file to write')
+    args = parser.parse_args()
+
+    filenames = sorted(glob.glob(os.path.join(args.directory, 'environment_*.txt')),
+                       key=lambda f: int(Environment.parse_name(f)))
+    compile_pack(filenames, args.out)
+    print('wrote %d levels to %s' % (len(filenames), args.out))
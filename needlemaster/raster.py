@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Pure NumPy rasterizer used by Environment.render as an alternative to
+building a matplotlib figure on every step.
+
+The output reproduces the layout of the matplotlib backend: a 2.24in figure,
+the default subplot rectangle, the x axis running from env_width to 1 and the
+y axis from env_height to 1, surfaces and gates underneath the needle and the
+thread on top.
+
+The layout and the antialiased axes spines follow matplotlib at any size
+(dpi = size / 2.24). Polygons, lines and the thread are drawn without
+antialiasing, so pixels on their edges differ; at the default 224 the mean
+pixel difference is about 0.002, and it grows as the frame gets smaller,
+about 0.004 at 84, where edges make up more of it. tests/test_raster.py
+bounds both for 84, 112, 160 and 224.
+
+LayeredRenderer keeps the parts of the scene that rarely change cached between
+steps and only repaints what changed.
+"""
+import math
+import numpy as np
+
+''' default figure layout, matching matplotlib's figure.subplot.* rcParams '''
+figure_inches = 2.24
+axes_rect = (0.125, 0.11, 0.775, 0.77)   # left, bottom, width, height
+
+''' line widths (in points) used by the matplotlib backend '''
+patch_linewidth = 1.0
+thread_linewidth = 1.5
+axes_linewidth = 0.8
+
+white = np.array([1., 1., 1.])
+green = np.array([0., 128., 0.]) / 255
+
+
+def intersect(a, b):
+    ''' intersection of two (r0, r1, c0, c1) pixel windows '''
+    return (max(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3]))
+
+
+def overlaps(a, b):
+    r0, r1, c0, c1 = intersect(a, b)
+    return r0 < r1 and c0 < c1
+
+
+def to_rgb8(color):
+    ''' convert a float RGB colour in [0, 1] to a uint8 triplet '''
+    return np.round(np.asarray(color) * 255).astype(np.uint8)
+
+
+class Rasterizer:
+    """
+        Fills polygons and polylines given in environment (data) coordinates
+        straight into a uint8 size x size x 3 frame.
+
+        Like plt.gca(), drawing goes to the current target: self.frame
+        (preallocated by default) restricted to the pixel window self.clip.
+    """
+
+    def __init__(self, env_width, env_height, size=224):
+        self.size = size
+        self.env_width = env_width
+        self.env_height = env_height
+        self.own_frame = np.zeros((size, size, 3), dtype=np.uint8)
+        self.frame = self.own_frame
+
+        dpi = size / figure_inches
+        self.points_to_pixels = dpi / 72.
+
+        ''' axes rectangle in image coordinates (columns, rows), computed as
+            matplotlib does from the figure size in pixels, figure_inches * dpi,
+            which is not always exactly size '''
+        left, bottom, width, height = axes_rect
+        pixels = figure_inches * dpi
+        self.ax_u0 = left * pixels
+        self.ax_u1 = (left + width) * pixels
+        self.ax_v0 = size - (bottom + height) * pixels
+        self.ax_v1 = size - bottom * pixels
+
+        ''' data -> image affine map; xlim = (W, 1), ylim = (H, 1) '''
+        self.sx = (self.ax_u1 - self.ax_u0) / (1. - env_width)
+        self.sy = (self.ax_v1 - self.ax_v0) / (env_height - 1.)
+
+        ''' pixels whose centres lie inside the axes; everything is clipped here '''
+        self.axes_clip = (int(math.floor(self.ax_v0 + 0.5)), int(math.ceil(self.ax_v1 - 0.5)),
+                     int(math.floor(self.ax_u0 + 0.5)), int(math.ceil(self.ax_u1 - 0.5)))
+        self.clip = self.axes_clip
+
+        self.spine_boxes = self._spines()
+        ''' pixel windows draw_spines changes '''
+        self.spine_windows = [self._window(*box, (0, size, 0, size)) for box in self.spine_boxes]
+
+    def set_target(self, frame=None, clip=None):
+        ''' direct drawing to frame (default: own frame), restricted to clip '''
+        self.frame = self.own_frame if frame is None else frame
+        self.clip = self.axes_clip if clip is None else intersect(self.axes_clip, clip)
+
+    def to_image(self, points):
+        ''' map an (N,2) array of data coordinates to (u, v) image coordinates '''
+        points = np.asarray(points, dtype=np.float64)
+        uv = np.empty_like(points)
+        uv[:, 0] = self.ax_u0 + (points[:, 0] - self.env_width) * self.sx
+        uv[:, 1] = self.ax_v0 + (points[:, 1] - 1.) * self.sy
+        return uv
+
+    def window(self, points, margin=0.):
+        ''' pixel window (r0, r1, c0, c1) covering data points plus margin pixels '''
+        uv = self.to_image(points)
+        return self._window(uv[:, 0].min() - margin, uv[:, 0].max() + margin,
+                            uv[:, 1].min() - margin, uv[:, 1].max() + margin,
+                            (0, self.size, 0, self.size))
+
+    def _window(self, lo_u, hi_u, lo_v, hi_v, clip):
+        ''' pixel window covering a bounding box, clipped to clip '''
+        r0, r1, c0, c1 = clip
+        r0 = max(r0, int(math.floor(lo_v)))
+        r1 = min(r1, int(math.ceil(hi_v)))
+        c0 = max(c0, int(math.floor(lo_u)))
+        c1 = min(c1, int(math.ceil(hi_u)))
+        return r0, r1, c0, c1
+
+    def clear(self, background_color):
+        ''' white figure with the axes face filled with background_color '''
+        self.frame[:] = to_rgb8(white)
+        self.fill_window(self.axes_clip, background_color)
+
+    def fill_window(self, window, color):
+        ''' fill a pixel window of the target, clipped to the current clip '''
+        r0, r1, c0, c1 = intersect(self.clip, window)
+        if r0 < r1 and c0 < c1:
+            self.frame[r0:r1, c0:c1] = to_rgb8(color)
+
+    def fill_polygon(self, points, color):
+        """
+            even-odd scanline fill of a polygon given in data coordinates;
+            only the polygon's bounding box is touched
+        """
+        uv = self.to_image(points)
+        r0, r1, c0, c1 = self._window(uv[:, 0].min(), uv[:, 0].max(),
+                                      uv[:, 1].min(), uv[:, 1].max(), self.clip)
+        if r0 >= r1 or c0 >= c1:
+            return
+
+        cu = np.arange(c0, c1) + 0.5
+        rv = np.arange(r0, r1) + 0.5
+        inside = np.zeros((r1 - r0, c1 - c0), dtype=bool)
+        u0, v0 = uv[:, 0], uv[:, 1]
+        u1, v1 = np.roll(u0, -1), np.roll(v0, -1)
+        for i in range(len(uv)):
+            crosses = (v0[i] > rv) != (v1[i] > rv)
+            if not crosses.any():
+                continue
+            rows = rv[crosses]
+            xint = u0[i] + (rows - v0[i]) * (u1[i] - u0[i]) / (v1[i] - v0[i])
+            inside[crosses] ^= cu[None, :] < xint[:, None]
+
+        self.frame[r0:r1, c0:c1][inside] = to_rgb8(color)
+
+    def draw_polyline(self, points, color, linewidth, closed=False, mask=None):
+        """
+            stroke a polyline given in data coordinates; linewidth is in points
+            as in matplotlib. If mask is given the covered pixels are also
+            recorded there.
+        """
+        uv = self.to_image(points)
+        if closed:
+            uv = np.vstack([uv, uv[:1]])
+        if len(uv) < 2:
+            return
+        self.draw_segments(uv[:-1], uv[1:], color, linewidth, mask=mask)
+
+    def draw_segments(self, starts, ends, color, linewidth, mask=None):
+        """
+            stroke independent segments given in image coordinates; pixels
+            whose centre lies within half a line width of a segment are set
+        """
+        frame, clip = self.frame, self.clip
+        half = self.half_width(linewidth)
+        rgb = to_rgb8(color)
+        for (ua, va), (ub, vb) in zip(starts, ends):
+            r0, r1, c0, c1 = self._window(min(ua, ub) - half, max(ua, ub) + half,
+                                          min(va, vb) - half, max(va, vb) + half, clip)
+            if r0 >= r1 or c0 >= c1:
+                continue
+            pu = np.arange(c0, c1)[None, :] + 0.5 - ua
+            pv = np.arange(r0, r1)[:, None] + 0.5 - va
+            du, dv = ub - ua, vb - va
+            length2 = du * du + dv * dv
+            if length2 > 0:
+                s = np.clip((pu * du + pv * dv) / length2, 0., 1.)
+            else:
+                s = 0.
+            eu = pu - s * du
+            ev = pv - s * dv
+            covered = eu * eu + ev * ev <= half * half
+            frame[r0:r1, c0:c1][covered] = rgb
+            if mask is not None:
+                mask[r0:r1, c0:c1] |= covered
+
+    def half_width(self, linewidth):
+        ''' half of a line width given in points, in pixels '''
+        return 0.5 * linewidth * self.points_to_pixels
+
+    def draw_spines(self):
+        ''' black axes frame drawn on top of everything else, see _spines '''
+        for box in self.spine_boxes:
+            self._darken(*box)
+
+    def _spines(self):
+        """
+            (lo_u, hi_u, lo_v, hi_v) boxes of the four spines, antialiased as
+            by matplotlib's Agg: axes_linewidth wide with projecting caps,
+            snapped to pixel centres if their rounded width in pixels is odd
+            and to pixel edges if it is even
+        """
+        width = axes_linewidth * self.points_to_pixels
+        offset = 0.5 if int(math.floor(width + 0.5)) % 2 else 0.
+        u0 = math.floor(self.ax_u0 + 0.5) + offset
+        u1 = math.floor(self.ax_u1 + 0.5) + offset
+        v0 = math.floor(self.ax_v0 + 0.5) + offset
+        v1 = math.floor(self.ax_v1 + 0.5) + offset
+        half = 0.5 * width
+        return [(lo_u - half, hi_u + half, lo_v - half, hi_v + half)
+                for lo_u, hi_u, lo_v, hi_v in ((u0, u1, v0, v0), (u0, u1, v1, v1),
+                                               (u0, u0, v0, v1), (u1, u1, v0, v1))]
+
+    def _darken(self, lo_u, hi_u, lo_v, hi_v):
+        ''' blend black into the target by the area each pixel shares with a box '''
+        r0, r1, c0, c1 = self._window(lo_u, hi_u, lo_v, hi_v, (0, self.size, 0, self.size))
+        if r0 >= r1 or c0 >= c1:
+            return
+        rows = np.arange(r0, r1)
+        cols = np.arange(c0, c1)
+        cover_v = np.clip(np.minimum(hi_v, rows + 1) - np.maximum(lo_v, rows), 0., 1.)
+        cover_u = np.clip(np.minimum(hi_u, cols + 1) - np.maximum(lo_u, cols), 0., 1.)
+        keep = 1. - cover_v[:, None, None] * cover_u[None, :, None]
+        window = self.frame[r0:r1, c0:c1]
+        window[:] = np.round(window * keep)
+
+
+class LayeredRenderer:
+    """
+        Incremental frame composition on top of a Rasterizer.
+
+        Three layers are kept for the current episode:
+          * static: background, surfaces and gates
+          * thread: static plus every thread segment drawn so far, with a mask
+            of the thread pixels
+          * frame: thread plus the needle triangle, returned to the caller
+
+        A render only repaints surfaces and gates flagged dirty (and whatever
+        overlaps them), appends the new thread segments, and moves the needle
+        by restoring its previous window from the thread layer.
+    """
+
+    def __init__(self, raster, background_color):
+        self.raster = raster
+        self.background_color = background_color
+        size = raster.size
+        self.static = np.zeros((size, size, 3), dtype=np.uint8)
+        self.thread = np.zeros((size, size, 3), dtype=np.uint8)
+        self.frame = np.zeros((size, size, 3), dtype=np.uint8)
+        self.thread_mask = np.zeros((size, size), dtype=bool)
+        self.thread_rgb = None
+        self.nthread = 0
+        self.needle_window = None
+        self.elements = None
+        self.windows = None
+
+    def invalidate(self):
+        ''' redraw every layer on the next render '''
+        self.elements = None
+
+    def _margin(self):
+        return self.raster.half_width(patch_linewidth) + 1
+
+    def _build(self, elements, needle):
+        ''' full redraw of every layer, done once per episode '''
+        raster = self.raster
+        self.elements = elements
+        self.windows = [raster.window(e.outline(), self._margin()) for e in elements]
+
+        raster.set_target(self.static)
+        raster.clear(self.background_color)
+        for element in elements:
+            element.rasterize(raster)
+            element.dirty = False
+
+        self.thread[:] = self.static
+        self.thread_mask[:] = False
+        self.thread_rgb = to_rgb8(needle.thread_color)
+        self.nthread = 0
+
+        self.frame[:] = self.thread
+        self.needle_window = None
+
+    def _repaint(self, window):
+        ''' redraw the static layer inside window and propagate it upwards '''
+        raster = self.raster
+        raster.set_target(self.static, window)
+        raster.fill_window(window, self.background_color)
+        for element, element_window in zip(self.elements, self.windows):
+            if overlaps(window, element_window):
+                element.rasterize(raster)
+
+        r0, r1, c0, c1 = window
+        thread = self.thread[r0:r1, c0:c1]
+        thread[:] = self.static[r0:r1, c0:c1]
+        thread[self.thread_mask[r0:r1, c0:c1]] = self.thread_rgb
+        self.frame[r0:r1, c0:c1] = thread
+
+    def render(self, surfaces, gates, needle):
+        ''' compose the current scene and return the (reused) frame buffer '''
+        raster = self.raster
+        elements = surfaces + gates
+        if self.elements is None or len(elements) != len(self.elements) or \
+                any(a is not b for a, b in zip(elements, self.elements)):
+            self._build(elements, needle)
+
+        for element, window in zip(self.elements, self.windows):
+            if element.dirty:
+                self._repaint(window)
+                element.dirty = False
+
+        # append the thread segments added since the last render
+        npoints = needle.nthread
+        if npoints > 1 and npoints > self.nthread:
+            start = max(self.nthread - 1, 0)
+            raster.set_target(self.thread)
+            needle.rasterize_thread(raster, start, mask=self.thread_mask)
+            raster.set_target(self.frame)
+            needle.rasterize_thread(raster, start)
+        self.nthread = npoints
+
+        # move the needle: restore its old window (and the spines, which are
+        # blended into what is below them), draw it at the new pose and put
+        # the thread back on top
+        for r0, r1, c0, c1 in raster.spine_windows:
+            self.frame[r0:r1, c0:c1] = self.thread[r0:r1, c0:c1]
+        if self.needle_window is not None:
+            r0, r1, c0, c1 = self.needle_window
+            self.frame[r0:r1, c0:c1] = self.thread[r0:r1, c0:c1]
+        window = raster.window(needle.corners, self._margin())
+        raster.set_target(self.frame, window)
+        needle.rasterize(raster)
+        r0, r1, c0, c1 = window
+        self.frame[r0:r1, c0:c1][self.thread_mask[r0:r1, c0:c1]] = self.thread_rgb
+        self.needle_window = window
+
+        raster.set_target(self.frame)
+        raster.draw_spines()
+        raster.set_target()
+        return self.frame
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Recording of rendered frames off the simulation thread.
+"""
+import atexit
+import contextlib
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import numpy as np
+from PIL import Image
+
+# output formats
+record_png = 'png'
+record_gif = 'gif'
+record_mp4 = 'mp4'
+
+
+class FrameRecorder:
+    """
+        Writes frames handed over by Environment.render from a background
+        thread, so stepping does not wait on image encoding or the disk.
+
+        Frames go through a queue of at most queue_size entries; write()
+        only blocks when the writer falls that far behind. Every episode
+        started with start_episode(name) is written as
+          * record_png: numbered files <name>_<t>.png
+          * record_gif: one animated <name>.gif, written when the episode ends
+          * record_mp4: one <name>.mp4, streamed to ffmpeg as frames arrive
+        Episodes that reuse a name get a _<n> suffix instead of overwriting.
+
+        Call close() (or flush()) to wait for pending frames; close() is also
+        run at exit. start_episode and write raise ValueError once closed.
+
+        If writing fails the writer keeps draining the queue, dropping
+        frames, and the error is raised again from the next start_episode,
+        write, flush or close.
+    """
+
+    def __init__(self, directory='./out', format=record_png, fps=10, queue_size=64):
+        if format not in (record_png, record_gif, record_mp4):
+            raise ValueError('unknown recording format %r' % format)
+        if format == record_mp4 and shutil.which('ffmpeg') is None:
+            raise RuntimeError('recording mp4 needs the ffmpeg executable')
+        self.directory = directory
+        self.format = format
+        self.fps = fps
+        self.names = {}
+        self.error = None   # first exception raised by the writer thread
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def start_episode(self, name):
+        ''' frames written from now on belong to a new episode called name '''
+        self._check_open()
+        count = self.names.get(name, 0)
+        self.names[name] = count + 1
+        if count > 0:
+            name = '%s_%d' % (name, count)
+        self.queue.put(('episode', name))
+
+    def write(self, t, frame):
+        ''' queue a copy of an (H, W, 3) uint8 frame for time step t '''
+        self._check_open()
+        self.queue.put(('frame', t, np.array(frame, dtype=np.uint8, copy=True)))
+
+    def flush(self):
+        ''' wait until every queued frame has been written '''
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        ''' finish the current episode and stop the writer thread '''
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(('close',))
+        self.thread.join()
+        atexit.unregister(self.close)
+        self._check()
+
+    def _check(self):
+        ''' raise the writer thread's error, if any '''
+        if self.error is not None:
+            raise self.error
+
+    def _check_open(self):
+        ''' raise if frames can no longer be queued: nothing drains the queue after close '''
+        if self.closed:
+            raise ValueError('recorder is closed')
+        self._check()
+
+    def _run(self):
+        episode = None
+        message = None
+        while message != ('close',):
+            message = self.queue.get()
+            try:
+                if self.error is not None:
+                    continue
+                if message[0] == 'frame':
+                    if episode is None:
+                        episode = self._open('frames')
+                    episode.add(*message[1:])
+                else:
+                    if episode is not None:
+                        episode.finish()
+                        episode = None
+                    if message[0] == 'episode':
+                        episode = self._open(message[1])
+            except Exception as error:
+                # keep draining so that write and close never block on a full queue
+                self.error = error
+                if episode is not None:
+                    with contextlib.suppress(Exception):
+                        episode.finish()
+                    episode = None
+            finally:
+                self.queue.task_done()
+
+    def _open(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        if self.format == record_png:
+            return _PngEpisode(path)
+        if self.format == record_gif:
+            return _GifEpisode(path + '.gif', self.fps)
+        return _Mp4Episode(path + '.mp4', self.fps)
+
+
+class _PngEpisode:
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, t, frame):
+        Image.fromarray(frame).save('{}_{:05d}.png'.format(self.path, t))
+
+    def finish(self):
+        pass
+
+
+class _GifEpisode:
+    ''' frames are palette-quantized as they arrive, the file is written at the end '''
+
+    def __init__(self, path, fps):
+        self.path = path
+        self.duration = int(round(1000. / fps))
+        self.frames = []
+
+    def add(self, t, frame):
+        self.frames.append(Image.fromarray(frame).quantize(colors=256))
+
+    def finish(self):
+        if self.frames:
+            self.frames[0].save(self.path, save_all=True, append_images=self.frames[1:],
+                                duration=self.duration, loop=0)
+        self.frames = []
+
+
+class _Mp4Episode:
+    ''' raw RGB frames piped to an ffmpeg process '''
+
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.process = None
+
+    def add(self, t, frame):
+        if self.process is None:
+            height, width = frame.shape[:2]
+            self.process = subprocess.Popen(
+                ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                 '-s', '%dx%d' % (width, height), '-r', str(self.fps), '-i', '-',
+                 '-pix_fmt', 'yuv420p', self.path], stdin=subprocess.PIPE)
+        self.process.stdin.write(frame.tobytes())
+
+    def finish(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Headless replay of recorded demonstrations: every trial's action sequence is
+played through an Environment that never renders, and the final score is
+broken down into its gate, time, path and damage parts.
+
+    python -m needlemaster.replay data/ --out scores.csv
+"""
+import argparse
+import contextlib
+import csv
+import multiprocessing as mp
+import os
+import sys
+import numpy as np
+
+from .corpus import DemoCorpus, _load_trial
+from .demo import Demo
+from .environment import Environment, mode_demo, obs_none
+
+score_fields = ('path', 'level', 'timestamp', 'rows', 'steps', 'finished',
+                'passed_gates', 'ngates', 'path_length', 'damage', 'deep',
+                'gate_score', 'time_score', 'path_score', 'damage_score', 'score')
+
+# per-process Environments, one per level file
+_envs = {}
+
+
+def replay(env, actions):
+    """
+        Play an (N, 2) array of demo actions from the start of the level.
+        Stops when the game ends or the actions run out.
+        Returns the score breakdown as a dict (see score_fields).
+    """
+    # check_status and _damage_score report on stdout, keep the replay quiet
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        env.reset()
+        done = False
+        while not done and env.t < len(actions):
+            _, _, done = env.step(actions[env.t, 0:2])
+        parts = (env._gate_score(), env._time_score(), env._path_score(), env._damage_score())
+    return {
+        'steps': env.t,
+        'finished': bool(done),
+        'passed_gates': env._compute_passed_gates(),
+        'ngates': env.ngates,
+        'path_length': env.needle.path_length,
+        'damage': env.damage,
+        'deep': bool(env._deep_tissue_intersect()),
+        'gate_score': parts[0],
+        'time_score': parts[1],
+        'path_score': parts[2],
+        'damage_score': parts[3],
+        'score': sum(parts),
+    }
+
+
+def _replay_trial(job):
+    """
+        replay one (level file, trial, level, timestamp) job, where trial is
+        a DemoCorpus job (path, offset, rows): the trial is parsed here, in
+        the worker, reusing this process's Environments
+    """
+    level_file, trial, level, timestamp = job
+    if level_file not in _envs:
+        _envs[level_file] = Environment(level_file, mode=mode_demo, observation=obs_none)
+    demo = Demo(None, None)
+    demo.set_array(_load_trial(trial))
+    row = replay(_envs[level_file], demo.u)
+    row.update(path=trial[0], level=level, timestamp=timestamp, rows=len(demo.u))
+    return row
+
+
+def score_corpus(corpus, levels, level=None, workers=None, context=None):
+    """
+        Replay every non-empty trial of corpus (a DemoCorpus), optionally only
+        those of level, against environment_<level>.txt in the levels
+        directory. Trials are spread over a pool of worker processes.
+        Returns one score breakdown dict per trial, in corpus order; trials
+        whose level file is missing are skipped.
+    """
+    indices = [i for i in corpus.select(level, min_rows=1)
+               if os.path.exists(os.path.join(levels, 'environment_%d.txt' % corpus.level[i]))]
+    jobs = [(os.path.join(levels, 'environment_%d.txt' % corpus.level[i]), corpus._job(i),
+             int(corpus.level[i]), int(corpus.timestamp[i])) for i in indices]
+
+    if workers is None:
+        workers = mp.cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1:
+        return [_replay_trial(job) for job in jobs]
+    with mp.get_context(context).Pool(workers) as pool:
+        return pool.map(_replay_trial, jobs, chunksize=max(1, len(jobs) // (4 * workers)))
+
+
+def write_table(rows, out):
+    ''' write score breakdowns as CSV to out (a path or a text file object) '''
+    def write(handle):
+        writer = csv.DictWriter(handle, fieldnames=score_fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    if hasattr(out, 'write'):
+        write(out)
+    else:
+        with open(out, 'w', newline='') as handle:
+            write(handle)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay and score demonstrations')
+    parser.add_argument('directories', nargs='+', help='directories with trial_*.csv files')
+    parser.add_argument('--levels', help='directory with environment_*.txt files (default: the first directory)')
+    parser.add_argument('--level', type=int, default=None, help='only score trials of this level')
+    parser.add_argument('--index', default=None, help='DemoCorpus index file to use and update')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default=None, help='CSV file to write (default: stdout)')
+    args = parser.parse_args()
+
+    corpus = DemoCorpus(args.directories, args.index)
+    rows = score_corpus(corpus, args.levels or args.directories[0], args.level, args.workers)
+    write_table(rows, args.out if args.out is not None else sys.stdout)
+    if args.out is not None:
+        scores = np.array([row['score'] for row in rows])
+        print('scored %d trials, mean score %.1f' % (len(rows), scores.mean() if len(rows) else 0.))
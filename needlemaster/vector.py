@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Process-pool vector environment. Workers own one or more Environment
+instances and write their observations straight into a shared-memory
+array, so frames are never pickled; only actions, rewards and done flags
+travel through the pipes.
+"""
+import multiprocessing as mp
+import numpy as np
+import torch
+
+from .environment import Environment, mode_rl, backend_numpy, obs_none
+
+
+def _worker(pipe, buffer, shape, dtype, first, filenames, env_kwargs):
+    ''' Worker loop: owns the environments for slots first..first+len(filenames) '''
+    torch.set_num_threads(1)
+    obs = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+    envs = [Environment(filename, **env_kwargs) for filename in filenames]
+    slots = range(first, first + len(envs))
+
+    for i, env in zip(slots, envs):
+        obs[i] = env.reset().cpu().numpy()
+    pipe.send('ready')
+
+    while True:
+        cmd, data = pipe.recv()
+        if cmd == 'step':
+            rewards, dones = [], []
+            for i, env, action in zip(slots, envs, data):
+                state, reward, done = env.step(action)
+                if done:
+                    # auto-reset, the terminal frame is replaced by the first
+                    # frame of the next episode
+                    state = env.reset()
+                obs[i] = state.cpu().numpy()
+                rewards.append(reward)
+                dones.append(done)
+            pipe.send((rewards, dones))
+        elif cmd == 'reset':
+            for i, env in zip(slots, envs):
+                obs[i] = env.reset().cpu().numpy()
+            pipe.send(None)
+        elif cmd == 'close':
+            pipe.close()
+            break
+
+
+class VectorEnvironment:
+    """
+        Steps N Environments spread over worker processes.
+
+        Observations are written by the workers into one shared array of
+        shape (N,) + observation shape and of the observations' dtype (uint8
+        with ObservationSpec(dtype=torch.uint8)). step_wait returns a tensor
+        view of it, which the next step overwrites, so copy it if it has
+        to be kept. Environments that finish are reset automatically.
+
+        Args:
+            filename: level file, or a list of N level files
+            n: number of environments (taken from the list if one is given)
+            workers: number of worker processes (default: one per CPU, at
+                most n); environments are split evenly between them
+            context: multiprocessing start method (default: platform default)
+            env_kwargs: passed to Environment, e.g. observation=obs_state
+                (not obs_none: there would be nothing to share)
+    """
+
+    def __init__(self, filename, n=None, workers=None, device=torch.device('cpu'),
+            context=None, **env_kwargs):
+        if env_kwargs.get('observation') == obs_none:
+            raise ValueError('VectorEnvironment shares observations, it cannot run with obs_none')
+        filenames = list(filename) if isinstance(filename, (list, tuple)) else [filename] * n
+        self.n = len(filenames)
+        self.device = device
+        env_kwargs.setdefault('mode', mode_rl)
+        env_kwargs.setdefault('backend', backend_numpy)
+        env_kwargs['device'] = torch.device('cpu')
+
+        ''' probe the observation shape and action space once '''
+        probe = Environment(filenames[0], **env_kwargs)
+        first_obs = probe.reset().cpu().numpy()
+        self.observation_shape = first_obs.shape
+        self.dtype = first_obs.dtype
+        self._action_space = probe.action_space()
+
+        if workers is None:
+            workers = mp.cpu_count()
+        workers = max(1, min(workers, self.n))
+
+        ctx = mp.get_context(context)
+        shape = (self.n,) + self.observation_shape
+        self.buffer = ctx.RawArray('b', int(np.prod(shape)) * self.dtype.itemsize)
+        self.obs = np.frombuffer(self.buffer, dtype=self.dtype).reshape(shape)
+
+        self.pipes = []
+        self.processes = []
+        self.slices = []
+        bounds = np.linspace(0, self.n, workers + 1).astype(int)
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(child, self.buffer, shape, self.dtype.str,
+                    first, filenames[first:last], env_kwargs), daemon=True)
+            process.start()
+            child.close()
+            self.pipes.append(parent)
+            self.processes.append(process)
+            self.slices.append(slice(first, last))
+
+        for pipe in self.pipes:
+            pipe.recv()
+        self.waiting = False
+
+    def action_space(self):
+        ''' Return the action space size of the environment '''
+        return self._action_space
+
+    def _observation(self):
+        return torch.from_numpy(self.obs).to(device=self.device)
+
+    def reset(self):
+        ''' Reset every environment, return the (N, ...) observations '''
+        for pipe in self.pipes:
+            pipe.send(('reset', None))
+        for pipe in self.pipes:
+            pipe.recv()
+        return self._observation()
+
+    def step_async(self, actions):
+        ''' Send one action per environment to the workers without waiting '''
+        actions = [int(a) for a in actions]
+        for pipe, s in zip(self.pipes, self.slices):
+            pipe.send(('step', actions[s]))
+        self.waiting = True
+
+    def step_wait(self):
+        """
+            Wait for the step started by step_async.
+            Returns:
+              * (N, ...) observations (view of the shared buffer)
+              * (N,) rewards
+              * (N,) done flags
+        """
+        rewards, dones = [], []
+        for pipe in self.pipes:
+            r, d = pipe.recv()
+            rewards.extend(r)
+            dones.extend(d)
+        self.waiting = False
+        return self._observation(), np.array(rewards), np.array(dones)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.waiting:
+            self.step_wait()
+        for pipe in self.pipes:
+            pipe.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.pipes = []
+        self.processes = []
@@ -1,3 +1,4 @@
+import copy
 import os
 import random
 import torch
@@ -18,13 +19,13 @@ class Agent():
     self.n = args.multi_step
     self.discount = args.discount
 
-    self.online_net = DQN(args, self.action_space).to(device=args.device)
+    self.online_net = DQN(args, self.action_space, env.spec).to(device=args.device)
     if args.model and os.path.isfile(args.model):
       # Always load tensors onto CPU by default, will shift to GPU if necessary
       self.online_net.load_state_dict(torch.load(args.model, map_location='cpu'))
     self.online_net.train()
 
-    self.target_net = DQN(args, self.action_space).to(device=args.device)
+    self.target_net = DQN(args, self.action_space, env.spec).to(device=args.device)
     self.update_target_net()
     self.target_net.train()
     for param in self.target_net.parameters():
@@ -47,6 +48,23 @@ class Agent():
   def act_e_greedy(self, state, epsilon=0.001):  # High ε can reduce evaluation scores drastically
     return random.randrange(self.action_space) if random.random() < epsilon else self.act(state)
 
+  # Acts based on a batch of N states (e.g. one per environment) with a single forward pass; returns N actions
+  def act_batch(self, states):
+    with torch.no_grad():
+      return (self.online_net(states) * self.support).sum(2).argmax(1).cpu()
+
+  # Acts ε-greedily on a batch of N states; epsilon is one ε for all of them or N values, one per environment.
+  # Only the states that are not explored go through the network
+  def act_e_greedy_batch(self, states, epsilon=0.001):
+    n = states.size(0)
+    explore = torch.rand(n) < torch.as_tensor(epsilon, dtype=torch.float32).expand(n)
+    actions = torch.randint(self.action_space, (n, ))
+    if not explore.all():
+      greedy = ~explore
+      actions[greedy] = self.act_batch(states[greedy.to(device=states.device)])
+    return actions
+
+  # Learns from a batch of mem, a ReplayMemory or a BatchPrefetcher drawing from one
   def learn(self, mem):
     # Sample transitions
     idxs, states, actions, returns, next_states, nonterminals, weights = mem.sample(self.batch_size)
@@ -94,11 +112,33 @@ class Agent():
   def save(self, path):
     torch.save(self.online_net.state_dict(), os.path.join(path, 'model.pth'))
 
+  # Online and target network parameters and optimiser state, for resumable checkpoints
+  def state_dict(self):
+    return {'online_net': self.online_net.state_dict(), 'target_net': self.target_net.state_dict(), 'optimiser': self.optimiser.state_dict()}
+
+  def load_state_dict(self, state):
+    self.online_net.load_state_dict(state['online_net'])
+    self.target_net.load_state_dict(state['target_net'])
+    self.optimiser.load_state_dict(state['optimiser'])
+
   # Evaluates Q-value based on single state (no batch)
   def evaluate_q(self, state):
     with torch.no_grad():
       return (self.online_net(state.unsqueeze(0)) * self.support).sum(2).max(1)[0].item()
 
+  # Evaluates Q-values of a batch of states
+  def evaluate_q_batch(self, states):
+    with torch.no_grad():
+      return (self.online_net(states) * self.support).sum(2).max(1)[0]
+
+  # Copy of the agent for acting only: a frozen copy of the online network in evaluation mode, on the CPU
+  def frozen_copy(self):
+    agent = copy.copy(self)
+    agent.online_net = copy.deepcopy(self.online_net).to(device=torch.device('cpu')).eval()
+    agent.support = self.support.cpu()
+    agent.target_net = agent.optimiser = None
+    return agent
+
   def train(self):
     self.online_net.train()
 
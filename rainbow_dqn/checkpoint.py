@@ -0,0 +1,254 @@
+import contextlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import traceback
+import zlib
+import numpy as np
+import torch
+
+
+# Resumable training checkpoints, one file holding a small torch-serialised state (networks, optimiser, counters,
+# random number generator states) and the arrays of any number of replay memories, written in chunks.
+#
+# Layout (little-endian): magic b'RBCK' and uint32 version; the chunks, each a raw slice of rows of one array (for
+# compressed frames, the uint32 lengths of the slice's frames followed by their bytes, 0 for an empty slot); a JSON
+# index giving the dtype, shape and chunks (first row, end row, byte offset, byte length, CRC-32) of every array; and
+# last the uint64 byte offset of the index followed by the magic again.
+magic = b'RBCK'
+version = 2
+chunk_bytes = 64 << 20  # Approximate size of the slices arrays are written and read in
+stash_rows = 256  # Memory-mapped frames training may overwrite before a background save has read them, see _FrameGuard
+state_name = '__state__'
+
+
+# Row ranges of about chunk_bytes each, starting with the one holding row first and wrapping around
+def _chunks(rows, row_bytes, first=0):
+  step = max(1, chunk_bytes // max(1, int(row_bytes)))
+  starts = list(range(0, rows, step))
+  k = min(first // step, len(starts))
+  return [(start, min(start + step, rows)) for start in starts[k:] + starts[:k]]
+
+
+# Keeps what a background save reads from a memory-mapped frame store (shared with the forked child, not copied on
+# write like the rest of the memory) as it was at the fork. Training overwrites frames in order from first, the slot
+# after the newest, and the child reads them in the same order; before each overwrite the parent calls
+# before_overwrite, which copies a frame the child has not read yet into a shared stash, or once stash_rows are
+# stashed waits for the child to read it. The child takes the overwritten frames of each chunk it reads from the stash.
+class _FrameGuard():
+  def __init__(self, frames, first, checkpointer):
+    self.frames = frames
+    self.first = first
+    self.capacity = len(frames)
+    self.checkpointer = checkpointer
+    rows = min(stash_rows, self.capacity)
+    self.shared = mmap.mmap(-1, 16 + rows * frames[0].nbytes)  # Anonymous shared memory, inherited by the child
+    # Frames read by the child and overwritten by the parent, counted in that order from first
+    self.counters = np.frombuffer(self.shared, dtype=np.int64, count=2)
+    self.stash = np.frombuffer(self.shared, dtype=np.uint8, offset=16).reshape((rows, ) + frames.shape[1:])
+
+  # Parent: the frame at index is about to be overwritten
+  def before_overwrite(self, index):
+    n = int(self.counters[1])
+    if n < self.capacity and self.counters[0] <= n:  # Not read yet (after a full wrap the stash holds the frame)
+      if n < len(self.stash):
+        self.stash[n] = self.frames[index]
+      else:
+        while self.counters[0] <= n and self.checkpointer.busy():
+          time.sleep(0.001)
+    self.counters[1] = n + 1  # Published before the frame changes
+
+  # Child: a copy of frames start to end as they were at the fork
+  def read(self, start, end):
+    rows = np.array(self.frames[start:end])
+    overwritten = min(int(self.counters[1]), len(self.stash))  # Read after the frames: covers any that changed
+    order = (np.arange(start, end) - self.first) % self.capacity
+    patch = order < overwritten
+    rows[patch] = self.stash[order[patch]]
+    return rows
+
+  # Child: frames start to end have been read, and with them every frame before end in overwrite order
+  def done(self, start, end):
+    self.counters[0] = max(int(self.counters[0]), (end - self.first - 1) % self.capacity + 1)
+
+
+def _write(path, state, arrays):
+  with open(path, 'wb') as handle:
+    handle.write(magic + struct.pack('<I', version))
+    index = {state_name: {'dtype': 'bytes', 'shape': [len(state)], 'chunks': [[0, 1, handle.tell(), len(state), zlib.crc32(state)]]}}
+    handle.write(state)
+    for name, (array, first, guard) in arrays.items():
+      compressed = array.dtype == object
+      if compressed:
+        sample = [len(frame) for frame in array[:256] if frame is not None]
+        row_bytes = 4 + (sum(sample) / len(sample) if sample else 0)
+      else:
+        row_bytes = array[:1].nbytes
+      entry = {'dtype': 'zlib' if compressed else array.dtype.str, 'shape': list(array.shape), 'chunks': []}
+      for start, end in _chunks(len(array), row_bytes, first):
+        offset = handle.tell()
+        if compressed:
+          frames = array[start:end]
+          data = np.array([0 if frame is None else len(frame) for frame in frames], dtype='<u4').tobytes()
+          data += b''.join(frame for frame in frames if frame is not None)
+        elif guard is not None:
+          data = memoryview(guard.read(start, end)).cast('B')
+        else:
+          data = memoryview(np.ascontiguousarray(array[start:end])).cast('B')
+        handle.write(data)
+        if guard is not None:
+          guard.done(start, end)
+        entry['chunks'].append([start, end, offset, handle.tell() - offset, zlib.crc32(data)])
+      if guard is not None:
+        guard.counters[0] = guard.capacity
+      index[name] = entry
+    offset = handle.tell()
+    handle.write(json.dumps(index).encode())
+    handle.write(struct.pack('<Q', offset) + magic)
+    handle.flush()
+    os.fsync(handle.fileno())
+
+
+def _read_index(handle):
+  if handle.read(4) != magic or struct.unpack('<I', handle.read(4))[0] != version:
+    raise ValueError('not a version %d checkpoint' % version)
+  end = handle.seek(-12, os.SEEK_END)
+  offset, tail = struct.unpack('<Q4s', handle.read(12))
+  if tail != magic:
+    raise ValueError('truncated checkpoint')
+  handle.seek(offset)
+  return json.loads(handle.read(end - offset).decode())
+
+
+def _check(data, crc, name):
+  if zlib.crc32(data) != crc:
+    raise ValueError('corrupt checkpoint: ' + name + ' does not match its checksum')
+
+
+def _read_array(handle, name, entry, target):
+  if tuple(entry['shape']) != target.shape or entry['dtype'] != ('zlib' if target.dtype == object else target.dtype.str):
+    raise ValueError('checkpoint array is %s %s, not %s %s' % (entry['dtype'], tuple(entry['shape']), target.dtype, target.shape))
+  for start, end, offset, nbytes, crc in entry['chunks']:
+    handle.seek(offset)
+    if entry['dtype'] == 'zlib':
+      data = handle.read(nbytes)
+      _check(data, crc, name)
+      lengths = np.frombuffer(data, dtype='<u4', count=end - start)
+      position = 4 * (end - start)
+      for row, length in zip(range(start, end), lengths.tolist()):
+        target[row] = data[position:position + length] if length > 0 else None
+        position += length
+    else:
+      data = memoryview(target[start:end]).cast('B')
+      if handle.readinto(data) != nbytes:
+        raise ValueError('truncated checkpoint')
+      _check(data, crc, name)
+
+
+# Saves and restores the training state. save() serialises the small state right away, then writes the memories from
+# a forked child process: the child sees a copy-on-write snapshot of the arrays as they were at the fork, so training
+# carries on while they are written. Frames stored in a memory-mapped file (--memory-dir) are shared with the child
+# rather than copied; until the child has read them, appending to such a memory keeps the frames it overwrites for the
+# child (see _FrameGuard). The file is written next to path and renamed over it once complete, so an interrupted save
+# leaves the previous checkpoint in place, and load() checks every chunk against its checksum. Where fork is
+# unavailable the checkpoint is written before save() returns.
+# The parent forks with other threads running (a BatchPrefetcher, a FrameRecorder, torch's intra-op pool), and the
+# child only has the thread that forked, so any lock another thread held at the fork stays held in the child. The
+# child therefore only touches what save() prepared: the state is serialised with torch before the fork, the memories'
+# locks are held across it, the arrays are written with numpy, zlib and plain file I/O, a failure is reported straight
+# to file descriptor 2 rather than through sys.stderr, and the child leaves with os._exit.
+class Checkpointer():
+  def __init__(self, path):
+    self.path = path
+    self.pid = None  # Child process writing the current checkpoint
+    self.guarded = []  # Memories whose memory-mapped frames the child is reading
+
+  def exists(self):
+    return os.path.isfile(self.path)
+
+  # Whether a background save is still running (reaps it if it has finished)
+  def busy(self):
+    if self.pid is None:
+      return False
+    pid, status = os.waitpid(self.pid, os.WNOHANG)
+    if pid == 0:
+      return True
+    self._reaped(status)
+    return False
+
+  # Waits for a background save to finish
+  def wait(self):
+    if self.pid is not None:
+      self._reaped(os.waitpid(self.pid, 0)[1])
+
+  def _reaped(self, status):
+    self.pid = None
+    for mem in self.guarded:
+      mem.frame_guard = None
+    self.guarded = []
+    if status != 0:
+      print('Checkpoint to ' + self.path + ' failed', file=sys.stderr)
+
+  # Saves state (any torch-serialisable object) and a dict of named ReplayMemorys; returns False, without saving, while
+  # the previous checkpoint is still being written
+  def save(self, state, memories):
+    if self.busy():
+      return False
+    buffer = io.BytesIO()
+    torch.save({'state': state, 'memories': {name: mem.checkpoint_state() for name, mem in memories.items()}}, buffer)
+    forking = hasattr(os, 'fork')
+    arrays, guarded = {}, []
+    for name, mem in memories.items():
+      for key, array in mem.checkpoint_arrays().items():
+        guard = None
+        if forking and key == 'frames' and mem.storage is not None:
+          guard = _FrameGuard(array, mem.transitions.index, self)
+          guarded.append((mem, guard))
+        arrays[name + '/' + key] = (array, mem.transitions.index, guard)
+    if not forking:
+      self._save(buffer.getbuffer(), arrays)
+      return True
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with contextlib.ExitStack() as locks:  # Fork with no sample or priority update half done
+      for mem in memories.values():
+        locks.enter_context(mem.lock)
+      pid = os.fork()
+      if pid == 0:
+        status = 1
+        try:
+          self._save(buffer.getbuffer(), arrays)
+          status = 0
+        except BaseException:
+          os.write(2, traceback.format_exc().encode())  # sys.stderr's lock may have been held at the fork
+        finally:
+          os._exit(status)  # Skip the parent's exit handlers
+      self.pid = pid
+      for mem, guard in guarded:
+        mem.frame_guard = guard
+      self.guarded = [mem for mem, _ in guarded]
+    return True
+
+  def _save(self, state, arrays):
+    tmp = self.path + '.tmp'
+    _write(tmp, state, arrays)
+    os.replace(tmp, self.path)
+
+  # Restores the memories in place and returns the saved state
+  def load(self, memories):
+    with open(self.path, 'rb') as handle:
+      index = _read_index(handle)
+      _, _, offset, nbytes, crc = index[state_name]['chunks'][0]
+      handle.seek(offset)
+      state = handle.read(nbytes)
+      _check(state, crc, state_name)
+      saved = torch.load(io.BytesIO(state), map_location='cpu', weights_only=False)
+      for name, mem in memories.items():
+        mem.load_checkpoint_state(saved['memories'][name])
+        for key, array in mem.checkpoint_arrays().items():
+          _read_array(handle, name + '/' + key, index[name + '/' + key], array)
+    return saved['state']
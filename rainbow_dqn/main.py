@@ -6,11 +6,12 @@ import random
 import torch
 
 from .agent import Agent
+from .checkpoint import Checkpointer
 #from .env import Env
-from .memory import ReplayMemory
-from .test import test
+from .memory import ReplayMemory, FrameHistory, BatchPrefetcher
+from .test import test, results_state, load_results_state
 
-from needlemaster.environment import Environment, mode_rl
+from needlemaster.environment import Environment, ObservationSpec, mode_rl
 
 
 parser = argparse.ArgumentParser(description='Rainbow')
@@ -19,7 +20,11 @@ parser.add_argument('--disable-cuda', action='store_true', help='Disable CUDA')
 parser.add_argument('--game', type=str, default='space_invaders', help='ATARI game')
 parser.add_argument('--T-max', type=int, default=int(50e6), metavar='STEPS', help='Number of training steps (4x number of frames)')
 parser.add_argument('--max-episode-length', type=int, default=int(108e3), metavar='LENGTH', help='Max episode length (0 to disable)')
+parser.add_argument('--action-repeat', type=int, default=1, metavar='K', help='Simulation steps each action is repeated for, observing only after the last')
 parser.add_argument('--history-length', type=int, default=3, metavar='T', help='Number of consecutive states processed')
+parser.add_argument('--observation-size', type=int, default=224, metavar='SIZE', help='Width and height of rendered observations')
+parser.add_argument('--grayscale', action='store_true', help='Render grayscale observations (stacked over --history-length frames)')
+parser.add_argument('--uint8-observations', action='store_true', help='Render uint8 instead of float observations')
 parser.add_argument('--hidden-size', type=int, default=512, metavar='SIZE', help='Network hidden size')
 parser.add_argument('--noisy-std', type=float, default=0.1, metavar='σ', help='Initial standard deviation of noisy linear layers')
 parser.add_argument('--atoms', type=int, default=51, metavar='C', help='Discretised size of value distribution')
@@ -27,7 +32,10 @@ parser.add_argument('--V-min', type=float, default=-10, metavar='V', help='Minim
 parser.add_argument('--V-max', type=float, default=10, metavar='V', help='Maximum of value distribution support')
 parser.add_argument('--model', type=str, metavar='PARAMS', help='Pretrained model (state dict)')
 parser.add_argument('--memory-capacity', type=int, default=int(1e6), metavar='CAPACITY', help='Experience replay memory capacity')
+parser.add_argument('--memory-compression', action='store_true', help='Store replay frames zlib-compressed in RAM')
+parser.add_argument('--memory-dir', type=str, default=None, metavar='DIR', help='Keep replay frames in a memory-mapped file in this directory instead of RAM')
 parser.add_argument('--replay-frequency', type=int, default=4, metavar='k', help='Frequency of sampling from memory')
+parser.add_argument('--prefetch-batches', type=int, default=2, metavar='N', help='Number of batches sampled ahead on a background thread (0 to sample in the learner)')
 parser.add_argument('--priority-exponent', type=float, default=0.5, metavar='ω', help='Prioritised experience replay exponent (originally denoted α)')
 parser.add_argument('--priority-weight', type=float, default=0.4, metavar='β', help='Initial prioritised experience replay importance sampling weight')
 parser.add_argument('--multi-step', type=int, default=3, metavar='n', help='Number of steps for multi-step return')
@@ -41,14 +49,19 @@ parser.add_argument('--learn-start', type=int, default=int(80e3), metavar='STEPS
 parser.add_argument('--evaluate', action='store_true', help='Evaluate only')
 parser.add_argument('--evaluation-interval', type=int, default=100000, metavar='STEPS', help='Number of training steps between evaluations')
 parser.add_argument('--evaluation-episodes', type=int, default=10, metavar='N', help='Number of evaluation episodes to average over')
+parser.add_argument('--evaluation-workers', type=int, default=None, metavar='N', help='Number of processes to spread evaluation episodes over (default: one per CPU)')
 parser.add_argument('--evaluation-size', type=int, default=500, metavar='N', help='Number of transitions to use for validating Q')
 parser.add_argument('--log-interval', type=int, default=25000, metavar='STEPS', help='Number of training steps between logging status')
+parser.add_argument('--checkpoint', type=str, default=None, metavar='PATH', help='Resume from and save training checkpoints (networks, optimiser, replay memory) to this file')
+parser.add_argument('--checkpoint-interval', type=int, default=250000, metavar='STEPS', help='Number of training steps between checkpoints (saved at the end of the episode)')
 parser.add_argument('--render', action='store_true', help='Display screen (testing only)')
 parser.add_argument('filename', help='File for environment')
 
 
 # Setup
 args = parser.parse_args()
+if args.action_repeat < 1:
+  parser.error('--action-repeat must be at least 1')
 print(' ' * 26 + 'Options')
 for k, v in vars(args).items():
   print(' ' * 26 + k + ': ' + str(v))
@@ -68,28 +81,58 @@ def log(s):
 
 
 # Environment
-env = Environment(filename=args.filename, mode=mode_rl, device=args.device)
+args.spec = ObservationSpec(args.observation_size, args.grayscale, torch.uint8 if args.uint8_observations else torch.float32)
+env = Environment(filename=args.filename, mode=mode_rl, device=args.device, spec=args.spec, action_repeat=args.action_repeat)
 env.train()
 action_space = env.action_space()
 
 
 # Agent
 dqn = Agent(args, env)
-mem = ReplayMemory(args, args.memory_capacity)
+mem = ReplayMemory(args, args.memory_capacity, storage_dir=args.memory_dir, compress=args.memory_compression)
 priority_weight_increase = (1 - args.priority_weight) / (args.T_max - args.learn_start)
 
 
-# Construct validation memory
+# Checkpoints
+checkpointer = Checkpointer(args.checkpoint) if args.checkpoint else None
+
+
+def save_checkpoint(T):
+  state = {'T': T, 'agent': dqn.state_dict(), 'results': results_state(), 'random': random.getstate(), 'torch_random': torch.get_rng_state(),
+           'cuda_random': torch.cuda.get_rng_state_all() if args.device.type == 'cuda' else None}
+  saved = checkpointer.save(state, {'memory': mem, 'val_memory': val_mem})
+  if saved:
+    log('T = ' + str(T) + ' / ' + str(args.T_max) + ' | Saving checkpoint to ' + args.checkpoint)
+  else:
+    log('T = ' + str(T) + ' / ' + str(args.T_max) + ' | Previous checkpoint still being written, retrying after the next episode')
+  return saved
+
+
+# Construct validation memory, or restore it with everything else from a checkpoint
 val_mem = ReplayMemory(args, args.evaluation_size)
-T, done = 0, True
-while T < args.evaluation_size:
-  if done:
-    state, done = env.reset(), False
+history = FrameHistory(args.history_length)
+T_start = 0
+if checkpointer is not None and checkpointer.exists():
+  state = checkpointer.load({'memory': mem, 'val_memory': val_mem})
+  dqn.load_state_dict(state['agent'])
+  load_results_state(state['results'])
+  random.setstate(state['random'])
+  torch.set_rng_state(state['torch_random'])
+  if state['cuda_random'] is not None and args.device.type == 'cuda':
+    torch.cuda.set_rng_state_all(state['cuda_random'])
+  T_start = state['T']
+  log('Resumed from ' + args.checkpoint + ' at T = ' + str(T_start))
+else:
+  T, done = 0, True
+  while T < args.evaluation_size:
+    if done:
+      state, done = history.reset(env.reset()), False
 
-  next_state, _, done = env.step(random.randint(0, action_space - 1))
-  val_mem.append(state, None, None, done)
-  state = next_state
-  T += 1
+    next_state, _, done = env.step(random.randint(0, action_space - 1))
+    next_state = history.append(next_state)
+    val_mem.append(state, None, None, done)
+    state = next_state
+    T += 1
 
 if args.evaluate:
   dqn.eval()  # Set DQN (online network) to evaluation mode
@@ -98,30 +141,39 @@ if args.evaluate:
 else:
   # Training loop
   dqn.train()
-  T, done = 0, True
+  T, done = T_start, True
+  sampler = None  # Memory, or prefetcher drawing from it, that the agent learns from
+  checkpoint_due = False  # Checkpoints are saved between episodes, so that a resumed run starts with a new one
   while T < args.T_max:
     if done:
-      state, done = env.reset(), False
+      state, done = history.reset(env.reset()), False
 
     if T % args.replay_frequency == 0:
       dqn.reset_noise()  # Draw a new set of noisy weights
 
     action = dqn.act(state)  # Choose an action greedily (with noisy weights)
     next_state, reward, done = env.step(action)  # Step
+    next_state = history.append(next_state)
     if args.reward_clip > 0:
       reward = max(min(reward, args.reward_clip), -args.reward_clip)  # Clip rewards
     mem.append(state, action, reward, done)  # Append transition to memory
     T += 1
 
     if T % args.log_interval == 0:
-      log('T = ' + str(T) + ' / ' + str(args.T_max))
+      status = ' | Replay memory: ' + str(round(mem.bytes_per_transition())) + ' bytes/transition'
+      if isinstance(sampler, BatchPrefetcher):
+        batches, waits, wait_time = sampler.wait_stats()
+        status += ' | Waited for ' + str(waits) + ' / ' + str(batches) + ' batches (' + str(round(wait_time, 2)) + ' s)'
+      log('T = ' + str(T) + ' / ' + str(args.T_max) + status)
 
     # Train and test
     if T >= args.learn_start:
       mem.priority_weight = min(mem.priority_weight + priority_weight_increase, 1)  # Anneal importance sampling weight β to 1
 
       if T % args.replay_frequency == 0:
-        dqn.learn(mem)  # Train with n-step distributional double-Q learning
+        if sampler is None:
+          sampler = BatchPrefetcher(mem, args.batch_size, args.prefetch_batches) if args.prefetch_batches > 0 else mem
+        dqn.learn(sampler)  # Train with n-step distributional double-Q learning
 
       if T % args.evaluation_interval == 0:
         dqn.eval()  # Set DQN (online network) to evaluation mode
@@ -133,6 +185,16 @@ else:
       if T % args.target_update == 0:
         dqn.update_target_net()
 
+    if checkpointer is not None:
+      checkpoint_due = checkpoint_due or T % args.checkpoint_interval == 0
+      if checkpoint_due and done:
+        checkpoint_due = not save_checkpoint(T)
+
     state = next_state
 
+  if isinstance(sampler, BatchPrefetcher):
+    sampler.close()
+  if checkpointer is not None:
+    checkpointer.wait()
+
 env.close()
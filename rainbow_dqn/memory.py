@@ -1,69 +1,120 @@
+import collections
+import os
+import queue
 import random
-from collections import namedtuple
+import sys
+import tempfile
+import threading
+import time
+import zlib
 import torch
 import numpy as np
 
 
-Transition = namedtuple('Transition', ('timestep', 'state', 'action', 'reward', 'nonterminal'))
-blank_trans = Transition(0, torch.zeros(84, 84, dtype=torch.uint8), None, 0, False)
+# Stacks the last history_length frames of single-channel (grayscale) observations for the network;
+# RGB observations are passed through as they are, their 3 channels standing in for the history
+class FrameHistory():
+  def __init__(self, history_length):
+    self.history = history_length
+    self.frames = []
 
+  def reset(self, observation):
+    if observation.size(0) != 1:
+      return observation
+    self.frames = [torch.zeros_like(observation[0])] * (self.history - 1)  # Blank frames before t = 0
+    return self.append(observation)
 
-# Segment tree data structure where parent node values are sum/max of children node values
+  def append(self, observation):
+    if observation.size(0) != 1:
+      return observation
+    self.frames = (self.frames + [observation[0]])[-self.history:]
+    return torch.stack(self.frames)
+
+
+# Segment tree data structure where parent node values are sum of children node values, stored in a NumPy array:
+# the root is at 0, the children of node i at 2i + 1 and 2i + 2, and the leaves, padded to a power of two so they all
+# sit on the last level, at capacity - 1 onwards. Batched finds and updates sweep the tree one level at a time.
+# The transitions themselves are stored by ReplayMemory, at the same (data) index as their priority.
 class SegmentTree():
   def __init__(self, size):
     self.index = 0
     self.size = size
     self.full = False  # Used to track actual capacity
-    self.sum_tree = [0] * (2 * size - 1)  # Initialise fixed size tree with all (priority) zeros
-    self.data = [None] * size  # Wrap-around cyclic buffer
+    self.capacity = 1 << (size - 1).bit_length()  # Number of leaves, padding leaves keep priority 0
+    self.depth = self.capacity.bit_length() - 1
+    self.sum_tree = np.zeros(2 * self.capacity - 1, dtype=np.float64)  # Initialise fixed size tree with all (priority) zeros
     self.max = 1  # Initial max value to return (1 = 1^ω)
 
-  # Propagates value up tree given a tree index
-  def _propagate(self, index, value):
-    parent = (index - 1) // 2
-    left, right = 2 * parent + 1, 2 * parent + 2
-    self.sum_tree[parent] = self.sum_tree[left] + self.sum_tree[right]
-    if parent != 0:
-      self._propagate(parent, value)
+  # Propagates value up tree given a single tree index
+  def _propagate_one(self, index):
+    tree = self.sum_tree
+    while index != 0:
+      index = (index - 1) >> 1
+      tree[index] = tree[2 * index + 1] + tree[2 * index + 2]
+
+  # Propagates values up tree given an array of tree indices, one level per sweep
+  def _propagate(self, indices):
+    for _ in range(self.depth):
+      indices = (indices - 1) >> 1
+      self.sum_tree[indices] = self.sum_tree[2 * indices + 1] + self.sum_tree[2 * indices + 2]
 
   # Updates value given a tree index
-  def update(self, index, value):
+  def update_one(self, index, value):
     self.sum_tree[index] = value  # Set new value
-    self._propagate(index, value)  # Propagate value
+    self._propagate_one(index)  # Propagate value
     self.max = max(value, self.max)
 
-  def append(self, data, value):
-    self.data[self.index] = data  # Store data in underlying data structure
-    self.update(self.index + self.size - 1, value)  # Update tree
+  # Updates values given arrays of tree indices and values
+  def update(self, indices, values):
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    self.sum_tree[indices] = values  # Set new values
+    self._propagate(indices)  # Propagate values
+    self.max = max(values.max(), self.max)
+
+  def append(self, value):
+    self.update_one(self.index + self.capacity - 1, value)  # Update tree
     self.index = (self.index + 1) % self.size  # Update index
     self.full = self.full or self.index == 0  # Save when capacity reached
     self.max = max(value, self.max)
 
-  # Searches for the location of a value in sum tree
-  def _retrieve(self, index, value):
-    left, right = 2 * index + 1, 2 * index + 2
-    if left >= len(self.sum_tree):
-      return index
-    elif value <= self.sum_tree[left]:
-      return self._retrieve(left, value)
-    else:
-      return self._retrieve(right, value - self.sum_tree[left])
+  # Searches for the locations of values in sum tree, descending from the root one level per sweep. Never descends
+  # into a subtree of priority 0, where rounding in the subtractions (at values up to total()) would otherwise lead
+  # to an empty or padding leaf
+  def _retrieve(self, values):
+    values = values.copy()
+    indices = np.zeros(len(values), dtype=np.int64)
+    for _ in range(self.depth):
+      left = 2 * indices + 1
+      left_values = self.sum_tree[left]
+      go_right = (values > left_values) & (self.sum_tree[left + 1] > 0)
+      values -= left_values * go_right
+      indices = left + go_right
+    return indices
 
-  # Searches for a value in sum tree and returns value, data index and tree index
-  def find(self, value):
-    index = self._retrieve(0, value)  # Search for index of item from root
-    data_index = index - self.size + 1
-    return (self.sum_tree[index], data_index, index)  # Return value, data index, tree index
-
-  # Returns data given a data index
-  def get(self, data_index):
-    return self.data[data_index % self.size]
+  # Searches for values (scalar or array) in sum tree and returns values, data indices and tree indices
+  def find(self, values):
+    scalar = np.ndim(values) == 0
+    indices = self._retrieve(np.asarray(values, dtype=np.float64).reshape(-1))  # Search for indices of items from root
+    data_indices = indices - self.capacity + 1
+    if scalar:
+      return (self.sum_tree[indices[0]], int(data_indices[0]), int(indices[0]))
+    return (self.sum_tree[indices], data_indices, indices)  # Return values, data indices, tree indices
 
   def total(self):
     return self.sum_tree[0]
 
+# Prioritised replay memory stored in preallocated wrap-around arrays: the last frame of each state (uint8) and the
+# timestep, action, reward and nonterminal flag of each transition. Frame storage is allocated on the first append,
+# once the frame size is known. With a storage_dir the frames live in a memory-mapped file there instead of RAM (the
+# tree and the other arrays stay in RAM), and the next batch is drawn as soon as priorities are updated so that its
+# frames can be read from disk in the background while the agent keeps acting. With compress each frame is stored
+# zlib-compressed instead (Needle Master frames are mostly flat colour) and only the frames of a sampled batch are
+# decompressed. append, sample and update_priorities hold lock, so that a BatchPrefetcher can sample meanwhile.
 class ReplayMemory():
-  def __init__(self, args, capacity):
+  def __init__(self, args, capacity, storage_dir=None, compress=False):
+    if compress and storage_dir is not None:
+      raise ValueError('compressed frames are kept in RAM, storage_dir cannot be used with compress')
     self.device = args.device
     self.capacity = capacity
     self.history = args.history_length
@@ -72,71 +123,207 @@ class ReplayMemory():
     self.priority_weight = args.priority_weight  # Initial importance sampling weight β, annealed to 1 over course of training
     self.priority_exponent = args.priority_exponent
     self.t = 0  # Internal episode timestep counter
-    self.transitions = SegmentTree(capacity)  # Store transitions in a wrap-around cyclic buffer within a sum tree for querying priorities
+    self.transitions = SegmentTree(capacity)  # Sum tree over the priorities, tracks the wrap-around index
+    self.frames = None  # uint8 (capacity, H, W), or (capacity, ) compressed frames
+    self.frame_shape = None
+    self.compress = compress
+    self.compressed_bytes = 0  # Total memory held by the compressed frames, with the overhead of each bytes object
+    self.storage_dir = storage_dir
+    self.storage = None  # Backing file of a memory-mapped frame store
+    self.frame_guard = None  # Set by a Checkpointer while a background save reads the memory-mapped frames
+    self.prefetched = None  # (batch size, data indices, tree indices) of the next batch
+    self.batch_size = args.batch_size  # Size of the batches drawn ahead with a storage_dir
+    self.timesteps = np.zeros(capacity, dtype=np.int64)
+    self.actions = np.zeros(capacity, dtype=np.int64)
+    self.rewards = np.zeros(capacity, dtype=np.float64)
+    self.nonterminals = np.zeros(capacity, dtype=bool)
+    self.n_step_discounts = self.discount ** np.arange(self.n)
+    # Offsets of the transitions used by a sample (from t - h + 1 to t + n) relative to t
+    self.offsets = np.arange(1 - self.history, self.n + 1)
+    self.lock = threading.RLock()
 
   # Adds state and action at time t, reward and terminal at time t + 1
   def append(self, state, action, reward, terminal):
-    state = state[-1].mul(255).to(dtype=torch.uint8, device=torch.device('cpu'))  # Only store last frame and discretise to save memory
-    self.transitions.append(Transition(self.t, state, action, reward, not terminal), self.transitions.max)  # Store new transition with maximum priority
-    self.t = 0 if terminal else self.t + 1  # Start new episodes with t = 0
-
-  # Returns a transition with blank states where appropriate
-  def _get_transition(self, idx):
-    transition = [None] * (self.history + self.n)
-    transition[self.history - 1] = self.transitions.get(idx)
-    for t in range(self.history - 2, -1, -1):  # e.g. 2 1 0
-      if transition[t + 1].timestep == 0:
-        transition[t] = blank_trans  # If future frame has timestep 0
-      else:
-        transition[t] = self.transitions.get(idx - self.history + 1 + t)
-    for t in range(self.history, self.history + self.n):  # e.g. 4 5 6
-      if transition[t - 1].nonterminal:
-        transition[t] = self.transitions.get(idx - self.history + 1 + t)
-      else:
-        transition[t] = blank_trans  # If prev (next) frame is terminal
-    return transition
-
-  # Returns a valid sample from a segment
-  def _get_sample_from_segment(self, segment, i):
-    valid = False
-    while not valid:
-      sample = random.uniform(i * segment, (i + 1) * segment)  # Uniformly sample an element from within a segment
-      prob, idx, tree_idx = self.transitions.find(sample)  # Retrieve sample from tree with un-normalised probability
-      # Resample if transition straddled current index or probablity 0
-      if (self.transitions.index - idx) % self.capacity > self.n and (idx - self.transitions.index) % self.capacity >= self.history and prob != 0:
-        valid = True  # Note that conditions are valid but extra conservative around buffer index 0
-
-    # Retrieve all required transition data (from t - h to t + n)
-    transition = self._get_transition(idx)
-    # Create un-discretised state and nth next state
-    state = torch.stack([trans.state for trans in transition[:self.history]]).to(dtype=torch.float32, device=self.device).div_(255)
-    next_state = torch.stack([trans.state for trans in transition[self.n:self.n + self.history]]).to(dtype=torch.float32, device=self.device).div_(255)
-    # Discrete action to be used as index
-    action = torch.tensor([transition[self.history - 1].action], dtype=torch.int64, device=self.device)
-    # Calculate truncated n-step discounted return R^n = Σ_k=0->n-1 (γ^k)R_t+k+1 (note that invalid nth next states have reward 0)
-    R = torch.tensor([sum(self.discount ** n * transition[self.history + n - 1].reward for n in range(self.n))], dtype=torch.float32, device=self.device)
-    # Mask for non-terminal nth next states
-    nonterminal = torch.tensor([transition[self.history + self.n - 1].nonterminal], dtype=torch.float32, device=self.device)
+    state = state[-1]  # Only store last frame and discretise to save memory
+    if state.dtype != torch.uint8:
+      state = state.mul(255)
+    state = state.to(dtype=torch.uint8, device=torch.device('cpu'))
+    frame = zlib.compress(state.numpy().tobytes(), 1) if self.compress else state.numpy()
+    with self.lock:
+      if self.frames is None:
+        self.frame_shape = tuple(state.shape)
+        self.frames = self._allocate_frames((self.capacity, ) + self.frame_shape)
+      index = self.transitions.index
+      if self.compress:
+        self.compressed_bytes += sys.getsizeof(frame) - (0 if self.frames[index] is None else sys.getsizeof(self.frames[index]))
+      if self.frame_guard is not None:
+        self.frame_guard.before_overwrite(index)
+      self.frames[index] = frame
+      self.timesteps[index] = self.t
+      self.actions[index] = -1 if action is None else action
+      self.rewards[index] = 0 if reward is None else reward
+      self.nonterminals[index] = not terminal
+      self.transitions.append(self.transitions.max)  # Store new transition with maximum priority
+      self.t = 0 if terminal else self.t + 1  # Start new episodes with t = 0
+
+  def _allocate_frames(self, shape):
+    if self.compress:
+      return np.full(self.capacity, None, dtype=object)
+    if self.storage_dir is None:
+      return np.zeros(shape, dtype=np.uint8)
+    # Anonymous file, removed by the OS once the memory is gone
+    self.storage = tempfile.TemporaryFile(dir=self.storage_dir, prefix='replay-', suffix='.frames')
+    return np.memmap(self.storage, dtype=np.uint8, mode='w+', shape=shape)
+
+  # Returns a new uint8 array with the frames at an array of data indices, decompressing each distinct frame once
+  def _get_frames(self, indices):
+    if not self.compress:
+      return self.frames[indices]
+    unique, inverse = np.unique(indices, return_inverse=True)
+    decoded = np.zeros((len(unique), ) + self.frame_shape, dtype=np.uint8)
+    for i, index in enumerate(unique):
+      if self.frames[index] is not None:  # Slots not written yet are only gathered as blank frames
+        decoded[i] = np.frombuffer(zlib.decompress(self.frames[index]), dtype=np.uint8).reshape(self.frame_shape)
+    return decoded[inverse.reshape(indices.shape)]
+
+  # Average memory used per stored transition: its frame (compressed frames as the whole bytes object), metadata and priority
+  def bytes_per_transition(self):
+    stored = self.capacity if self.transitions.full else self.transitions.index
+    if stored == 0:
+      return 0.
+    if self.compress:
+      frame_bytes = self.compressed_bytes / stored + self.frames.itemsize  # Plus the reference to the frame
+    else:
+      frame_bytes = int(np.prod(self.frame_shape))
+    metadata = self.timesteps.itemsize + self.actions.itemsize + self.rewards.itemsize + self.nonterminals.itemsize
+    return frame_bytes + metadata + self.transitions.sum_tree.itemsize
+
+  # Counters and settings that, with the arrays of checkpoint_arrays, make up the contents of the memory
+  def checkpoint_state(self):
+    return {'capacity': self.capacity, 'compress': self.compress, 'frame_shape': self.frame_shape, 't': self.t,
+            'index': self.transitions.index, 'full': self.transitions.full, 'max': self.transitions.max,
+            'priority_weight': self.priority_weight, 'compressed_bytes': self.compressed_bytes}
+
+  # The arrays holding the transitions and their priorities; checkpoints are written from and read into them in place
+  def checkpoint_arrays(self):
+    arrays = {'timesteps': self.timesteps, 'actions': self.actions, 'rewards': self.rewards,
+              'nonterminals': self.nonterminals, 'priorities': self.transitions.sum_tree}
+    if self.frames is not None:
+      arrays['frames'] = self.frames
+    return arrays
+
+  # Restores the counters of a checkpoint and allocates the frame storage its arrays are then read into
+  def load_checkpoint_state(self, state):
+    if state['capacity'] != self.capacity:
+      raise ValueError('checkpoint memory holds %d transitions, not %d' % (state['capacity'], self.capacity))
+    if state['compress'] != self.compress:
+      raise ValueError('checkpoint memory was saved %s frame compression' % ('with' if state['compress'] else 'without'))
+    self.t = state['t']
+    self.transitions.index, self.transitions.full, self.transitions.max = state['index'], state['full'], state['max']
+    self.priority_weight = state['priority_weight']
+    self.compressed_bytes = state['compressed_bytes']
+    self.prefetched = None
+    if state['frame_shape'] is not None and self.frames is None:
+      self.frame_shape = tuple(state['frame_shape'])
+      self.frames = self._allocate_frames((self.capacity, ) + self.frame_shape)
+    elif state['frame_shape'] is not None and tuple(state['frame_shape']) != self.frame_shape:
+      raise ValueError('checkpoint frames are %s, not %s' % (tuple(state['frame_shape']), self.frame_shape))
+
+  # Returns the data indices of the transitions around each sampled index, and which of them are blank: a past
+  # frame is blank if it or a later one up to t has timestep 0, a future one if a frame from t on is terminal
+  def _get_transitions(self, idxs):
+    indices = (idxs[:, None] + self.offsets) % self.capacity  # (B, h + n)
+    h = self.history
+    first = self.timesteps[indices[:, 1:h]] == 0  # Transitions t - h + 2 ... t that start an episode
+    past_blank = np.flip(np.logical_or.accumulate(np.flip(first, 1), 1), 1)
+    terminal = ~self.nonterminals[indices[:, h - 1:-1]]  # Transitions t ... t + n - 1 that end an episode
+    future_blank = np.logical_or.accumulate(terminal, 1)
+    blank = np.concatenate([past_blank, np.zeros((len(idxs), 1), dtype=bool), future_blank], 1)
+    return indices, blank
+
+  # Transitions that can be sampled: not straddling the current index and with non-zero probability
+  def _valid(self, idxs, probs):
+    # Note that conditions are valid but extra conservative around buffer index 0
+    return ((self.transitions.index - idxs) % self.capacity > self.n) & ((idxs - self.transitions.index) % self.capacity >= self.history) & (probs != 0)
 
-    return prob, idx, tree_idx, state, action, R, next_state, nonterminal
+  # (Re)samples the given rows of a batch from their segments until they are all valid
+  def _sample_segments(self, segment, probs, idxs, tree_idxs, invalid):
+    while len(invalid) > 0:
+      samples = np.array([random.uniform(i * segment, (i + 1) * segment) for i in invalid])  # Uniformly sample an element from within each segment
+      probs[invalid], idxs[invalid], tree_idxs[invalid] = self.transitions.find(samples)  # Retrieve samples from tree with un-normalised probability
+      invalid = invalid[~self._valid(idxs[invalid], probs[invalid])]  # Resample if transition straddled current index or probablity 0
+    return probs, idxs, tree_idxs
+
+  # Returns valid samples, one from each of batch_size segments
+  def _sample_batch(self, batch_size):
+    segment = self.transitions.total() / batch_size  # Batch size number of segments, based on sum over all probabilities
+    probs, idxs, tree_idxs = np.zeros(batch_size), np.zeros(batch_size, dtype=np.int64), np.zeros(batch_size, dtype=np.int64)
+    return self._sample_segments(segment, probs, idxs, tree_idxs, np.arange(batch_size))
+
+  # Draws the next batch now and asks the OS to start reading its frames from disk
+  def _prefetch(self, batch_size):
+    _, idxs, tree_idxs = self._sample_batch(batch_size)
+    self.prefetched = (batch_size, idxs, tree_idxs)
+    if not hasattr(os, 'posix_fadvise'):
+      return
+    indices = np.unique(self._get_transitions(idxs)[0])
+    runs = np.split(indices, np.nonzero(np.diff(indices) != 1)[0] + 1)  # Contiguous ranges of frames
+    frame_bytes = self.frames[0].nbytes
+    for run in runs:
+      os.posix_fadvise(self.storage.fileno(), int(run[0]) * frame_bytes, len(run) * frame_bytes, os.POSIX_FADV_WILLNEED)
 
   def sample(self, batch_size):
-    p_total = self.transitions.total()  # Retrieve sum of all priorities (used to create a normalised probability distribution)
-    segment = p_total / batch_size  # Batch size number of segments, based on sum over all probabilities
-    batch = [self._get_sample_from_segment(segment, i) for i in range(batch_size)]  # Get batch of valid samples
-    probs, idxs, tree_idxs, states, actions, returns, next_states, nonterminals = zip(*batch)
-    states, next_states, = torch.stack(states), torch.stack(next_states)
-    actions, returns, nonterminals = torch.cat(actions), torch.cat(returns), torch.stack(nonterminals)
-    probs = np.array(probs, dtype = np.float32)/p_total # Calculate normalised probabilities
-    capacity = self.capacity if self.transitions.full else self.transitions.index
+    with self.lock:  # Only the reads of the memory's arrays need the lock, tensors are built after
+      p_total = self.transitions.total()  # Retrieve sum of all priorities (used to create a normalised probability distribution)
+      if self.prefetched is not None and self.prefetched[0] == batch_size:
+        # Batch drawn after the last priority update; resample rows made invalid by transitions appended since
+        _, idxs, tree_idxs = self.prefetched
+        probs = self.transitions.sum_tree[tree_idxs]
+        invalid = np.nonzero(~self._valid(idxs, probs))[0]
+        probs, idxs, tree_idxs = self._sample_segments(p_total / batch_size, probs, idxs, tree_idxs, invalid)
+      else:
+        probs, idxs, tree_idxs = self._sample_batch(batch_size)  # Get batch of valid samples
+      self.prefetched = None
+      # Retrieve all required transition data (from t - h to t + n) with one gather
+      indices, blank = self._get_transitions(idxs)
+      frames = self._get_frames(indices)
+      actions = self.actions[idxs]
+      rewards = np.where(blank, 0, self.rewards[indices])[:, self.history - 1:-1]
+      nonterminals = self.nonterminals[indices[:, -1]] & ~blank[:, -1]
+      capacity = self.capacity if self.transitions.full else self.transitions.index
+    frames[blank] = 0
+    frames = torch.from_numpy(frames).to(device=self.device).to(dtype=torch.float32).div_(255)
+    # Create un-discretised states and nth next states
+    states, next_states = frames[:, :self.history], frames[:, self.n:self.n + self.history]
+    # Discrete actions to be used as index
+    actions = torch.from_numpy(actions).to(device=self.device)
+    # Calculate truncated n-step discounted returns R^n = Σ_k=0->n-1 (γ^k)R_t+k+1 (note that invalid nth next states have reward 0)
+    returns = torch.tensor(rewards.dot(self.n_step_discounts), dtype=torch.float32, device=self.device)
+    # Mask for non-terminal nth next states
+    nonterminals = torch.tensor(nonterminals, dtype=torch.float32, device=self.device).unsqueeze(1)
+    probs = probs.astype(np.float32) / p_total  # Calculate normalised probabilities
     weights = (capacity * probs) ** -self.priority_weight  # Compute importance-sampling weights w
     weights = torch.tensor(weights / weights.max(), dtype=torch.float32, device=self.device)   # Normalise by max importance-sampling weight from batch
     return tree_idxs, states, actions, returns, next_states, nonterminals, weights
 
-
   def update_priorities(self, idxs, priorities):
-    priorities = np.power(priorities, self.priority_exponent)
-    [self.transitions.update(idx, priority) for idx, priority in zip(idxs, priorities)]
+    with self.lock:
+      priorities = np.power(priorities, self.priority_exponent)
+      self.transitions.update(idxs, priorities)  # One batched update
+      if self.storage is not None:
+        self._prefetch(self.batch_size)  # Not len(idxs): a BatchPrefetcher drops the updates of overwritten rows
+
+  # Returns stacks of the last history frames ending at each of idxs, blank before the start of the episode
+  def _get_states(self, idxs):
+    back = np.arange(self.history - 1, -1, -1)  # e.g. 2 1 0
+    frames = self._get_frames((idxs[:, None] - back) % self.capacity)
+    frames[back > self.timesteps[idxs][:, None]] = 0  # Frames from before timestep 0
+    return torch.from_numpy(frames).to(device=self.device).to(dtype=torch.float32).div_(255)
+
+  # Returns the valid states for validation in batches of up to batch_size
+  def state_batches(self, batch_size):
+    for start in range(0, self.capacity, batch_size):
+      yield self._get_states(np.arange(start, min(start + batch_size, self.capacity)))
 
   # Set up internal state for iterator
   def __iter__(self):
@@ -147,16 +334,74 @@ class ReplayMemory():
   def __next__(self):
     if self.current_idx == self.capacity:
       raise StopIteration
-    # Create stack of states
-    state_stack = [None] * self.history
-    state_stack[-1] = self.transitions.data[self.current_idx].state
-    prev_timestep = self.transitions.data[self.current_idx].timestep
-    for t in reversed(range(self.history - 1)):
-      if prev_timestep == 0:
-        state_stack[t] = blank_trans.state  # If future frame has timestep 0
-      else:
-        state_stack[t] = self.transitions.data[self.current_idx + t - self.history + 1].state
-        prev_timestep -= 1
-    state = torch.stack(state_stack, 0).to(dtype=torch.float32, device=self.device).div_(255)  # Agent will turn into batch
+    state = self._get_states(np.array([self.current_idx]))[0]  # Agent will turn into batch
     self.current_idx += 1
     return state
+
+
+# Samples batches from a ReplayMemory on a background thread, up to depth batches ahead of the learner, so that the tree
+# walks and frame gathers of the next batches overlap with the forward and backward passes (which release the GIL).
+# Stands in for the memory in Agent.learn: sample hands out the prefetched batches in order and update_priorities
+# applies their priorities in the same order, skipping transitions that were overwritten since their batch was drawn.
+# Prefetched batches are drawn with the priorities known at the time, at most depth updates old.
+class BatchPrefetcher():
+  def __init__(self, mem, batch_size, depth=2):
+    self.mem = mem
+    self.batch_size = batch_size
+    self.queue = queue.Queue(maxsize=depth)
+    self.pending = collections.deque()  # Memory index when each batch handed out but not yet updated was drawn
+    self.batches, self.waits, self.wait_time = 0, 0, 0.  # Batches handed out, how many the learner waited for and for how long
+    self.closed = False
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while not self.closed:
+      try:
+        index = self.mem.transitions.index  # Read before sampling, so any slot written since is treated as overwritten
+        item = (index, self.mem.sample(self.batch_size), None)
+      except Exception as error:
+        item = (None, None, error)
+      self.queue.put(item)
+      if item[2] is not None:
+        return
+
+  def sample(self, batch_size):
+    if batch_size != self.batch_size:
+      raise ValueError('prefetcher draws batches of %d, not %d' % (self.batch_size, batch_size))
+    try:
+      index, batch, error = self.queue.get_nowait()
+    except queue.Empty:
+      start = time.perf_counter()
+      index, batch, error = self.queue.get()
+      self.waits += 1
+      self.wait_time += time.perf_counter() - start
+    if error is not None:
+      raise error
+    self.batches += 1
+    self.pending.append(index)
+    return batch
+
+  def update_priorities(self, idxs, priorities):
+    index, mem = self.pending.popleft(), self.mem
+    with mem.lock:
+      written = (mem.transitions.index - index) % mem.capacity  # Transitions appended since the batch was drawn
+      keep = (idxs - mem.transitions.capacity + 1 - index) % mem.capacity >= written
+      if keep.any():
+        mem.update_priorities(idxs[keep], priorities[keep])
+
+  # Returns and resets the number of batches handed out, how many of them the learner had to wait for and the time spent waiting
+  def wait_stats(self):
+    stats = self.batches, self.waits, self.wait_time
+    self.batches, self.waits, self.wait_time = 0, 0, 0.
+    return stats
+
+  # Stops the background thread, dropping the batches it has drawn
+  def close(self):
+    self.closed = True
+    while self.thread.is_alive():
+      try:
+        self.queue.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    self.thread.join()
@@ -3,6 +3,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from needlemaster.environment import ObservationSpec
+
 
 # Factorised NoisyLinear layer with bias
 class NoisyLinear(nn.Module):
@@ -45,28 +47,37 @@ class NoisyLinear(nn.Module):
 
 
 class DQN(nn.Module):
-  def __init__(self, args, action_space):
+  def __init__(self, args, action_space, spec=ObservationSpec()):
     super().__init__()
     self.atoms = args.atoms
     self.action_space = action_space
-    self.dim = 224
-    self.initial_size = int(16 * self.dim * self.dim / 4)
-    self.reduced_size = int(self.initial_size / (2 * 2 * 2))
+    self.dim = spec.size
+    if not spec.grayscale and spec.channels != args.history_length:
+      # FrameHistory passes RGB frames through, their channels standing in for the history_length frames that replay
+      # memory stacks, so both only agree on the input channels when there are as many
+      raise ValueError('RGB observations have %d channels, a history length of %d needs grayscale observations' % (spec.channels, args.history_length))
 
     self.conv1 = nn.Conv2d(args.history_length, 16, 5, stride=2, padding=2)
     self.conv2 = nn.Conv2d(16, 32, 5, stride=2, padding=2)
     self.conv3 = nn.Conv2d(32, 64, 5, stride=2, padding=2)
     self.conv4 = nn.Conv2d(64, 128, 3, stride=2, padding=1)
+    with torch.no_grad():  # Size of the flattened conv features for dim x dim inputs
+      self.reduced_size = self._features(torch.zeros(1, args.history_length, self.dim, self.dim)).numel()
     self.fc_h_v = NoisyLinear(self.reduced_size, args.hidden_size, std_init=args.noisy_std)
     self.fc_h_a = NoisyLinear(self.reduced_size, args.hidden_size, std_init=args.noisy_std)
     self.fc_z_v = NoisyLinear(args.hidden_size, self.atoms, std_init=args.noisy_std)
     self.fc_z_a = NoisyLinear(args.hidden_size, action_space * self.atoms, std_init=args.noisy_std)
 
-  def forward(self, x, log=False):
+  def _features(self, x):
     x = F.relu(self.conv1(x))
     x = F.relu(self.conv2(x))
     x = F.relu(self.conv3(x))
-    x = F.relu(self.conv4(x))
+    return F.relu(self.conv4(x))
+
+  def forward(self, x, log=False):
+    if x.dtype == torch.uint8:  # uint8 observations are scaled on the device
+      x = x.float().div_(255)
+    x = self._features(x)
     x = x.view(-1, self.reduced_size)
     v = self.fc_z_v(F.relu(self.fc_h_v(x)))  # Value stream
     a = self.fc_z_a(F.relu(self.fc_h_a(x)))  # Advantage stream
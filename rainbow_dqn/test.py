@@ -1,46 +1,83 @@
+import multiprocessing as mp
 import os
+import random
+import numpy as np
 import plotly
 from plotly.graph_objs import Scatter
 from plotly.graph_objs.scatter import Line
 import torch
 
 #from .env import Env
-from needlemaster.environment import Environment
+from .memory import FrameHistory
+from needlemaster.environment import Environment, mode_rl
 
 
 # Globals
 Ts, rewards, Qs, best_avg_reward = [], [], [], -1e10
+q_batch_size = 256  # Validation states per forward pass
+_frozen = None  # (args, frozen agent) in evaluation worker processes
 
 
-# Test DQN
-def test(args, T, dqn, val_mem, evaluate=False):
-  global Ts, rewards, Qs, best_avg_reward
-  env = Environment(args)
-  env.eval()
-  Ts.append(T)
-  T_rewards, T_Qs = [], []
+def _init_worker(args, agent):
+  global _frozen
+  torch.set_num_threads(1)
+  _frozen = args, agent
 
-  # Test performance over several episodes
-  done = True
-  for _ in range(args.evaluation_episodes):
-    while True:
-      if done:
-        state, reward_sum, done = env.reset(), 0, False
 
-      action = dqn.act_e_greedy(state)  # Choose an action ε-greedily
+# Plays episodes of the evaluation environment with agent and returns their rewards
+def _run_episodes(args, agent, episodes, seed):
+  random.seed(seed)
+  torch.manual_seed(seed)
+  env = Environment(filename=args.filename, mode=mode_rl, spec=args.spec, action_repeat=args.action_repeat)
+  env.eval()
+  history = FrameHistory(args.history_length)
+  T_rewards = []
+  for _ in range(episodes):
+    state, reward_sum, done = history.reset(env.reset()), 0, False
+    while not done:
+      action = agent.act_e_greedy(state)  # Choose an action ε-greedily
       state, reward, done = env.step(action)  # Step
+      state = history.append(state)
       reward_sum += reward
       if args.render:
         env.render()
-
-      if done:
-        T_rewards.append(reward_sum)
-        break
+    T_rewards.append(reward_sum)
   env.close()
+  return T_rewards
+
+
+def _worker_episodes(job):
+  return _run_episodes(*_frozen, *job)
 
-  # Test Q-values over validation memory
-  for state in val_mem:  # Iterate over valid states
-    T_Qs.append(dqn.evaluate_q(state))
+
+# Runs _run_episodes in the trainer's process, restoring the Python, torch and CUDA random states it reseeds
+def _episodes_in_process(args, agent, episodes, seed):
+  state = random.getstate()
+  with torch.random.fork_rng():
+    try:
+      return _run_episodes(args, agent, episodes, seed)
+    finally:
+      random.setstate(state)
+
+
+# Test DQN
+def test(args, T, dqn, val_mem, evaluate=False):
+  global Ts, rewards, Qs, best_avg_reward
+  Ts.append(T)
+
+  # Test performance over several episodes, spread over worker processes that each get a frozen copy of the network
+  workers = 1 if args.render else min(args.evaluation_episodes, args.evaluation_workers or mp.cpu_count())
+  jobs = [(len(episodes), random.randint(0, 2 ** 31 - 1)) for episodes in np.array_split(np.arange(args.evaluation_episodes), workers)]
+  if len(jobs) == 1:
+    T_rewards = _episodes_in_process(args, dqn.frozen_copy(), *jobs[0])
+  else:
+    # Forked workers inherit the network instead of unpickling it (and do not re-run the main module)
+    context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else None)
+    with context.Pool(len(jobs), initializer=_init_worker, initargs=(args, dqn.frozen_copy())) as pool:
+      T_rewards = [reward for job_rewards in pool.map(_worker_episodes, jobs, chunksize=1) for reward in job_rewards]
+
+  # Test Q-values over validation memory, in batches
+  T_Qs = torch.cat([dqn.evaluate_q_batch(states) for states in val_mem.state_batches(q_batch_size)]).tolist()
 
   avg_reward, avg_Q = sum(T_rewards) / len(T_rewards), sum(T_Qs) / len(T_Qs)
   if not evaluate:
@@ -61,6 +98,16 @@ def test(args, T, dqn, val_mem, evaluate=False):
   return avg_reward, avg_Q
 
 
+# Evaluation history (plotted) and best average reward so far, kept in checkpoints
+def results_state():
+  return {'Ts': Ts, 'rewards': rewards, 'Qs': Qs, 'best_avg_reward': best_avg_reward}
+
+
+def load_results_state(state):
+  global Ts, rewards, Qs, best_avg_reward
+  Ts, rewards, Qs, best_avg_reward = state['Ts'], state['rewards'], state['Qs'], state['best_avg_reward']
+
+
 # Plots min, max and mean + standard deviation bars of a population over time
 def _plot_line(xs, ys_population, title, path=''):
   max_colour, mean_colour, std_colour, transparent = 'rgb(0, 132, 180)', 'rgb(0, 172, 237)', 'rgba(29, 202, 255, 0.2)', 'rgba(0, 0, 0, 0)'
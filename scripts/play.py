@@ -30,6 +30,7 @@ def playback(env_path, demo_path):
     print("________________________")
     print(" Level " + str(demo.env))
     environment.score(True)
+    environment.close()
     print("________________________")
     """ ..................................... """
 
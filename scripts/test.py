@@ -15,8 +15,6 @@ parser = argparse.ArgumentParser()
 parser.add_argument('directory', help='directory to read from')
 args = parser.parse_args()
 
-files = os.listdir(args.directory)
-
 start_idx = 1
 end_idx = 11
 envs = [0]*(end_idx-start_idx)
@@ -31,15 +29,10 @@ for i in range(start_idx,end_idx):
     plt.subplot(2,ncols,i)
     env.draw()
 
-for file in files:
-    if file[:5] == 'trial':
-        # process as a trial
-        (env,t) = nm.ParseDemoName(file)
-
-        # draw
-        if env < end_idx and env >= start_idx:
-            demo = nm.Demo(env_height=envs[env-1].height,env_width=envs[env-1].width,filename=os.path.join(args.directory, file))
-            plt.subplot(2,ncols,env)
-            demo.draw()
+corpus = nm.DemoCorpus(args.directory)
+for env in range(start_idx,end_idx):
+    for demo in corpus.iter_demos(level=env, env_width=envs[env-1].width, env_height=envs[env-1].height):
+        plt.subplot(2,ncols,env)
+        demo.draw()
 plt.savefig('test_output.png')
 plt.show()
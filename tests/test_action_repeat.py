@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Environment(action_repeat=k) against k single steps of the same action.
+"""
+import glob
+import os
+import numpy as np
+import pytest
+import torch
+
+from needlemaster.environment import Environment, ObservationSpec, backend_numpy
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+levels = sorted(glob.glob(os.path.join(data_dir, 'environment_*.txt')))
+
+spec = ObservationSpec(84, False, torch.uint8)
+actions = 40
+
+
+def environment(filename, action_repeat=1):
+    return Environment(filename, backend=backend_numpy, spec=spec, action_repeat=action_repeat)
+
+
+@pytest.mark.parametrize('k', [2, 5])
+@pytest.mark.parametrize('filename', levels[::4], ids=os.path.basename)
+def test_repeat_matches_single_steps(filename, k):
+    ''' demo-mode (dx, dw) moves, so that gates, tissue and the end of the
+        game are reached within a few repeated actions '''
+    rng = np.random.default_rng(k)
+    repeated, single = environment(filename, k), environment(filename)
+    for dx, dw in zip(rng.uniform(-15, -3, actions), rng.uniform(-0.05, 0.05, actions)):
+        observation, reward, done = repeated.step((dx, dw))
+        for _ in range(k):
+            expected_observation, expected_reward, expected_done = single.step((dx, dw))
+            if expected_done:
+                break
+        assert torch.equal(observation, expected_observation)
+        assert reward == expected_reward  # The score of the final state, not a sum over the k steps
+        assert done == expected_done
+        assert repeated.t == single.t
+        if done:
+            break
+
+
+@pytest.mark.parametrize('k', [0, -1])
+def test_action_repeat_below_one(k):
+    with pytest.raises(ValueError):
+        environment(levels[0], k)
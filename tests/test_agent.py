@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Agent.act_batch and act_e_greedy_batch against the one-state act, and
+per-environment epsilons.
+"""
+import types
+import numpy as np
+import pytest
+import torch
+
+from needlemaster.environment import ObservationSpec
+from rainbow_dqn.agent import Agent
+
+spec = ObservationSpec(84, True, torch.float32)
+args = types.SimpleNamespace(device=torch.device('cpu'), atoms=51, V_min=-10, V_max=10, batch_size=8, multi_step=3,
+                             discount=0.99, history_length=4, hidden_size=64, noisy_std=0.1, model=None,
+                             lr=1e-4, adam_eps=1.5e-4)
+action_space = 16
+batch = 64
+
+
+class FakeEnvironment():
+    ''' the parts of Environment the Agent reads '''
+    spec = spec
+
+    def action_space(self):
+        return action_space
+
+
+@pytest.fixture(params=['train', 'eval'])
+def agent(request):
+    torch.manual_seed(0)
+    agent = Agent(args, FakeEnvironment())
+    with torch.no_grad():  # Freshly initialised, the network picks the same action for every state
+        for param in agent.online_net.parameters():
+            param.mul_(3)
+    if request.param == 'eval':
+        agent.online_net.eval()
+    return agent
+
+
+def states(count, seed=1):
+    return torch.rand((count, args.history_length, spec.size, spec.size), generator=torch.Generator().manual_seed(seed))
+
+
+def test_act_batch_matches_act(agent):
+    observations = states(batch)
+    actions = agent.act_batch(observations)
+    assert actions.shape == (batch, ) and actions.dtype == torch.int64
+    assert actions.tolist() == [agent.act(state) for state in observations]
+    assert len(set(actions.tolist())) > 1  # Not a network that picks one action whatever it sees
+
+
+def test_zero_epsilon_is_greedy(agent):
+    observations = states(batch)
+    assert torch.equal(agent.act_e_greedy_batch(observations, 0.), agent.act_batch(observations))
+    assert torch.equal(agent.act_e_greedy_batch(observations, torch.zeros(batch)), agent.act_batch(observations))
+
+
+def test_per_row_epsilon(agent, monkeypatch):
+    observations = states(batch)
+    greedy_actions = agent.act_batch(observations)
+    epsilon = torch.tensor([0., 1.]).repeat(batch // 2)
+    act_batch = agent.act_batch
+    through_network = []
+
+    def recording_act_batch(states):
+        through_network.append(states)
+        return act_batch(states)
+    monkeypatch.setattr(agent, 'act_batch', recording_act_batch)
+
+    torch.manual_seed(2)
+    random_actions = []
+    for _ in range(200):
+        actions = agent.act_e_greedy_batch(observations, epsilon)
+        assert torch.equal(actions[::2], greedy_actions[::2])
+        random_actions.append(actions[1::2])
+        assert torch.equal(through_network.pop(), observations[::2])  # Only the greedy rows are evaluated
+    frequencies = np.bincount(torch.cat(random_actions).numpy(), minlength=action_space) / (200 * batch // 2)
+    np.testing.assert_allclose(frequencies, 1 / action_space, atol=0.01)
+
+    assert agent.act_e_greedy_batch(observations, 1.).shape == (batch, )
+    assert through_network == []  # All random: no forward pass at all
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+BatchedEnvironment against N independent mode_rl Environments.
+"""
+import glob
+import os
+import numpy as np
+import pytest
+import torch
+
+from needlemaster.batched import BatchedEnvironment
+from needlemaster.environment import Environment, mode_rl, obs_state
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+levels = sorted(glob.glob(os.path.join(data_dir, 'environment_*.txt')))
+
+n = 8
+steps = 400
+''' mostly forward moves, so needles cross tissue and gates and episodes end '''
+action_probabilities = np.r_[np.full(8, 0.02), np.full(8, 0.105)]
+
+
+@pytest.mark.parametrize('filename', levels, ids=os.path.basename)
+def test_batched_matches_environments(filename):
+    batched = BatchedEnvironment(filename, n)
+    envs = [Environment(filename, mode=mode_rl, observation=obs_state) for _ in range(n)]
+    observations = batched.reset()
+    for i, env in enumerate(envs):
+        assert torch.equal(observations[i], env.reset())
+
+    rng = np.random.RandomState(0)
+    resets = 0
+    for t in range(steps):
+        actions = rng.choice(len(action_probabilities), n, p=action_probabilities)
+        observations, rewards, dones, info = batched.step(actions)
+        for i, env in enumerate(envs):
+            observation, reward, done = env.step(int(actions[i]))
+            assert done == dones[i], 'step %d, copy %d' % (t, i)
+            assert reward == pytest.approx(rewards[i], abs=1e-6), 'step %d, copy %d' % (t, i)
+            if done:
+                # the batched copy was reset automatically
+                resets += 1
+                observation = env.reset()
+            assert torch.equal(observation, observations[i]), 'step %d, copy %d' % (t, i)
+    assert resets > 0
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpointer round trips of every replay frame store, with the learner
+appending while the forked child writes, and rejection of damaged files.
+"""
+import os
+import time
+import types
+import numpy as np
+import pytest
+import torch
+
+from rainbow_dqn import checkpoint
+from rainbow_dqn.checkpoint import Checkpointer
+from rainbow_dqn.memory import ReplayMemory
+
+args = types.SimpleNamespace(device=torch.device('cpu'), history_length=3, discount=0.99, multi_step=3,
+                             priority_weight=0.4, priority_exponent=0.5, batch_size=8)
+capacity = 200
+frame_shape = (24, 24)
+
+
+def fill(mem, steps, rng):
+    for _ in range(steps):
+        state = torch.from_numpy(rng.integers(0, 256, (args.history_length, ) + frame_shape, dtype=np.uint8))
+        mem.append(state, int(rng.integers(16)), float(rng.normal()), bool(rng.random() < 0.05))
+
+
+def contents(mem):
+    return mem.checkpoint_state(), {key: np.array(array) for key, array in mem.checkpoint_arrays().items()}
+
+
+def assert_same(mem, expected):
+    state, arrays = contents(mem)
+    assert state == expected[0]
+    assert arrays.keys() == expected[1].keys()
+    for key, array in arrays.items():
+        if array.dtype == object:
+            assert list(array) == list(expected[1][key]), key
+        else:
+            assert np.array_equal(array, expected[1][key]), key
+
+
+def memory(store, tmp_path):
+    return ReplayMemory(args, capacity, storage_dir=str(tmp_path) if store == 'storage_dir' else None,
+                        compress=store == 'compress')
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    ''' several chunks per array, fewer stash rows than the appends made during a save and a child slow enough
+        that they overtake it '''
+    monkeypatch.setattr(checkpoint, 'chunk_bytes', 2048)
+    monkeypatch.setattr(checkpoint, 'stash_rows', 16)
+    read = checkpoint._FrameGuard.read
+
+    def slow_read(self, start, end):
+        time.sleep(0.005)
+        return read(self, start, end)
+    monkeypatch.setattr(checkpoint._FrameGuard, 'read', slow_read)
+
+
+@pytest.mark.parametrize('store', ['ram', 'storage_dir', 'compress'])
+def test_round_trip_while_appending(store, tmp_path, small_chunks):
+    rng = np.random.default_rng(0)
+    mem = memory(store, tmp_path)
+    fill(mem, capacity + 37, rng)  # Wrapped, so the oldest frame is not at slot 0
+    expected = contents(mem)
+    checkpointer = Checkpointer(str(tmp_path / 'checkpoint'))
+    assert checkpointer.save({'T': 1}, {'memory': mem})
+    if store == 'storage_dir':
+        assert mem.frame_guard is not None
+    fill(mem, 3 * checkpoint.stash_rows, rng)  # Past the stash of a memory-mapped store, so appending waits for the child
+    checkpointer.wait()
+    assert mem.frame_guard is None
+    assert not os.path.exists(checkpointer.path + '.tmp')
+
+    restored = memory(store, tmp_path)
+    assert checkpointer.load({'memory': restored}) == {'T': 1}
+    assert_same(restored, expected)
+
+
+def test_save_replaces_previous_checkpoint(tmp_path):
+    rng = np.random.default_rng(1)
+    mem = memory('ram', tmp_path)
+    checkpointer = Checkpointer(str(tmp_path / 'checkpoint'))
+    fill(mem, 50, rng)
+    checkpointer.save({'T': 1}, {'memory': mem})
+    checkpointer.wait()
+    fill(mem, 50, rng)
+    expected = contents(mem)
+    checkpointer.save({'T': 2}, {'memory': mem})
+    checkpointer.wait()
+    restored = memory('ram', tmp_path)
+    assert checkpointer.load({'memory': restored}) == {'T': 2}
+    assert_same(restored, expected)
+
+
+@pytest.fixture
+def saved(tmp_path, small_chunks):
+    mem = memory('storage_dir', tmp_path)
+    fill(mem, 120, np.random.default_rng(2))
+    checkpointer = Checkpointer(str(tmp_path / 'checkpoint'))
+    checkpointer.save({'T': 1}, {'memory': mem})
+    checkpointer.wait()
+    return checkpointer, tmp_path
+
+
+def test_truncated_file_is_rejected(saved):
+    checkpointer, tmp_path = saved
+    with open(checkpointer.path, 'r+b') as handle:
+        handle.truncate(os.path.getsize(checkpointer.path) // 2)
+    with pytest.raises(ValueError):
+        checkpointer.load({'memory': memory('storage_dir', tmp_path)})
+
+
+@pytest.mark.parametrize('name', ['__state__', 'memory/frames', 'memory/priorities'])
+def test_bad_checksum_is_rejected(saved, name):
+    checkpointer, tmp_path = saved
+    with open(checkpointer.path, 'r+b') as handle:
+        start, end, offset, nbytes, crc = checkpoint._read_index(handle)[name]['chunks'][-1]
+        handle.seek(offset + nbytes // 2)
+        byte = handle.read(1)
+        handle.seek(-1, os.SEEK_CUR)
+        handle.write(bytes([byte[0] ^ 0x10]))
+    with pytest.raises(ValueError, match='checksum'):
+        checkpointer.load({'memory': memory('storage_dir', tmp_path)})
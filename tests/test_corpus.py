@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+DemoCorpus: building the index, keeping it up to date as trial files
+change, and looking trials up by level.
+"""
+import os
+import shutil
+import numpy as np
+import pytest
+
+from needlemaster import corpus as corpus_module
+from needlemaster.corpus import DemoCorpus
+from needlemaster.demo import Demo
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+trials = ['trial_0_1543329463743.csv', 'trial_1_1543329468206.csv', 'trial_1_1543329474121.csv',
+          'trial_11_1543329624024.csv', 'trial_19_1543329723130.csv']
+
+
+@pytest.fixture
+def trial_dir(tmp_path):
+    directory = tmp_path / 'data'
+    directory.mkdir()
+    for name in trials:
+        shutil.copy(os.path.join(data_dir, name), str(directory))
+    return directory
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    ''' the trial files read by refresh() '''
+    scanned = []
+    scan = corpus_module._scan_trial
+
+    def counting_scan(path):
+        scanned.append(os.path.basename(path))
+        return scan(path)
+    monkeypatch.setattr(corpus_module, '_scan_trial', counting_scan)
+    return scanned
+
+
+def assert_matches_files(corpus):
+    ''' every entry agrees with parsing its file from scratch '''
+    keys = [(level, timestamp) for level, timestamp in zip(corpus.level, corpus.timestamp)]
+    assert keys == sorted(keys)
+    for i, path in enumerate(corpus.paths):
+        level, timestamp = Demo.parse_name(str(path))
+        assert (corpus.level[i], corpus.timestamp[i]) == (level, int(timestamp))
+        expected = Demo(None, None, str(path))
+        assert corpus.rows[i] == len(expected.u)
+        np.testing.assert_array_equal(corpus.load(i).u, expected.u)
+        np.testing.assert_array_equal(corpus.load(i).s, expected.s)
+
+
+def test_build_index(trial_dir, tmp_path, scans):
+    index_path = str(tmp_path / 'index.npz')
+    corpus = DemoCorpus(str(trial_dir), index_path)
+    assert len(corpus) == len(trials) and sorted(scans) == sorted(trials)
+    assert os.path.exists(index_path)
+    assert_matches_files(corpus)
+
+    del scans[:]
+    reopened = DemoCorpus(str(trial_dir), index_path)
+    assert scans == []  # Nothing changed, nothing is read again
+    assert reopened.refresh() == 0
+    np.testing.assert_array_equal(reopened.paths, corpus.paths)
+    np.testing.assert_array_equal(reopened.rows, corpus.rows)
+    np.testing.assert_array_equal(reopened.offset, corpus.offset)
+
+
+def test_changed_files_invalidate_their_entries(trial_dir, tmp_path, scans):
+    index_path = str(tmp_path / 'index.npz')
+    DemoCorpus(str(trial_dir), index_path)
+    del scans[:]
+
+    # Drop the last rows of one trial, remove another, add a third
+    changed = trial_dir / trials[2]
+    lines = changed.read_text().splitlines(True)
+    changed.write_text(''.join(lines[:10]))
+    stat = os.stat(str(changed))
+    os.utime(str(changed), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.remove(str(trial_dir / trials[4]))
+    shutil.copy(os.path.join(data_dir, 'trial_2_1543329478552.csv'), str(trial_dir))
+
+    corpus = DemoCorpus(str(trial_dir), index_path)
+    assert sorted(scans) == sorted([trials[2], 'trial_2_1543329478552.csv'])
+    i = list(corpus.paths).index(str(changed))
+    assert corpus.rows[i] == 10
+    assert not any(path.endswith(trials[4]) for path in corpus.paths)
+    assert_matches_files(corpus)
+
+    # The updated index is what the next corpus reads
+    del scans[:]
+    reopened = DemoCorpus(str(trial_dir), index_path, refresh=False)
+    np.testing.assert_array_equal(reopened.paths, corpus.paths)
+    np.testing.assert_array_equal(reopened.rows, corpus.rows)
+
+
+def test_query_by_level(trial_dir):
+    corpus = DemoCorpus(str(trial_dir))
+    np.testing.assert_array_equal(corpus.levels(), [0, 1, 11, 19])
+    assert [os.path.basename(corpus.paths[i]) for i in corpus.select(1)] == trials[1:3]
+    assert [corpus.level[i] for i in corpus.select([0, 19])] == [0, 19]
+    assert [os.path.basename(corpus.paths[i]) for i in corpus.select(11)] == [trials[3]]
+    assert len(corpus.select(11, min_rows=1)) == 0  # The empty trial
+    assert len(corpus.select(min_rows=1)) == len(trials) - 1
+
+    demos = list(corpus.iter_demos(1))
+    assert [(demo.env, demo.timestamp) for demo in demos] == [(1, 1543329468206), (1, 1543329474121)]
+    pooled = corpus.load_all(1, workers=2)
+    for demo, expected in zip(pooled, demos):
+        assert (demo.env, demo.timestamp, demo.path) == (expected.env, expected.timestamp, expected.path)
+        np.testing.assert_array_equal(demo.u, expected.u)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Demo loading and conversion against the original line-by-line, scalar
+implementation, on every trial in data/ (empty ones included).
+"""
+import glob
+import math
+import os
+import numpy as np
+import pytest
+
+from needlemaster.demo import Demo
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+trials = sorted(glob.glob(os.path.join(data_dir, 'trial_*.csv')))
+
+
+def reference_load(handle):
+    ''' the original Demo.load '''
+    t, s, u = [], [], []
+    data = handle.readline()
+    while not data is None and len(data) > 0:
+        data = [float(x) for x in data.split(',')]
+        t.append(data[0])
+        s.append(data[1:4])
+        u.append(data[4:])
+        data = handle.readline()
+    return np.array(t), np.array(s), np.array(u)
+
+
+def reference_convert_action(a, width_ratio):
+    ''' the original Demo.convert_action, which only handled equal ratios '''
+    r, theta = a[0], a[1]
+    return np.array([width_ratio * r, theta])
+
+
+def test_trials_include_empty_ones():
+    assert any(os.path.getsize(trial) == 0 for trial in trials)
+
+
+@pytest.mark.parametrize('trial', trials, ids=os.path.basename)
+def test_load_matches_reference(trial):
+    demo = Demo(1920, 1080, filename=trial)
+    with open(trial) as handle:
+        t, s, u = reference_load(handle)
+    if len(t) == 0:
+        assert demo.t.shape == (0, ) and demo.s.shape == (0, 3) and demo.u.shape == (0, 2)
+        return
+    np.testing.assert_array_equal(demo.t, t)
+    np.testing.assert_array_equal(demo.s, s)
+    np.testing.assert_array_equal(demo.u, u)
+
+
+@pytest.mark.parametrize('trial', trials[::5], ids=os.path.basename)
+def test_equal_ratio_convert_matches_reference(trial):
+    demo = Demo(1920, 1080, filename=trial)
+    demo.device_width, demo.device_height = 1280, 720
+    with open(trial) as handle:
+        t, s, u = reference_load(handle)
+    demo.convert()
+    ratio = 1920 / 1280.
+    for row in range(len(t)):
+        np.testing.assert_array_equal(demo.u[row], reference_convert_action(u[row], ratio))
+        assert demo.s[row, 0] == s[row, 0] * ratio and demo.s[row, 1] == s[row, 1] * ratio
+
+
+def test_unequal_ratio_keeps_theta():
+    ''' theta is the heading increment, r the length of the per-axis scaled displacement, with its sign '''
+    demo = Demo(2000, 1000, None)
+    demo.device_width, demo.device_height = 1000, 1000
+    u = np.array([[10., 0.], [10., math.pi / 2], [-10., 0.3], [0., -0.2]])
+    converted = demo.convert_actions(u)
+    np.testing.assert_array_equal(converted[:, 1], u[:, 1])
+    np.testing.assert_allclose(converted[:, 0], [20., 10., -10 * math.hypot(2 * math.cos(0.3), math.sin(0.3)), 0.])
+    np.testing.assert_array_equal(demo.convert_action(u[2]), converted[2])
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Level packs: every shipped level compiled, read back from a memory-mapped
+file and from a buffer, against the text loader.
+"""
+import glob
+import io
+import os
+import numpy as np
+import pytest
+
+from needlemaster.environment import Environment, LevelTemplate
+from needlemaster.levelpack import LevelPack, compile_pack
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+levels = sorted(glob.glob(os.path.join(data_dir, 'environment_*.txt')),
+                key=lambda f: int(Environment.parse_name(f)))
+
+''' packed values are float32, scaled to the screen (up to 1920 wide) '''
+tolerance = {'rtol': 1e-6, 'atol': 1e-4}
+
+
+@pytest.fixture(scope='module')
+def pack_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('pack') / 'levels.pack')
+    compile_pack(levels, path)
+    return path
+
+
+def assert_same_level(template, expected):
+    assert (template.width, template.height) == (expected.width, expected.height)
+    assert len(template.gates) == len(expected.gates)
+    for gate, expected_gate in zip(template.gates, expected.gates):
+        np.testing.assert_allclose([gate.x, gate.y, gate.w], [expected_gate.x, expected_gate.y, expected_gate.w], **tolerance)
+        for name in ('corners', 'top', 'bottom'):
+            np.testing.assert_allclose(getattr(gate, name), getattr(expected_gate, name), **tolerance)
+    assert len(template.surfaces) == len(expected.surfaces)
+    for surface, expected_surface in zip(template.surfaces, expected.surfaces):
+        assert surface.deep == expected_surface.deep
+        np.testing.assert_allclose(surface.corners, expected_surface.corners, **tolerance)
+
+
+@pytest.mark.parametrize('source', ['memmap', 'buffer'])
+def test_pack_matches_text_levels(pack_path, source):
+    if source == 'memmap':
+        pack = LevelPack(pack_path)
+        assert isinstance(pack.data, np.memmap)
+    else:
+        with open(pack_path, 'rb') as handle:
+            pack = LevelPack(handle.read())
+    assert len(pack) == len(levels)
+    for index, filename in enumerate(levels):
+        level = int(Environment.parse_name(filename))
+        assert pack.index_of(level) == index
+        with open(filename) as handle:
+            assert_same_level(pack.template(index), LevelTemplate(handle))
+
+
+def test_compile_to_file_object(pack_path):
+    buffer = io.BytesIO()
+    compile_pack(levels, buffer)
+    with open(pack_path, 'rb') as handle:
+        assert buffer.getvalue() == handle.read()
+
+
+@pytest.mark.parametrize('offset, value', [(0, b'XMLP'), (4, (2).to_bytes(4, 'little'))], ids=['magic', 'version'])
+def test_bad_header_is_rejected(pack_path, offset, value):
+    with open(pack_path, 'rb') as handle:
+        data = bytearray(handle.read())
+    data[offset:offset + len(value)] = value
+    with pytest.raises(ValueError):
+        LevelPack(bytes(data))
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+ReplayMemory batches against the original per-transition implementation,
+and the same batches from every frame store.
+"""
+import collections
+import random
+import sys
+import types
+import numpy as np
+import pytest
+import torch
+
+from rainbow_dqn.memory import ReplayMemory
+
+args = types.SimpleNamespace(device=torch.device('cpu'), history_length=4, discount=0.99, multi_step=3,
+                             priority_weight=0.4, priority_exponent=0.5, batch_size=8)
+capacity = 50
+frame_shape = (6, 5)
+
+Transition = collections.namedtuple('Transition', ('timestep', 'state', 'action', 'reward', 'nonterminal'))
+blank_trans = Transition(0, torch.zeros(frame_shape, dtype=torch.uint8), None, 0, False)
+
+
+class ReferenceMemory():
+    ''' the list-of-Transitions replay memory ReplayMemory replaced, reduced to
+        building the sample of one data index '''
+    def __init__(self, size=capacity):
+        self.history = args.history_length
+        self.n = args.multi_step
+        self.size = size
+        self.data = [None] * size
+        self.index = 0
+        self.t = 0
+
+    def append(self, state, action, reward, terminal):
+        state = state[-1].mul(255).to(dtype=torch.uint8, device=torch.device('cpu'))
+        self.data[self.index] = Transition(self.t, state, action, reward, not terminal)
+        self.index = (self.index + 1) % self.size
+        self.t = 0 if terminal else self.t + 1
+
+    def get(self, data_index):
+        return self.data[data_index % self.size]
+
+    def _get_transition(self, idx):
+        transition = [None] * (self.history + self.n)
+        transition[self.history - 1] = self.get(idx)
+        for t in range(self.history - 2, -1, -1):
+            if transition[t + 1].timestep == 0:
+                transition[t] = blank_trans  # If future frame has timestep 0
+            else:
+                transition[t] = self.get(idx - self.history + 1 + t)
+        for t in range(self.history, self.history + self.n):
+            if transition[t - 1].nonterminal:
+                transition[t] = self.get(idx - self.history + 1 + t)
+            else:
+                transition[t] = blank_trans  # If prev (next) frame is terminal
+        return transition
+
+    def sample(self, idx):
+        transition = self._get_transition(idx)
+        state = torch.stack([trans.state for trans in transition[:self.history]]).to(dtype=torch.float32).div_(255)
+        next_state = torch.stack([trans.state for trans in transition[self.n:self.n + self.history]]).to(dtype=torch.float32).div_(255)
+        R = sum(args.discount ** n * transition[self.history + n - 1].reward for n in range(self.n))
+        return state, next_state, R, float(transition[self.history + self.n - 1].nonterminal)
+
+
+def trace(seed, steps):
+    ''' short episodes, so that starts and ends fall on every offset from a
+        sampled index, the ring wrap included '''
+    rng = np.random.default_rng(seed)
+    ends = set(np.cumsum(rng.integers(1, 9, steps)).tolist())
+    ends.update({capacity - 1, capacity, 2 * capacity - 2})  # Around the wrap
+    for step in range(steps):
+        frames = rng.integers(0, 256, (args.history_length, ) + frame_shape, dtype=np.uint8)
+        yield torch.from_numpy(frames).float().div(255), int(rng.integers(16)), float(rng.normal()), step in ends
+
+
+def filled(seed, steps, size=capacity, **kwargs):
+    mem, reference = ReplayMemory(args, size, **kwargs), ReferenceMemory(size)
+    for transition in trace(seed, steps):
+        mem.append(*transition)
+        reference.append(*transition)
+    return mem, reference
+
+
+def sample_all(mem):
+    ''' one batch of every valid data index '''
+    idxs = np.arange(capacity)
+    tree_idxs = idxs + mem.transitions.capacity - 1
+    valid = mem._valid(idxs, mem.transitions.sum_tree[tree_idxs])
+    idxs, tree_idxs = idxs[valid], tree_idxs[valid]
+    mem._sample_batch = lambda batch_size: (mem.transitions.sum_tree[tree_idxs], idxs, tree_idxs)
+    return idxs, mem.sample(len(idxs))
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('steps', [capacity - 7, 2 * capacity + 13])
+def test_batches_match_reference(seed, steps):
+    mem, reference = filled(seed, steps)
+    idxs, (_, states, actions, returns, next_states, nonterminals, _) = sample_all(mem)
+    assert len(idxs) > capacity // 2
+    for row, idx in enumerate(idxs):
+        state, next_state, R, nonterminal = reference.sample(idx)
+        assert torch.equal(states[row], state), idx
+        assert torch.equal(next_states[row], next_state), idx
+        assert returns[row].item() == pytest.approx(R, rel=1e-6, abs=1e-6)
+        assert nonterminals[row].item() == nonterminal
+        assert actions[row].item() == reference.get(idx).action
+
+
+def batches(mem, rng, cycles=12):
+    ''' sample, append, update priorities, in a fixed order: a memory-mapped
+        store draws its next batch in update_priorities, the others in sample,
+        with the same random numbers either way '''
+    random.seed(0)
+    out = []
+    for cycle in range(cycles):
+        out.append(mem.sample(args.batch_size))
+        for transition in trace(100 + cycle, 3):
+            mem.append(*transition)
+        mem.update_priorities(out[-1][0], rng.random(args.batch_size) + 0.1)
+    return out
+
+
+def assert_same_batches(batches, expected):
+    for batch, expected_batch in zip(batches, expected):
+        for tensor, expected_tensor in zip(batch, expected_batch):
+            assert np.array_equal(np.asarray(tensor), np.asarray(expected_tensor))
+
+
+''' memories large enough that no segment can fall entirely on the
+    transitions around the write index, which cannot be sampled '''
+large = 10 * capacity
+
+
+def test_storage_dir_batches_match_ram(tmp_path):
+    ram, _ = filled(0, 2 * large + 13, large)
+    mapped, _ = filled(0, 2 * large + 13, large, storage_dir=str(tmp_path))
+    assert isinstance(mapped.frames, np.memmap)
+    assert_same_batches(batches(mapped, np.random.default_rng(1)), batches(ram, np.random.default_rng(1)))
+
+
+def test_prefetched_batch_is_revalidated(tmp_path):
+    mem, reference = filled(1, 2 * large + 13, large, storage_dir=str(tmp_path))
+    random.seed(0)
+    tree_idxs = mem.sample(args.batch_size)[0]
+    mem.update_priorities(tree_idxs, np.ones(args.batch_size))
+    batch_size, prefetched, prefetched_tree_idxs = mem.prefetched
+    # The oldest transitions that can be sampled go in the first rows: the appends below overwrite them or come
+    # too close to them
+    prefetched[:4] = (mem.transitions.index + args.history_length + np.arange(4)) % large
+    prefetched_tree_idxs[:4] = prefetched[:4] + mem.transitions.capacity - 1
+    assert mem._valid(prefetched, mem.transitions.sum_tree[prefetched_tree_idxs]).all()
+
+    for transition in trace(7, args.multi_step + 2):  # More than n appends
+        mem.append(*transition)
+        reference.append(*transition)
+    still_valid = mem._valid(prefetched, mem.transitions.sum_tree[prefetched_tree_idxs])
+    assert not still_valid[:4].any() and still_valid[4:].all()
+
+    tree_idxs, states, actions, returns, next_states, nonterminals, _ = mem.sample(args.batch_size)
+    idxs = tree_idxs - mem.transitions.capacity + 1
+    assert mem._valid(idxs, mem.transitions.sum_tree[tree_idxs]).all()
+    assert (idxs[4:] == prefetched[4:]).all()  # Rows still valid are kept
+    for row, idx in enumerate(idxs):
+        state, next_state, R, nonterminal = reference.sample(idx)
+        assert torch.equal(states[row], state) and torch.equal(next_states[row], next_state)
+        assert returns[row].item() == pytest.approx(R, rel=1e-6, abs=1e-6)
+        assert nonterminals[row].item() == nonterminal
+
+
+def test_compressed_batches_match_ram():
+    ram, _ = filled(2, 2 * large + 13, large)
+    compressed, _ = filled(2, 2 * large + 13, large, compress=True)
+    assert compressed.frames.dtype == object
+    assert_same_batches(batches(compressed, np.random.default_rng(3)), batches(ram, np.random.default_rng(3)))
+
+
+def test_compressed_unwritten_slots_are_blank():
+    ram, _ = filled(3, capacity // 2)
+    compressed, _ = filled(3, capacity // 2, compress=True)
+    assert compressed.frames[capacity - 1] is None
+    unwritten = np.arange(capacity // 2, capacity)
+    assert not compressed._get_frames(unwritten[:, None]).any()
+    # Validation states run over every slot, unwritten ones included
+    for states, expected in zip(compressed.state_batches(16), ram.state_batches(16)):
+        assert torch.equal(states, expected)
+
+
+def test_compressed_bytes_per_transition():
+    compressed, _ = filled(4, capacity + 7, compress=True)
+    frames = sum(sys.getsizeof(frame) for frame in compressed.frames)
+    metadata = sum(array.itemsize for array in (compressed.timesteps, compressed.actions, compressed.rewards, compressed.nonterminals))
+    expected = frames / capacity + compressed.frames.itemsize + metadata + compressed.transitions.sum_tree.itemsize
+    assert compressed.bytes_per_transition() == pytest.approx(expected)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+DQN input shape: built for the observations FrameHistory hands it.
+"""
+import types
+import pytest
+import torch
+
+from needlemaster.environment import ObservationSpec
+from rainbow_dqn.memory import FrameHistory
+from rainbow_dqn.model import DQN
+
+action_space = 16
+
+
+def make_args(history_length):
+    return types.SimpleNamespace(atoms=11, history_length=history_length, hidden_size=32, noisy_std=0.1)
+
+
+@pytest.mark.parametrize('spec, history_length', [
+    (ObservationSpec(84, True, torch.float32), 4),
+    (ObservationSpec(84, True, torch.uint8), 2),
+    (ObservationSpec(112, False, torch.uint8), 3),
+])
+def test_forward_on_frame_history(spec, history_length):
+    dqn = DQN(make_args(history_length), action_space, spec)
+    history = FrameHistory(history_length)
+    observation = torch.zeros(spec.shape, dtype=spec.dtype)
+    state = history.reset(observation)
+    state = history.append(observation)
+    assert state.shape[0] == history_length
+    q = dqn(state.unsqueeze(0))
+    assert q.shape == (1, action_space, 11)
+
+
+def test_rgb_needs_history_of_three():
+    with pytest.raises(ValueError):
+        DQN(make_args(4), action_space, ObservationSpec(84, False, torch.float32))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the numpy render backend with the matplotlib one on every level,
+at the default observation size and at smaller ones.
+"""
+import glob
+import os
+import random
+import pytest
+import torch
+
+from needlemaster.environment import Environment, ObservationSpec, mode_rl, backend_numpy
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+levels = sorted(glob.glob(os.path.join(data_dir, 'environment_*.txt')))
+
+''' per observation size, bounds on the per-frame pixel difference (values in
+    [0, 1]): mean absolute difference and fraction of values off by more than
+    off_by. What is left comes from matplotlib's antialiased polygon edges,
+    which cover a larger share of the frame the smaller it is '''
+bounds = {
+    224: (0.01, 0.02),
+    160: (0.01, 0.02),
+    112: (0.02, 0.04),
+    84: (0.025, 0.08),
+}
+off_by = 0.1
+
+steps = 30
+
+
+@pytest.mark.parametrize('size', sorted(bounds, reverse=True))
+@pytest.mark.parametrize('filename', levels, ids=os.path.basename)
+def test_numpy_backend_matches_matplotlib(filename, size):
+    spec = ObservationSpec(size, False, torch.float32)
+    reference = Environment(filename, mode=mode_rl, spec=spec)
+    env = Environment(filename, mode=mode_rl, backend=backend_numpy, spec=spec)
+    rng = random.Random(0)
+    frames = [(reference.render(), env.render())]
+    for _ in range(steps):
+        action = rng.randrange(env.action_space())
+        expected, expected_reward, expected_done = reference.step(action)
+        actual, reward, done = env.step(action)
+        assert (reward, done) == (expected_reward, expected_done)
+        frames.append((expected, actual))
+        if done:
+            break
+
+    max_mean_difference, max_fraction_off = bounds[size]
+    for t, (expected, actual) in enumerate(frames):
+        assert actual.shape == expected.shape == spec.shape and actual.dtype == expected.dtype
+        difference = (actual - expected).abs()
+        assert difference.mean().item() <= max_mean_difference, 'step %d' % t
+        assert (difference > off_by).float().mean().item() <= max_fraction_off, 'step %d' % t
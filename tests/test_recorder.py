@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+FrameRecorder error handling: a failing writer, or one that was closed,
+must not hang its callers.
+"""
+import os
+import threading
+import numpy as np
+import pytest
+
+from needlemaster.environment import Environment, mode_rl, backend_numpy
+from needlemaster.recorder import FrameRecorder
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+level = os.path.join(data_dir, 'environment_0.txt')
+
+
+def test_write_error_is_raised_instead_of_blocking(tmp_path):
+    ''' the output directory is a regular file, so opening every episode fails '''
+    directory = tmp_path / 'not_a_directory'
+    directory.write_text('')
+    recorder = FrameRecorder(str(directory), queue_size=2)
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+    raised = {}
+
+    def call(name, function):
+        try:
+            function()
+        except OSError as error:
+            raised[name] = error
+
+    def write():
+        for t in range(20):
+            recorder.write(t, frame)
+
+    for name, function in (('write', write), ('close', recorder.close)):
+        thread = threading.Thread(target=call, args=(name, function), daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive(), '%s blocked' % name
+        assert name in raised
+    assert not recorder.thread.is_alive()
+
+
+def test_frames_are_written(tmp_path):
+    recorder = FrameRecorder(str(tmp_path))
+    recorder.start_episode('level')
+    for t in range(3):
+        recorder.write(t, np.zeros((4, 4, 3), dtype=np.uint8))
+    recorder.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['level_%05d.png' % t for t in range(3)]
+
+
+def test_closed_recorder_rejects_frames(tmp_path):
+    recorder = FrameRecorder(str(tmp_path), queue_size=2)
+    recorder.close()
+    with pytest.raises(ValueError):
+        recorder.start_episode('level')
+    with pytest.raises(ValueError):
+        recorder.write(0, np.zeros((4, 4, 3), dtype=np.uint8))
+
+
+def test_environment_stops_recording_on_close(tmp_path):
+    recorder = FrameRecorder(str(tmp_path), queue_size=2)
+    env = Environment(level, mode=mode_rl, backend=backend_numpy, recorder=recorder)
+    env.close()  # After the first frame, recorded by the reset in __init__
+    assert env.recorder is None
+
+    def resets():
+        for _ in range(5):  # More episodes than the queue holds
+            env.reset()
+    thread = threading.Thread(target=resets, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), 'reset blocked'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['level_0_rl_00000.png']
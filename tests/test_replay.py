@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+score_corpus: the same score rows serially and over a worker pool, and the
+same as playing each trial through an Environment directly.
+"""
+import os
+import shutil
+import numpy as np
+import pytest
+
+from needlemaster.corpus import DemoCorpus
+from needlemaster.demo import Demo
+from needlemaster.environment import Environment, mode_demo, obs_none
+from needlemaster.replay import score_corpus, score_fields
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+''' two trials of level 1, one of level 0, an empty trial of level 11 and
+    a trial of level 2, whose level file is left out '''
+trials = ['trial_0_1543329463743.csv', 'trial_1_1543329468206.csv', 'trial_1_1543329474121.csv',
+          'trial_11_1543329624024.csv', 'trial_2_1543329478552.csv']
+level_files = ['environment_0.txt', 'environment_1.txt', 'environment_11.txt']
+
+
+@pytest.fixture(scope='module')
+def corpus_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('data')
+    for name in trials + level_files:
+        shutil.copy(os.path.join(data_dir, name), str(directory))
+    return str(directory)
+
+
+def direct_replay(path, level_file):
+    ''' step an Environment through the trial's actions until the game ends '''
+    env = Environment(level_file, mode=mode_demo, observation=obs_none)
+    demo = Demo(None, None, path)
+    done = False
+    while not done and env.t < len(demo.u):
+        _, _, done = env.step(demo.u[env.t])
+    return {'steps': env.t, 'finished': done, 'passed_gates': env._compute_passed_gates(),
+            'damage': env.damage, 'score': env.score()}
+
+
+def test_serial_and_pool_rows_match_direct_replay(corpus_dir):
+    corpus = DemoCorpus(corpus_dir)
+    serial = score_corpus(corpus, corpus_dir, workers=1)
+    pooled = score_corpus(corpus, corpus_dir, workers=2)
+    assert serial == pooled
+
+    assert [os.path.basename(row['path']) for row in serial] == trials[:3]
+    for row in serial:
+        assert set(row) == set(score_fields)
+        level_file = os.path.join(corpus_dir, 'environment_%d.txt' % row['level'])
+        expected = direct_replay(row['path'], level_file)
+        for field, value in expected.items():
+            assert row[field] == pytest.approx(value), field
+        assert row['score'] == pytest.approx(row['gate_score'] + row['time_score'] + row['path_score'] + row['damage_score'])
+        assert row['rows'] == len(Demo(None, None, row['path']).u)
+
+
+def test_level_filter(corpus_dir):
+    corpus = DemoCorpus(corpus_dir)
+    rows = score_corpus(corpus, corpus_dir, level=1, workers=2)
+    assert [os.path.basename(row['path']) for row in rows] == trials[1:3]
+    assert rows == [row for row in score_corpus(corpus, corpus_dir, workers=1) if row['level'] == 1]
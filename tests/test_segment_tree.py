@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+SegmentTree batched updates and finds, on sizes that are and are not
+powers of two.
+"""
+import numpy as np
+import pytest
+
+from rainbow_dqn.memory import SegmentTree
+
+sizes = [1, 2, 5, 8, 13, 100]
+
+
+def filled(size, count, rng):
+    tree = SegmentTree(size)
+    for _ in range(count):
+        tree.append(float(rng.random() ** 3 * 10))
+    return tree
+
+
+def leaves(tree):
+    return tree.sum_tree[tree.capacity - 1:]
+
+
+def assert_consistent(tree):
+    ''' every inner node is the sum of its children and padding leaves stay 0 '''
+    inner = np.arange(tree.capacity - 1)
+    np.testing.assert_allclose(tree.sum_tree[inner], tree.sum_tree[2 * inner + 1] + tree.sum_tree[2 * inner + 2])
+    assert not leaves(tree)[tree.size:].any()
+
+
+@pytest.mark.parametrize('size', sizes)
+def test_batched_update_matches_sequential(size):
+    rng = np.random.default_rng(size)
+    tree, reference = filled(size, size, rng), SegmentTree(size)
+    reference.sum_tree[:], reference.max = tree.sum_tree, tree.max
+    for _ in range(20):
+        idxs = rng.integers(0, size, int(rng.integers(1, 2 * size + 1))) + tree.capacity - 1  # With duplicates
+        values = rng.random(len(idxs)) * 5
+        tree.update(idxs, values)
+        for index, value in zip(idxs, values):
+            reference.update_one(index, value)
+        np.testing.assert_allclose(tree.sum_tree, reference.sum_tree)
+        assert tree.max == reference.max
+        assert_consistent(tree)
+
+
+def test_duplicate_indices_keep_the_last_value():
+    tree = filled(5, 5, np.random.default_rng(0))
+    first = tree.capacity - 1
+    tree.update([first + 1, first + 3, first + 1], [2., 3., 4.])
+    assert leaves(tree)[1] == 4. and leaves(tree)[3] == 3.
+    assert tree.total() == pytest.approx(leaves(tree).sum())
+    assert_consistent(tree)
+
+
+@pytest.mark.parametrize('size', sizes)
+def test_find_never_returns_padding_or_empty_leaves(size):
+    rng = np.random.default_rng(size)
+    for _ in range(200):
+        count = int(rng.integers(1, size + 1))
+        tree = filled(size, count, rng)
+        total = tree.total()
+        values = np.r_[rng.random(50) * total, 0., total, np.nextafter(total, np.inf)]
+        probs, idxs, tree_idxs = tree.find(values)
+        assert (idxs >= 0).all() and (idxs < count).all()
+        assert (probs[values > 0] > 0).all()  # Any value above 0 lands on a transition that can be drawn
+        assert (tree_idxs == idxs + tree.capacity - 1).all()
+        np.testing.assert_array_equal(probs, tree.sum_tree[tree_idxs])
+        assert tree.find(total)[1] < count  # Scalar find
+
+
+@pytest.mark.parametrize('size', [5, 13])
+def test_sampling_frequency_matches_priorities(size):
+    rng = np.random.default_rng(size)
+    tree = filled(size, size, rng)
+    tree.update(np.array([tree.capacity - 1 + 2]), np.array([0.]))  # One transition that must never be drawn
+    draws = 200000
+    _, idxs, _ = tree.find(rng.random(draws) * tree.total())
+    frequencies = np.bincount(idxs, minlength=size) / draws
+    expected = leaves(tree)[:size] / tree.total()
+    assert frequencies[2] == 0
+    np.testing.assert_allclose(frequencies, expected, atol=4 * np.sqrt(expected * (1 - expected) / draws).max())
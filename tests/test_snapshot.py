@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Environment.snapshot/restore: replaying the same actions from a snapshot
+gives the same observations, rewards and done flags, in place and in a
+second Environment of the level.
+"""
+import glob
+import os
+import numpy as np
+import pytest
+import torch
+
+from needlemaster.environment import Environment, ObservationSpec, backend_numpy, obs_state
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+levels = sorted(glob.glob(os.path.join(data_dir, 'environment_*.txt')))
+
+spec = ObservationSpec(84, False, torch.uint8)
+before = 10
+after = 60
+
+
+def moves(rng, count):
+    ''' demo-mode (dx, dw) moves, long enough for the thread to show and for
+        the needle to reach tissue and gates '''
+    return list(zip(rng.uniform(-40, -10, count), rng.uniform(-0.1, 0.1, count)))
+
+
+def play(env, actions):
+    ''' observations, rewards and done flags of actions, up to the end of the game '''
+    return play_together([env], [actions])[0]
+
+
+def play_together(envs, actions):
+    ''' play each Environment its actions, one step of each in turn '''
+    traces = [[] for _ in envs]
+    for step in range(max(len(a) for a in actions)):
+        for env, env_actions, trace in zip(envs, actions, traces):
+            if step < len(env_actions) and not (trace and trace[-1][2]):
+                observation, reward, done = env.step(env_actions[step])
+                trace.append((observation.clone(), reward, done))
+    return traces
+
+
+def assert_same(trace, expected):
+    assert len(trace) == len(expected)
+    for (observation, reward, done), (expected_observation, expected_reward, expected_done) in zip(trace, expected):
+        assert torch.equal(observation, expected_observation)
+        assert reward == expected_reward
+        assert done == expected_done
+
+
+def environment(filename, **kwargs):
+    return Environment(filename, backend=backend_numpy, spec=spec, **kwargs)
+
+
+@pytest.mark.parametrize('observation', ['image', 'state'])
+@pytest.mark.parametrize('filename', levels[::4], ids=os.path.basename)
+def test_replay_from_snapshot(filename, observation):
+    kwargs = {'observation': obs_state} if observation == 'state' else {}
+    rng = np.random.default_rng(0)
+    env = environment(filename, **kwargs)
+    play(env, moves(rng, before))
+    snapshot = env.snapshot()
+    actions = moves(rng, after)
+    expected = play(env, actions)
+
+    env.restore(snapshot)
+    assert_same(play(env, actions), expected)
+    env.restore(snapshot)  # The snapshot is unchanged by the steps taken after restoring it
+    assert_same(play(env, actions), expected)
+
+    other = environment(filename, **kwargs)
+    play(other, moves(rng, before // 2))  # Elsewhere, with a rendered scene to replace
+    other.restore(snapshot)
+    assert_same(play(other, actions), expected)
+
+    # Two Environments carrying on from the same snapshot along different paths do not disturb each other
+    diverging = moves(rng, after)
+    env.restore(snapshot)
+    expected_diverging = play(env, diverging)
+    env.restore(snapshot)
+    other.restore(snapshot)
+    trace, other_trace = play_together([env, other], [actions, diverging])
+    assert_same(trace, expected)
+    assert_same(other_trace, expected_diverging)
+
+
+def test_restore_into_a_different_level():
+    snapshot = environment(levels[0]).snapshot()
+    with pytest.raises(ValueError):
+        environment(levels[1]).restore(snapshot)
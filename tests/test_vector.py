@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+VectorEnvironment against N independent Environments, auto-reset included.
+"""
+import glob
+import os
+import numpy as np
+import pytest
+import torch
+
+from needlemaster.environment import Environment, ObservationSpec, mode_rl, backend_numpy, obs_image, obs_state, obs_none
+from needlemaster.vector import VectorEnvironment
+
+data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+levels = sorted(glob.glob(os.path.join(data_dir, 'environment_*.txt')))
+
+filenames = levels[:4]
+spec = ObservationSpec(84, False, torch.uint8)
+steps = 320  # Past max_time, so every episode ends once
+''' mostly forward moves, so needles cross tissue and gates '''
+action_probabilities = np.r_[np.full(8, 0.02), np.full(8, 0.105)]
+
+
+@pytest.mark.parametrize('observation', [obs_image, obs_state], ids=['image', 'state'])
+def test_vector_matches_environments(observation):
+    kwargs = {'mode': mode_rl, 'backend': backend_numpy, 'spec': spec, 'observation': observation}
+    vector = VectorEnvironment(filenames, workers=2, **kwargs)
+    envs = [Environment(filename, **kwargs) for filename in filenames]
+    try:
+        assert vector.action_space() == envs[0].action_space()
+        observations = vector.reset()
+        for i, env in enumerate(envs):
+            assert torch.equal(observations[i], env.reset())
+
+        rng = np.random.RandomState(0)
+        resets = 0
+        for t in range(steps):
+            actions = rng.choice(len(action_probabilities), len(envs), p=action_probabilities)
+            observations, rewards, dones = vector.step(actions)
+            for i, env in enumerate(envs):
+                observation, reward, done = env.step(int(actions[i]))
+                assert done == dones[i], 'step %d, environment %d' % (t, i)
+                assert reward == rewards[i], 'step %d, environment %d' % (t, i)
+                if done:
+                    # the vector's copy was reset automatically
+                    resets += 1
+                    observation = env.reset()
+                assert torch.equal(observation, observations[i]), 'step %d, environment %d' % (t, i)
+        assert resets >= len(envs)
+
+        observations = vector.reset()
+        for i, env in enumerate(envs):
+            assert torch.equal(observations[i], env.reset())
+    finally:
+        vector.close()
+
+
+def test_obs_none_is_rejected():
+    with pytest.raises(ValueError):
+        VectorEnvironment(filenames[0], n=2, observation=obs_none)